@@ -0,0 +1,450 @@
+import collections
+import time
+
+import capture
+import catalog
+import checkpoint
+import metrics
+import pipeline
+import post_export
+import record
+import util
+
+__author__ = 'chris'
+
+
+class CaptureItem(object):
+    """
+    Data from a single capture as it moves through post-processing, export and post-export
+    """
+
+    def __init__(self, capture_id, data):
+        self.capture_id = capture_id
+        self.capture_id_short = capture_id[-8::]
+        self.data = data
+        self.exported_files = []
+        self.exports = []
+        self.deferred = set()
+        self.checkpoint = None
+        self.catalog = None
+
+
+class Acquisition(util.LoggingBaseClass):
+    """
+    Steps the experiment tree and runs a capture for each leaf step
+    """
+
+    def __init__(self, experiment_nodes, capture_modules, post_process_modules=None, export_modules=None,
+                 post_export_modules=None, pipeline_config=None, parallel_capture_config=None,
+                 checkpoint_journal=None, resume_record=None, metrics_registry=None, record_batch_size=None,
+                 catalog_index=None, post_export_pool_config=None):
+        super().__init__()
+
+        self._experiment_nodes = list(experiment_nodes)
+        self._capture_modules = capture_modules
+        self._post_process_modules = post_process_modules if post_process_modules else []
+        self._export_modules = export_modules if export_modules else []
+        self._post_export_modules = post_export_modules if post_export_modules else []
+
+        # Track running experiments in order to stop them properly
+        self._running_experiments = []
+
+        # Flatten the tree so nodes can be referenced by index in checkpoint records
+        self._nodes = []
+
+        for node in self._experiment_nodes:
+            self._flatten(node)
+
+        # Captures share a schema and are stored by column in record batches
+        self._record_builder = record.RecordBuilder(record_batch_size)
+
+        self._catalog_index = catalog_index
+        self._checkpoint_journal = checkpoint_journal
+        self._resume_record = resume_record
+        self._capture_count = 0
+
+        # Captures waiting on background exporters, in capture order
+        self._deferred = collections.OrderedDict()
+
+        # Stage timing, histograms are looked up once here to keep the loop cheap
+        self._metrics = metrics_registry if metrics_registry else metrics.MetricsRegistry()
+
+        self._step_histograms = {n.experiment: self._metrics.get_histogram(
+            "step.{}".format(n.experiment.get_label())) for n in self._nodes}
+        self._capture_histograms = self._module_histograms('capture', self._capture_modules)
+        self._post_process_histograms = self._module_histograms('post_process', self._post_process_modules)
+        self._export_histograms = self._module_histograms('export', self._export_modules)
+        self._post_export_histograms = self._module_histograms('post_export', self._post_export_modules)
+        self._total_histogram = self._metrics.get_histogram('capture_total')
+
+        self._capture_runner = None
+
+        if parallel_capture_config is not None:
+            self._capture_runner = capture.ParallelCaptureRunner(self._capture_modules,
+                                                                 histograms=self._capture_histograms,
+                                                                 **parallel_capture_config)
+
+        self._post_export_pool = None
+
+        if post_export_pool_config is not None and self._post_export_modules:
+            self._post_export_pool = post_export.PostExportPool(self._post_export_modules,
+                                                                histograms=self._post_export_histograms,
+                                                                forward=self._forward_files,
+                                                                **post_export_pool_config)
+
+        self._pipeline = None
+
+        if pipeline_config is not None:
+            stage_functions = []
+
+            if self._post_process_modules:
+                stage_functions.append(('post_process', self._post_process))
+
+            stage_functions.append(('export', self._export))
+
+            if self._post_export_modules:
+                stage_functions.append(('post_export', self._post_export))
+
+            # Capture is only complete once the final stage has processed it
+            (last_name, last_function) = stage_functions[-1]
+            stage_functions[-1] = (last_name, lambda item: self._complete(last_function(item)))
+
+            self._pipeline = pipeline.Pipeline.from_config(stage_functions, **pipeline_config)
+
+    def run(self):
+        if self._pipeline:
+            self._pipeline.start()
+
+        # Step experiment stack
+        if self._resume_record:
+            (experiment_nodes, active_experiments) = self._resume(self._resume_record)
+        else:
+            experiment_nodes = list(self._experiment_nodes)
+            active_experiments = []
+
+        while experiment_nodes:
+            current_node = experiment_nodes[0]
+            current_experiment = current_node.experiment
+
+            if current_experiment.has_next():
+                # Add experiment to active list
+                if current_experiment not in active_experiments:
+                    active_experiments.append(current_experiment)
+
+                if current_experiment not in self._running_experiments:
+                    self._running_experiments.append(current_experiment)
+
+                # Step the active experiment, including any settling delay
+                start_time = time.perf_counter()
+                current_experiment.step()
+                self._step_histograms[current_experiment].add(time.perf_counter() - start_time)
+
+                if current_node.children:
+                    # Append children to node stack
+                    experiment_nodes[:0] = current_node.children
+                else:
+                    # Save data from this experiment
+                    self._capture(experiment_nodes, active_experiments)
+
+                    self._metrics.poll()
+            else:
+                # Remove experiment both from the stack and from the active list
+                experiment_nodes.pop(0)
+                active_experiments.remove(current_experiment)
+
+                # Reset experiment state in case it is re-used
+                current_experiment.reset()
+
+    def stop(self):
+        errors = []
+
+        # Stop running experiments first so equipment is left in a safe state whatever fails below
+        for e in self._running_experiments:
+            self._stop_step(errors, "stopping experiment {}".format(e.get_label()), e.stop)
+
+        # Finish processing captures already handed to the pipeline
+        if self._pipeline:
+            self._stop_step(errors, 'stopping pipeline', self._pipeline.stop)
+
+        # Flush and close output even after a failure so buffered data isn't lost
+        closed_files = []
+
+        for m in self._export_modules:
+            files = self._stop_step(errors, "closing {}".format(type(m).__name__), m.close)
+
+            if files:
+                closed_files.extend(files)
+
+        # Background exporters have finished, so every capture they wrote can be completed
+        self._stop_step(errors, 'completing background exports', lambda: self._collect_deferred(stopping=True))
+
+        if self._deferred:
+            self._log.warning("{} capture{} not written by background exporters".format(
+                len(self._deferred), 's' if len(self._deferred) != 1 else ''))
+
+        if closed_files and self._post_export_modules:
+            # Files completed by closing exporters haven't been post-exported yet
+            self._stop_step(errors, 'post-exporting closed files',
+                            lambda: self._post_export_files(list(collections.OrderedDict.fromkeys(closed_files))))
+
+        if self._post_export_pool:
+            # Finish post-export work already queued before the post-exporters are closed
+            self._stop_step(errors, 'shutting down post-export pool', self._post_export_pool.shutdown)
+
+        for (n, m) in enumerate(self._post_export_modules):
+            files = self._stop_step(errors, "closing {}".format(type(m).__name__), m.close)
+
+            if files and m.REPLACES_FILES:
+                # Files replaced while closing still go through the remaining post-exporters
+                self._stop_step(errors, "post-exporting files from {}".format(type(m).__name__),
+                                lambda: self._run_post_exporters(self._forward_files(m, (), files), n + 1))
+
+        if self._capture_runner:
+            self._stop_step(errors, 'shutting down capture runner', self._capture_runner.shutdown)
+
+        if self._checkpoint_journal:
+            self._stop_step(errors, 'closing checkpoint journal', self._checkpoint_journal.close)
+
+        if self._catalog_index:
+            self._stop_step(errors, 'closing catalog', self._catalog_index.close)
+
+        self._stop_step(errors, 'writing metrics', self._metrics.write)
+        self._metrics.log_summary()
+
+        # Every step has been attempted, report the first failure
+        if errors:
+            raise errors[0]
+
+    def get_metrics(self):
+        return self._metrics
+
+    def _stop_step(self, errors, description, function):
+        try:
+            return function()
+        except Exception as e:
+            self._log.exception("Exception {}".format(description), exc_info=True)
+            errors.append(e)
+
+    def _module_histograms(self, prefix, modules):
+        histograms = []
+        names = []
+
+        for m in modules:
+            label = m.get_label() if hasattr(m, 'get_label') else type(m).__name__
+            name = "{}.{}".format(prefix, label)
+
+            # Number repeated modules of the same type
+            if name in names:
+                name = "{}#{}".format(name, names.count(name) + 1)
+
+            names.append("{}.{}".format(prefix, label))
+            histograms.append(self._metrics.get_histogram(name))
+
+        return histograms
+
+    def _flatten(self, node):
+        self._nodes.append(node)
+
+        if node.children:
+            for child in node.children:
+                self._flatten(child)
+
+    def _checkpoint(self, capture_id, experiment_nodes, active_experiments):
+        state = []
+
+        for node in self._nodes:
+            try:
+                state.append(node.experiment.get_resume_state())
+            except NotImplementedError:
+                state.append(None)
+
+        return {
+            'capture': self._capture_count,
+            'cap_id': capture_id,
+            'timestamp': time.time(),
+            'state': state,
+            'stack': [self._nodes.index(n) for n in experiment_nodes],
+            'active': [[n.experiment for n in self._nodes].index(e) for e in active_experiments]
+        }
+
+    def _resume(self, record):
+        if len(record['state']) != len(self._nodes):
+            raise checkpoint.CheckpointException('Checkpoint does not match experiment configuration')
+
+        for (node, state) in zip(self._nodes, record['state']):
+            if state is not None:
+                node.experiment.set_resume_state(state)
+
+        experiment_nodes = [self._nodes[i] for i in record['stack']]
+        active_experiments = [self._nodes[i].experiment for i in record['active']]
+
+        self._running_experiments.extend(active_experiments)
+        self._capture_count = record['capture']
+
+        self._log.info("Resuming after capture {} ({})".format(self._capture_count, record['cap_id']))
+
+        return experiment_nodes, active_experiments
+
+    def _capture(self, experiment_nodes, active_experiments):
+        capture_start_time = time.perf_counter()
+
+        # Generate a unique identifier for the capture
+        capture_id = util.rand_hex_str(64)
+
+        # Numbered from 1 across the whole run, including any run this one resumed
+        self._capture_count += 1
+
+        # Timestamp data and attach unique id and index
+        parts = [{
+            'cap_id': capture_id,
+            'cap_index': self._capture_count,
+            'cap_time': time.strftime('%a, %d %b %Y %H:%M:%S +0000'),
+            'cap_timestamp': time.time()
+        }]
+
+        # Get current state of experiment
+        for e in active_experiments:
+            parts.append(e.get_state())
+
+        # Capture data from all sources
+        if self._capture_runner:
+            parts.append(self._capture_runner.get_data(active_experiments))
+        else:
+            for (c, h) in zip(self._capture_modules, self._capture_histograms):
+                start_time = time.perf_counter()
+                parts.append(c.get_data(active_experiments))
+                h.add(time.perf_counter() - start_time)
+
+        # Each part is written straight into the record batch rather than merged into one dictionary first
+        item = CaptureItem(capture_id, self._record_builder.build(parts))
+
+        if self._catalog_index:
+            # Primary key values depend on the active experiments so resolve them now
+            item.catalog = (self._capture_count, catalog.CatalogIndex.get_key_values(active_experiments, item.data))
+
+        if self._checkpoint_journal:
+            # Snapshot state now, the record is written once the capture has been fully processed
+            item.checkpoint = self._checkpoint(capture_id, experiment_nodes, active_experiments)
+
+        if self._pipeline:
+            # Hand off to worker threads so the next step isn't delayed by disk access
+            self._pipeline.put(item)
+        else:
+            if self._post_process_modules:
+                self._post_process(item)
+
+            if self._export(item) is not None:
+                if self._post_export_modules:
+                    self._post_export(item)
+
+                self._complete(item)
+
+        self._total_histogram.add(time.perf_counter() - capture_start_time)
+
+    def _post_process(self, item):
+        # Apply optional post-processors to data
+        for (p, h) in zip(self._post_process_modules, self._post_process_histograms):
+            start_time = time.perf_counter()
+            d = p.process(item.data)
+            h.add(time.perf_counter() - start_time)
+
+            # Don't let badly written post-processors wipe out data
+            if d is not None:
+                item.data = d
+            else:
+                self._log.warning("PostProcessor {} returning no data".format(type(p).__name__))
+
+        return item
+
+    def _export(self, item):
+        # Export data
+        for (e, h) in zip(self._export_modules, self._export_histograms):
+            start_time = time.perf_counter()
+            f = e.export(item.capture_id_short, item.data)
+            h.add(time.perf_counter() - start_time)
+
+            if e.DEFERRED:
+                item.deferred.add(e)
+            elif f is not None:
+                item.exported_files.extend(f)
+                item.exports.append((self._export_name(e), f))
+
+        # Post-export, catalog and checkpoint wait until the background writes have finished
+        deferred = bool(item.deferred)
+
+        if deferred:
+            self._deferred[item.capture_id_short] = item
+
+        self._collect_deferred()
+
+        return None if deferred else item
+
+    def _collect_deferred(self, stopping=False):
+        for e in self._export_modules:
+            if not e.DEFERRED:
+                continue
+
+            for (identifier, files) in e.pop_completed():
+                item = self._deferred[identifier]
+                item.deferred.discard(e)
+
+                if files is not None:
+                    item.exported_files.extend(files)
+                    item.exports.append((self._export_name(e), files))
+
+        # Captures carry on in order, so a checkpoint never covers a capture that hasn't been written
+        while self._deferred and not next(iter(self._deferred.values())).deferred:
+            (_, item) = self._deferred.popitem(last=False)
+
+            if self._post_export_modules and self._pipeline and not stopping:
+                self._pipeline.get_stage('post_export').put(item)
+            else:
+                if self._post_export_modules:
+                    self._post_export(item)
+
+                self._complete(item)
+
+    @staticmethod
+    def _export_name(export_module):
+        return export_module.get_label() if hasattr(export_module, 'get_label') else type(export_module).__name__
+
+    def _post_export(self, item):
+        self._post_export_files(item.exported_files)
+
+        return item
+
+    def _post_export_files(self, files):
+        if self._post_export_pool:
+            # Runs later on the pool, coalesced with requests from other captures
+            self._post_export_pool.submit(files)
+            return
+
+        self._run_post_exporters(files, 0)
+
+    def _run_post_exporters(self, files, start):
+        for n in range(start, len(self._post_export_modules)):
+            start_time = time.perf_counter()
+            processed_files = self._post_export_modules[n].process(files)
+            self._post_export_histograms[n].add(time.perf_counter() - start_time)
+
+            files = self._forward_files(self._post_export_modules[n], files, processed_files)
+
+    def _forward_files(self, post_exporter, exported_files, processed_files):
+        if post_exporter.renamed_files and self._catalog_index:
+            self._catalog_index.rename(post_exporter.renamed_files)
+
+        return post_export.forward_files(post_exporter, exported_files, processed_files)
+
+    def _complete(self, item):
+        if item is None:
+            # Capture is waiting on a background exporter and completes later
+            return None
+
+        if item.catalog is not None:
+            self._catalog_index.add(item.capture_id, item.catalog[0], item.data['cap_timestamp'], item.catalog[1],
+                                    item.exports)
+
+        if item.checkpoint is not None:
+            self._checkpoint_journal.append(item.checkpoint)
+
+        return None
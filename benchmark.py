@@ -0,0 +1,254 @@
+#!/usr/bin/env python3
+# -- coding: utf-8 --
+
+import argparse
+import concurrent.futures
+import itertools
+import json
+import logging
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import time
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+import acquisition
+import capture
+import experiment
+import exporter
+import jtfadump2
+import post_export
+import util
+
+__author__ = 'chris'
+
+
+_EXPORTERS = {
+    'csv': lambda path: exporter.CSVExporter(path),
+    'mat': lambda path: exporter.MatfileExporter(path),
+    'summary': lambda path: exporter.SummaryTextExporter(path),
+    'sqlite': lambda path: exporter.SQLiteExporter(path)
+}
+
+_POST_EXPORTERS = {
+    'zip': lambda path, backup_path: post_export.ZipPostExporter(path),
+    'backup': lambda path, backup_path: post_export.BackupCopy(path, backup_path),
+    'backup_incremental': lambda path, backup_path: post_export.BackupCopy(path, backup_path, incremental=True),
+    'compress': lambda path, backup_path: post_export.CompressPostExporter(path),
+    'chunk_store': lambda path, backup_path: post_export.ChunkStoreBackup(path, backup_path)
+}
+
+
+def _create_instrument(index, spec):
+    # Instrument specs are <type>[:<latency>[:<points>]], serial and visa instruments share a bus per type
+    fields = spec.split(':')
+    kind = fields[0]
+    latency = float(fields[1]) if len(fields) > 1 else 0.0
+    points = int(fields[2]) if len(fields) > 2 else 1
+
+    label = "{}{}".format(kind, index)
+
+    if kind == 'random':
+        return capture.RandomCapture(label, length=points)
+    elif kind == 'null':
+        return capture.NullCapture(label)
+    elif kind == 'serial':
+        # 9600 baud line, a separate bus for each serial instrument
+        return capture.SimulatedCapture(label, latency=latency, baud=9600, points=points)
+    elif kind == 'visa':
+        return capture.SimulatedCapture(label, latency=latency, points=points)
+    elif kind == 'gpib':
+        # Instruments on a shared GPIB bus are serialised by their common connector
+        return capture.SimulatedCapture(label, latency=latency, points=points, bus='gpib')
+    else:
+        raise ValueError("Unknown instrument type {}".format(kind))
+
+
+def _create_tree(shape):
+    # Tree shape is a list of step counts from outer to inner experiment
+    node = None
+
+    for (depth, steps) in reversed(list(enumerate(shape))):
+        e = experiment.RegulatedTemperatureExperiment("level{}".format(depth), None, None, list(range(steps)))
+        node = jtfadump2.ExperimentNode(e, [node] if node else None)
+
+    return [node]
+
+
+def run_scenario(scenario):
+    result_path = tempfile.mkdtemp(prefix='jtfadump2-bench-')
+    backup_path = os.path.join(result_path, 'backup')
+    os.makedirs(backup_path)
+
+    try:
+        experiment_nodes = _create_tree(scenario['tree'])
+        capture_modules = [_create_instrument(n, spec) for (n, spec) in enumerate(scenario['instruments'])]
+        export_modules = [_EXPORTERS[name](result_path) for name in scenario['exporters']]
+        post_export_modules = [_POST_EXPORTERS[name](result_path, backup_path)
+                               for name in scenario['post_exporters']]
+
+        acquisition_loop = acquisition.Acquisition(experiment_nodes, capture_modules, [], export_modules,
+                                                   post_export_modules, pipeline_config=scenario['pipeline'],
+                                                   parallel_capture_config=scenario['parallel_capture'])
+
+        start_time = time.perf_counter()
+
+        try:
+            acquisition_loop.run()
+        finally:
+            acquisition_loop.stop()
+
+        elapsed = time.perf_counter() - start_time
+    finally:
+        shutil.rmtree(result_path, ignore_errors=True)
+
+    stages = acquisition_loop.get_metrics().summary()
+    captures = stages['capture_total']['count']
+
+    return {
+        'scenario': scenario,
+        'captures': captures,
+        'elapsed': elapsed,
+        'captures_per_second': captures / elapsed if elapsed > 0 else None,
+        'stages': stages,
+        # ru_maxrss is in kilobytes on Linux
+        'peak_rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss if resource else None
+    }
+
+
+def _scenario_name(scenario):
+    return "tree={} instruments={} export={} post_export={}{}{}".format(
+        'x'.join(str(x) for x in scenario['tree']), '+'.join(scenario['instruments']),
+        '+'.join(scenario['exporters']) or '-', '+'.join(scenario['post_exporters']) or '-',
+        ' pipeline' if scenario['pipeline'] is not None else '',
+        ' parallel' if scenario['parallel_capture'] is not None else '')
+
+
+def _run_isolated(scenario):
+    # Fresh process per scenario so peak RSS isn't inherited from earlier scenarios, unlike multiprocessing.Pool
+    # the worker isn't daemonic so post-exporters can start their own processes
+    with concurrent.futures.ProcessPoolExecutor(1) as pool:
+        return pool.submit(run_scenario, scenario).result()
+
+
+def _compare(results, baseline, threshold):
+    baseline_results = {r['name']: r for r in baseline['results']}
+    regression = False
+
+    for r in results:
+        if r['name'] not in baseline_results:
+            continue
+
+        old = baseline_results[r['name']]['captures_per_second']
+        new = r['captures_per_second']
+
+        if not old or not new:
+            continue
+
+        change = (new - old) / old
+
+        flag = ''
+
+        if change < -threshold:
+            flag = ' REGRESSION'
+            regression = True
+
+        print("{}: {:.1f} -> {:.1f} captures/s ({:+.1%}){}".format(r['name'], old, new, change, flag))
+
+    return regression
+
+
+def main():
+    parse = argparse.ArgumentParser(description='jtfadump2 acquisition loop benchmark')
+
+    parse.add_argument('--tree', help='Experiment tree step counts, outer to inner (e.g. 10x10)', nargs='+',
+                       default=['10x10'])
+    parse.add_argument('--instruments', help='Instrument sets, + separated <type>[:<latency>[:<points>]] where type '
+                                             'is random, null, serial, visa or gpib', nargs='+',
+                       default=['random', 'random+null', 'serial:0.005+visa:0.002+gpib:0.001'])
+    parse.add_argument('--exporters', help='Exporter combinations, + separated from csv, mat, summary, sqlite',
+                       nargs='+', default=['csv', 'csv+mat+summary'])
+    parse.add_argument('--post-exporters', help='Post-exporter combinations, + separated from zip, backup, '
+                                                'backup_incremental, compress, chunk_store',
+                       nargs='+', dest='post_exporters', default=['-'])
+    parse.add_argument('--pipeline', help='Also run each scenario in pipeline mode', action='store_true')
+    parse.set_defaults(pipeline=False)
+    parse.add_argument('--parallel', help='Also run each scenario with parallel capture', action='store_true')
+    parse.set_defaults(parallel=False)
+    parse.add_argument('-o', '--output', help='JSON result file', default=None)
+    parse.add_argument('--compare', help='Baseline JSON result file to compare against', default=None)
+    parse.add_argument('--threshold', help='Fractional slowdown reported as a regression', type=float, default=0.1)
+
+    args = parse.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+
+    def split(value):
+        return [] if value == '-' else value.split('+')
+
+    scenarios = []
+
+    for (tree, instruments, exporters, post_exporters, pipeline, parallel) in itertools.product(
+            args.tree, args.instruments, args.exporters, args.post_exporters,
+            [None, {}] if args.pipeline else [None], [None, {}] if args.parallel else [None]):
+        scenarios.append({
+            'tree': [int(x) for x in tree.split('x')],
+            'instruments': split(instruments),
+            'exporters': split(exporters),
+            'post_exporters': split(post_exporters),
+            'pipeline': pipeline,
+            'parallel_capture': parallel
+        })
+
+    results = []
+
+    for scenario in scenarios:
+        name = _scenario_name(scenario)
+
+        result = _run_isolated(scenario)
+        result['name'] = name
+
+        results.append(result)
+
+        print("{}\n\t{} captures in {:.3f} s, {:.1f} captures/s, peak RSS {} kB".format(
+            name, result['captures'], result['elapsed'], result['captures_per_second'], result['peak_rss_kb']))
+
+        for (stage, summary) in sorted(result['stages'].items()):
+            if summary['count']:
+                print("\t{}: p50 {:.3f} ms, p90 {:.3f} ms, p99 {:.3f} ms, max {:.3f} ms".format(
+                    stage, summary['p50'] * 1e3, summary['p90'] * 1e3, summary['p99'] * 1e3, summary['max'] * 1e3))
+
+    try:
+        git_hash = util.get_git_hash().decode() or 'not found'
+    except OSError:
+        git_hash = 'not found'
+
+    output = {
+        'version': jtfadump2.__version__,
+        'git_hash': git_hash,
+        'python': sys.version,
+        'platform': platform.platform(),
+        'time': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+        'results': results
+    }
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(output, f, indent=2, sort_keys=True)
+
+    if args.compare:
+        with open(args.compare, 'r') as f:
+            baseline = json.load(f)
+
+        if _compare(results, baseline, args.threshold):
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,7 +1,11 @@
+import concurrent.futures
+import contextlib
 import logging
 import random
 import threading
 import time
+
+import hardware
 import util
 
 __author__ = 'chris'
@@ -15,6 +19,7 @@ class Capture(object):
     def __init__(self, label, raw=False):
         self._label = label
         self._raw = raw
+        self._data_keys = {}
 
         self._log = logging.getLogger(type(self).__name__)
         self._log.debug("Created capture module {} ({})".format(type(self).__name__, self._label))
@@ -30,11 +35,18 @@ class Capture(object):
         data = self._get_data(experiment_stack)
 
         # Append label to keys in state
-        return {self._label + '_' + k: v for k, v in data.items()}
+        return util.prefix_keys(self._label, data, self._data_keys)
 
     def _get_data(self, experiment_stack):
         raise NotImplementedError()
 
+    def get_label(self):
+        return self._label
+
+    def get_connectors(self):
+        # Connectors used during capture, None if undeclared (never captured in parallel)
+        return None
+
     @staticmethod
     def _has_experiment_state(experiment_stack):
         for e in experiment_stack:
@@ -90,6 +102,9 @@ class NullCapture(Capture):
     def __init__(self, label, raw=False):
         super().__init__(label, raw)
 
+    def get_connectors(self):
+        return ()
+
     def _get_data(self, experiment_stack):
         return {}
 
@@ -100,6 +115,9 @@ class PulseCapture(Capture):
 
         self._channels = channel
 
+    def get_connectors(self):
+        return ()
+
     def _get_data(self, experiment_stack):
         return {
             'signal_time': [],
@@ -113,6 +131,9 @@ class RandomCapture(Capture):
 
         self._length = length
 
+    def get_connectors(self):
+        return ()
+
     def _get_data(self, experiment_stack):
         if self._raw:
             keys = []
@@ -134,6 +155,43 @@ class RandomCapture(Capture):
             }
 
 
+class SimulatedCapture(Capture):
+    # Connectors shared between modules configured with the same bus
+    _bus_connectors = {}
+
+    def __init__(self, label, raw=False, latency=0.0, jitter=0.0, baud=None, points=1, bus=None):
+        super().__init__(label, raw)
+
+        self._points = points
+
+        if bus is None:
+            self._connector = hardware.SimulatedConnector(label, latency, jitter, baud)
+        else:
+            if bus not in SimulatedCapture._bus_connectors:
+                SimulatedCapture._bus_connectors[bus] = hardware.SimulatedConnector(bus, latency, jitter, baud)
+
+            self._connector = SimulatedCapture._bus_connectors[bus]
+
+    def get_connectors(self):
+        return self._connector,
+
+    def _get_data(self, experiment_stack):
+        value = float(self._connector.query(b'MEAS?\n'))
+
+        if self._points > 1:
+            # Trace transfer sized like an 8 byte value per point
+            self._connector.read(self._points * 8)
+
+            return {
+                'value': value,
+                'trace': [value + random.random() for _ in range(self._points)]
+            }
+        else:
+            return {
+                'value': value
+            }
+
+
 class VNACapture(Capture):
     def __init__(self, label, raw=False):
         super().__init__(label, raw)
@@ -162,17 +220,114 @@ class ContinuousCaptureWrapper(Capture):
         self._stop.set()
         self._thread.join()
 
+    def get_connectors(self):
+        return self._wrapped_class.get_connectors()
+
     def _get_data(self, experiment_stack):
         with self._buffer_lock:
             out_buffer = self._buffer
 
             self._buffer = []
 
-            return out_buffer
+            return {
+                'buffer': out_buffer
+            }
 
     def _update(self):
         while not self._stop.is_set():
+            # Hold connector locks so background polling doesn't interleave with other captures
+            with _lock_connectors(self.get_connectors() or ()):
+                wrapped_data = self._wrapped_class.get_data([])
+
             with self._buffer_lock:
-                self._capture._get_data()
+                self._buffer.append(wrapped_data)
 
             time.sleep(self._interval)
+
+
+@contextlib.contextmanager
+def _lock_connectors(connectors):
+    with contextlib.ExitStack() as stack:
+        # Always acquire in the same order to avoid deadlock between threads
+        for connector in sorted(set(c.get_root() for c in connectors), key=id):
+            stack.enter_context(connector.get_lock())
+
+        yield
+
+
+class ParallelCaptureRunner(object):
+    """
+    Runs capture modules concurrently, serialising only modules that share a connector
+    """
+
+    def __init__(self, capture_modules, workers=None, histograms=None):
+        self._capture_modules = capture_modules
+        self._histograms = histograms
+
+        self._log = logging.getLogger(type(self).__name__)
+
+        # Group modules that share a physical connector, groups are run sequentially within a single worker
+        groups = []
+
+        for index, module in enumerate(self._capture_modules):
+            connectors = module.get_connectors()
+
+            if connectors is None:
+                raise CaptureException("Capture module {} ({}) does not declare its connectors and can't be captured "
+                                       "in parallel".format(type(module).__name__, module.get_label()))
+
+            roots = set(c.get_root() for c in connectors)
+            merged = ([index], roots)
+
+            for group in [g for g in groups if g[1] & roots]:
+                groups.remove(group)
+                merged = (sorted(merged[0] + group[0]), merged[1] | group[1])
+
+            groups.append(merged)
+
+        self._groups = sorted(groups, key=lambda g: g[0][0])
+
+        if workers is None:
+            workers = len(self._groups)
+
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=max(workers, 1))
+
+        for group in self._groups:
+            self._log.info("Capture group: {}".format(', '.join(type(self._capture_modules[i]).__name__
+                                                                for i in group[0])))
+
+        self._log.info("{} capture group{} on {} worker{}".format(len(self._groups),
+                                                                  's' if len(self._groups) != 1 else '',
+                                                                  workers, 's' if workers != 1 else ''))
+
+    def get_data(self, experiment_stack):
+        futures = [self._executor.submit(self._get_group_data, group, experiment_stack) for group in self._groups]
+
+        results = {}
+
+        for f in futures:
+            results.update(f.result())
+
+        # Merge in module order so overlapping keys resolve the same way as a sequential capture
+        data = {}
+
+        for index in range(len(self._capture_modules)):
+            data.update(results[index])
+
+        return data
+
+    def shutdown(self):
+        self._executor.shutdown(wait=True)
+
+    def _get_group_data(self, group, experiment_stack):
+        results = {}
+
+        with _lock_connectors(group[1]):
+            for index in group[0]:
+                start_time = time.perf_counter()
+                results[index] = self._capture_modules[index].get_data(experiment_stack)
+
+                if self._histograms:
+                    self._histograms[index].add(time.perf_counter() - start_time)
+
+        return results
@@ -0,0 +1,210 @@
+import json
+import logging
+import os
+import re
+import sqlite3
+import threading
+import time
+import urllib.request
+
+import util
+
+__author__ = 'chris'
+
+
+class CatalogException(Exception):
+    pass
+
+
+class CatalogIndex(object):
+    """
+    SQLite index of captures by experiment primary key with the files written for each capture
+    """
+
+    FILENAME = 'catalog.sqlite'
+
+    DEFAULT_COMMIT_RECORDS = 100
+    DEFAULT_COMMIT_INTERVAL = 5.0
+
+    # Indexed primary key fields, e.g. label_flow[0]
+    _INDEXED_FIELD = re.compile(r'^(.*)\[(\d+)\]$')
+
+    def __init__(self, result_directory, commit_records=None, commit_interval=None, read_only=False):
+        self._result_directory = result_directory
+        self._path = os.path.join(result_directory, self.FILENAME)
+
+        self._commit_records = commit_records if commit_records is not None else self.DEFAULT_COMMIT_RECORDS
+        self._commit_interval = commit_interval if commit_interval is not None else self.DEFAULT_COMMIT_INTERVAL
+
+        if read_only and not os.path.isfile(self._path):
+            raise CatalogException("No catalog in {}".format(result_directory))
+
+        # Captures may be added from a pipeline worker thread, access is serialised by the lock
+        if read_only:
+            # Opened without write access so a catalog can be queried while the run is still writing it
+            self._connection = sqlite3.connect("file:{}?mode=ro".format(
+                urllib.request.pathname2url(os.path.abspath(self._path))), uri=True, check_same_thread=False)
+        else:
+            self._connection = sqlite3.connect(self._path, check_same_thread=False)
+
+            # WAL lets read only catalogs query while the run is still writing
+            self._connection.execute('PRAGMA journal_mode=WAL')
+            self._connection.execute('PRAGMA synchronous=NORMAL')
+
+        self._lock = threading.Lock()
+
+        self._pending = 0
+        self._commit_time = time.time()
+
+        # Replacements for files renamed before their capture was added
+        self._renamed = {}
+
+        self._log = logging.getLogger(type(self).__name__)
+
+        with self._lock:
+            if not read_only:
+                self._connection.execute('CREATE TABLE IF NOT EXISTS capture (cap_id TEXT PRIMARY KEY, '
+                                         'cap_id_short TEXT, cap_index INTEGER, cap_timestamp REAL)')
+                self._connection.execute('CREATE TABLE IF NOT EXISTS file (cap_id TEXT, exporter TEXT, path TEXT)')
+                self._connection.execute('CREATE INDEX IF NOT EXISTS file_cap_id ON file (cap_id)')
+                self._connection.execute('CREATE INDEX IF NOT EXISTS file_path ON file (path)')
+                self._connection.commit()
+
+            self._columns = [row[1] for row in self._connection.execute('PRAGMA table_info(capture)')]
+
+    @classmethod
+    def open(cls, result_directory):
+        return cls(result_directory, read_only=True)
+
+    @classmethod
+    def get_key_values(cls, experiment_stack, data):
+        # Primary key values for the active experiments, resolving indexed fields
+        keys = {}
+
+        for e in experiment_stack:
+            field = e.get_primary_key_field()
+
+            if not field:
+                continue
+
+            match = cls._INDEXED_FIELD.match(field)
+
+            if field in data:
+                keys[field] = data[field]
+            elif match and match.group(1) in data:
+                keys[field] = data[match.group(1)][int(match.group(2))]
+
+        return keys
+
+    def add(self, capture_id, capture_index, timestamp, keys, exports):
+        with self._lock:
+            for field in keys:
+                if field not in self._columns:
+                    # New primary key field, extend the table and index it for lookups
+                    self._connection.execute("ALTER TABLE capture ADD COLUMN {}".format(util.sql_identifier(field)))
+                    self._connection.execute("CREATE INDEX IF NOT EXISTS {} ON capture ({})".format(
+                        util.sql_identifier('capture_' + field), util.sql_identifier(field)))
+                    self._columns.append(field)
+
+            fields = ['cap_id', 'cap_id_short', 'cap_index', 'cap_timestamp'] + list(keys)
+            values = [capture_id, capture_id[-8::], capture_index, timestamp] + \
+                [self._to_sql(v) for v in keys.values()]
+
+            self._connection.execute("INSERT OR REPLACE INTO capture ({}) VALUES ({})".format(
+                ', '.join(util.sql_identifier(f) for f in fields), ', '.join('?' * len(fields))), values)
+
+            self._connection.executemany('INSERT INTO file (cap_id, exporter, path) VALUES (?, ?, ?)',
+                                         [(capture_id, exporter_name, self._renamed.pop(path, path))
+                                          for (exporter_name, paths) in exports
+                                          for path in (self._relative_path(p) for p in paths)])
+
+            self._pending += 1
+
+            # Batch commits, each one costs a sync of the database file
+            if self._pending >= self._commit_records or time.time() - self._commit_time >= self._commit_interval:
+                self._commit()
+
+    def rename(self, renamed_files):
+        # Files replaced by a post-exporter, e.g. compressed, keep their captures
+        with self._lock:
+            for (path, new_path) in renamed_files:
+                (path, new_path) = (self._relative_path(path), self._relative_path(new_path))
+
+                if not self._connection.execute('UPDATE file SET path = ? WHERE path = ?',
+                                                (new_path, path)).rowcount:
+                    self._renamed[path] = new_path
+
+    def find(self, conditions=None, tolerance=None):
+        where = []
+        parameters = []
+
+        if conditions:
+            for (field, value) in conditions.items():
+                if field not in self._columns:
+                    raise CatalogException("Field {} not in catalog".format(field))
+
+                if tolerance is not None and type(value) in (int, float):
+                    where.append("{} BETWEEN ? AND ?".format(util.sql_identifier(field)))
+                    parameters.extend([value - tolerance, value + tolerance])
+                else:
+                    where.append("{} = ?".format(util.sql_identifier(field)))
+                    parameters.append(self._to_sql(value))
+
+        query = 'SELECT cap_id, cap_index, cap_timestamp FROM capture'
+
+        if where:
+            query += ' WHERE ' + ' AND '.join(where)
+
+        query += ' ORDER BY cap_index'
+
+        with self._lock:
+            captures = self._connection.execute(query, parameters).fetchall()
+
+            results = []
+
+            for (capture_id, capture_index, timestamp) in captures:
+                files = {}
+
+                for (exporter_name, path) in self._connection.execute(
+                        'SELECT exporter, path FROM file WHERE cap_id = ?', (capture_id,)):
+                    files.setdefault(exporter_name, []).append(os.path.join(self._result_directory, path))
+
+                results.append({
+                    'cap_id': capture_id,
+                    'cap_index': capture_index,
+                    'cap_timestamp': timestamp,
+                    'files': files
+                })
+
+        return results
+
+    def get_fields(self):
+        return list(self._columns)
+
+    def close(self):
+        with self._lock:
+            self._commit()
+            self._connection.close()
+
+    def _commit(self):
+        self._connection.commit()
+
+        self._pending = 0
+        self._commit_time = time.time()
+
+    def _relative_path(self, path):
+        path = os.path.realpath(path)
+
+        if path.startswith(os.path.realpath(self._result_directory) + os.sep):
+            return os.path.relpath(path, self._result_directory)
+
+        return path
+
+    @staticmethod
+    def _to_sql(value):
+        if value is None or type(value) in (int, float, str):
+            return value
+        elif type(value) is bool:
+            return int(value)
+        else:
+            return json.dumps(value, default=str)
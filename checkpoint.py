@@ -0,0 +1,81 @@
+import json
+import logging
+import os
+import time
+
+__author__ = 'chris'
+
+
+class CheckpointException(Exception):
+    pass
+
+
+class CheckpointJournal(object):
+    """
+    Append-only journal of experiment resume state, one JSON record per completed capture
+    """
+
+    FILENAME = 'checkpoint.journal'
+
+    DEFAULT_SYNC_RECORDS = 16
+    DEFAULT_SYNC_INTERVAL = 5.0
+
+    def __init__(self, result_directory, sync_records=None, sync_interval=None):
+        self._path = os.path.join(result_directory, self.FILENAME)
+
+        # Batch fsync calls, a crash loses at most the records since the last sync
+        self._sync_records = sync_records if sync_records is not None else self.DEFAULT_SYNC_RECORDS
+        self._sync_interval = sync_interval if sync_interval is not None else self.DEFAULT_SYNC_INTERVAL
+
+        self._file = open(self._path, 'a')
+        self._pending = 0
+        self._sync_time = time.time()
+
+        self._log = logging.getLogger(type(self).__name__)
+        self._log.info("Checkpoint journal {}".format(self._path))
+
+    def append(self, record):
+        self._file.write(json.dumps(record, separators=(',', ':')) + '\n')
+        self._pending += 1
+
+        if self._pending >= self._sync_records or time.time() - self._sync_time >= self._sync_interval:
+            self.sync()
+
+    def sync(self):
+        if self._file.closed:
+            return
+
+        self._file.flush()
+        os.fsync(self._file.fileno())
+
+        self._pending = 0
+        self._sync_time = time.time()
+
+    def close(self):
+        if self._file.closed:
+            return
+
+        self.sync()
+        self._file.close()
+
+    @classmethod
+    def load(cls, result_directory):
+        path = os.path.join(result_directory, cls.FILENAME)
+
+        if not os.path.isfile(path):
+            raise CheckpointException("No checkpoint journal in {}".format(result_directory))
+
+        record = None
+
+        with open(path, 'r') as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    # Last line may be incomplete if the process died mid-write
+                    logging.getLogger(cls.__name__).warning("Ignoring corrupt checkpoint record in {}".format(path))
+
+        if record is None:
+            raise CheckpointException("No completed captures recorded in {}".format(path))
+
+        return record
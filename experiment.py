@@ -3,8 +3,11 @@
 import code
 import datetime
 import logging
+import math
 import time
 
+import util
+
 __author__ = 'chris'
 
 
@@ -20,6 +23,7 @@ class Experiment(object):
     def __init__(self, label, primary=True):
         self._label = label
         self._primary = primary
+        self._state_keys = {}
 
         self._log = logging.getLogger(type(self).__name__)
         self._log.debug("Created Experiment module {} ({} primary key)".format(self._label,
@@ -37,6 +41,13 @@ class Experiment(object):
     def has_next(self):
         raise NotImplementedError()
 
+    def get_label(self):
+        return self._label
+
+    def get_step_delays(self):
+        # Expected delay in seconds for each step, used to plan an experiment without running it
+        raise NotImplementedError()
+
     def get_resume_state(self):
         raise NotImplementedError()
 
@@ -48,7 +59,7 @@ class Experiment(object):
         state = self._get_state()
 
         # Append label to keys in state
-        return {self._label + '_' + k: v for k, v in state.items()}
+        return util.prefix_keys(self._label, state, self._state_keys)
 
     def _get_state(self):
         raise NotImplementedError()
@@ -80,7 +91,16 @@ class Experiment(object):
 
 
 class _SteppedExperiment(Experiment):
-    def __init__(self, label, step_values, primary=True):
+    # Step ordering modes, serpentine and nearest alternate direction on each sweep so the first step of a sweep
+    # is next to the last step of the previous one. Ordering is chosen per experiment from its own step values, nested
+    # experiments are each ordered independently rather than as one path through the whole tree
+    ORDER_SERPENTINE = 'serpentine'
+    ORDER_NEAREST = 'nearest'
+    ORDER_RAMP = 'ramp'
+
+    ORDERS = (ORDER_SERPENTINE, ORDER_NEAREST, ORDER_RAMP)
+
+    def __init__(self, label, step_values, primary=True, order=None):
         super().__init__(label, primary)
 
         self._step_values = step_values
@@ -88,6 +108,18 @@ class _SteppedExperiment(Experiment):
         self._current_step = 0
         self._next_step = 0
 
+        if order is not None and order not in self.ORDERS:
+            raise ExperimentConfigurationException("Unknown step order {}".format(order))
+
+        self._order = order
+        self._reversed = False
+
+        # Indices into step values in the order they are run
+        self._step_order = self._generate_step_order()
+
+        if self._order is not None:
+            self._log.info("Step order ({}): {}".format(self._order, ', '.join(str(x) for x in self._step_order)))
+
     def step(self):
         if self._next_step > self._step_maximum():
             raise ExperimentException()
@@ -95,22 +127,32 @@ class _SteppedExperiment(Experiment):
         self._current_step = self._next_step
         self._next_step += 1
 
-        self._log.info("Step {} of {}".format(self._current_step + 1, self._step_maximum()))
+        self._log.info("Step {} of {} (value {})".format(self._current_step + 1, self._step_maximum(),
+                                                         self._get_step_value()))
 
     def reset(self):
         self._current_step = 0
         self._next_step = 0
 
+        if self._order in (self.ORDER_SERPENTINE, self.ORDER_NEAREST):
+            self._reversed = not self._reversed
+
         self._log.info('Steps reset')
 
     def has_next(self):
         return self._next_step < self._step_maximum()
 
+    def get_step_delays(self):
+        return [0] * self._step_maximum()
+
     def get_resume_state(self):
-        return self._current_step, self._next_step,
+        return self._current_step, self._next_step, self._reversed
 
     def set_resume_state(self, state):
-        self._current_step, self._next_step = state
+        self._current_step, self._next_step = state[:2]
+
+        if len(state) > 2:
+            self._reversed = state[2]
 
     def _get_state(self):
         return {
@@ -127,10 +169,50 @@ class _SteppedExperiment(Experiment):
             return 1
 
     def _get_step(self):
-        return self._current_step
+        # Index of the current value in the configured list, independent of step order
+        if self._step_order is None:
+            return self._current_step
+
+        if self._reversed:
+            return self._step_order[-1 - self._current_step]
+
+        return self._step_order[self._current_step]
 
     def _get_step_value(self):
-        return self._step_values[self._current_step]
+        if type(self._step_values) is not list:
+            return self._step_values
+
+        return self._step_values[self._get_step()]
+
+    def _generate_step_order(self):
+        if self._order is None or type(self._step_values) is not list:
+            return None
+
+        indices = list(range(len(self._step_values)))
+
+        if self._order == self.ORDER_RAMP:
+            return sorted(indices, key=lambda i: self._step_values[i])
+        elif self._order == self.ORDER_NEAREST:
+            # Greedy nearest neighbour path starting from the first configured value
+            order = [indices.pop(0)]
+
+            while indices:
+                last = self._step_values[order[-1]]
+                nearest = min(indices, key=lambda i: self._step_distance(last, self._step_values[i]))
+
+                indices.remove(nearest)
+                order.append(nearest)
+
+            return order
+        else:
+            return indices
+
+    @staticmethod
+    def _step_distance(a, b):
+        if type(a) in (list, tuple):
+            return math.sqrt(sum((x - y) ** 2 for (x, y) in zip(a, b)))
+        else:
+            return abs(a - b)
 
 
 class RepeatExperiment(Experiment):
@@ -149,6 +231,9 @@ class RepeatExperiment(Experiment):
     def has_next(self):
         return self._count < self._maximum
 
+    def get_step_delays(self):
+        return [0] * self._maximum
+
     def get_resume_state(self):
         return self._count, self._maximum
 
@@ -157,8 +242,8 @@ class RepeatExperiment(Experiment):
 
 
 class FlowExperiment(_SteppedExperiment):
-    def __init__(self, label, mfc_connector, mfc_flow_rate, primary=True):
-        super().__init__(label, mfc_flow_rate, primary)
+    def __init__(self, label, mfc_connector, mfc_flow_rate, primary=True, order=None):
+        super().__init__(label, mfc_flow_rate, primary, order)
 
         self._channels = len(mfc_flow_rate[0])
 
@@ -199,8 +284,9 @@ class FlowExperiment(_SteppedExperiment):
 
 
 class HumidityExperiment(_SteppedExperiment):
-    def __init__(self, label, vgen_connector, vgen_temperature, vgen_rtd_incline=None, vgen_rtd_intercept=None, primary=True):
-        super().__init__(label, vgen_temperature, primary)
+    def __init__(self, label, vgen_connector, vgen_temperature, vgen_rtd_incline=None, vgen_rtd_intercept=None,
+                 primary=True, order=None):
+        super().__init__(label, vgen_temperature, primary, order)
 
         self._log.info('Setup VGen humidity controller')
 
@@ -245,8 +331,9 @@ class HumidityExperiment(_SteppedExperiment):
 
 
 class RegulatedTemperatureExperiment(_SteppedExperiment):
-    def __init__(self, label, probe_connector, supply_connector, temperature, regulator=None, primary=True):
-        super().__init__(label, temperature, primary)
+    def __init__(self, label, probe_connector, supply_connector, temperature, regulator=None, primary=True,
+                 order=None):
+        super().__init__(label, temperature, primary, order)
 
         # Hardware setup
         self._regulator_probe_id = probe_connector
@@ -293,7 +380,7 @@ class RegulatedTemperatureExperiment(_SteppedExperiment):
 
 class TimeExperiment(_SteppedExperiment):
     def __init__(self, label, delay, primary=True):
-        super().__init__(label, primary)
+        super().__init__(label, delay, primary)
 
         self._delay = delay
 
@@ -311,8 +398,11 @@ class TimeExperiment(_SteppedExperiment):
     def get_resume_state(self):
         return (self._timer,) + super().get_resume_state()
 
+    def get_step_delays(self):
+        return [self._get_delay(step) for step in range(self._step_maximum())]
+
     def set_resume_state(self, state):
-        self._timer = state[:1]
+        self._timer = state[0]
 
         super().set_resume_state(state[1:])
 
@@ -330,9 +420,12 @@ class TimeExperiment(_SteppedExperiment):
     def _primary_key_field(self):
         return None
 
-    def _get_delay(self):
+    def _get_delay(self, step=None):
+        if step is None:
+            step = self._get_step()
+
         if type(self._delay) is list:
-            return self._delay[self._get_step()]
+            return self._delay[step]
         else:
             return self._delay
 
@@ -418,14 +511,17 @@ class SynchronisedTimeExperiment(TimeExperiment):
         return (self._first,) + super().get_resume_state()
 
     def set_resume_state(self, state):
-        self._first = state[:1]
+        self._first = state[0]
 
         super().set_resume_state(state[1:])
 
     def _get_state(self):
-        return {
+        state = super()._get_state()
+        state.update({
             'sync_lag': time.time() - self._timer
-        }.update(super()._get_state())
+        })
+
+        return state
 
     def _primary_key_field(self):
         return None
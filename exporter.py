@@ -1,11 +1,22 @@
+import bisect
 import collections
 import data
+import fnmatch
+import json
 import logging
 import os
+import re
+import sqlite3
+import threading
 import time
 
+import numpy as np
 import scipy.io as sio
 
+import pipeline
+import record
+import util
+
 __author__ = 'chris'
 
 
@@ -16,6 +27,12 @@ class Exporter(object):
 
     _file_date_format = '%Y%m%d%H%M%S'
 
+    # Deferred exporters write on another thread, export returns None and files are reported by pop_completed
+    DEFERRED = False
+
+    # Characters allowed when a field name becomes part of a file name
+    _UNSAFE_CHARACTERS = re.compile(r'[^A-Za-z0-9_.\-]')
+
     def __init__(self, type_prefix, type_extension, result_directory, export_prefix=None,
                  file_date_format=None):
         self._type_prefix = type_prefix
@@ -56,41 +73,485 @@ class Exporter(object):
     def export(self, identifier, export_data):
         raise NotImplementedError()
 
+    def close(self):
+        # Flush buffered output at shutdown, returns any files written by closing
+        return None
+
+    def pop_completed(self):
+        # (identifier, files) for each capture written since the last call, files is None if it was dropped
+        return ()
+
+    @staticmethod
+    def _to_json(value):
+        # JSON encoder fallback for numpy scalars and arrays
+        if hasattr(value, 'tolist'):
+            return value.tolist()
+
+        return str(value)
+
 
 class _DelimitedTextExporter(Exporter):
+    SEGMENT_MANIFEST_SUFFIX = '-segments.json'
+
     def __init__(self, type_prefix, type_extension, result_directory, text_header, text_delimiter,
-                 line_separator=None, **kwargs):
+                 line_separator=None, flush_rows=1, flush_interval=None, durable=False, buffer_size=None,
+                 float_format=None, flatten_limit=16, missing='', sidecar_threshold=1024, rotate_bytes=None,
+                 rotate_rows=None, rotate_interval=None, state_fields=None, **kwargs):
         super().__init__(type_prefix, type_extension, result_directory, **kwargs)
 
         self._text_header = text_header
         self._text_delimiter = text_delimiter
         self._line_separator = line_separator if line_separator else '\n'
 
-        # Single files is used for all writes, generate the file name at startup
-        self._file_name = self._generate_name(None)
+        # Quote cells so the file can be read back with a CSV parser
+        self._quote_pattern = re.compile(r'[{}"\r\n]|^\s'.format(re.escape(text_delimiter.strip() or text_delimiter)))
+
+        # Flush every flush_rows rows and/or flush_interval seconds, fsync on flush if durable
+        self._flush_rows = flush_rows
+        self._flush_interval = flush_interval
+        self._durable = durable
+        self._buffer_size = buffer_size if buffer_size else -1
+
+        self._file = None
+        self._pending_rows = 0
+        self._flush_time = time.time()
+
+        # Single file is used for all writes, generate the file name at startup
+        self._base_name = self._generate_name(None)
+
+        # Rotate to a new numbered segment on rotate_bytes, rotate_rows or rotate_interval
+        self._rotate_bytes = rotate_bytes
+        self._rotate_rows = rotate_rows
+        self._rotate_interval = rotate_interval
+        self._rotating = rotate_bytes is not None or rotate_rows is not None or rotate_interval is not None
+
+        self._rows = 0
+        self._segment = 0
+        self._segments = []
+
+        if self._rotating:
+            self._file_name = self._segment_name(self._segment)
+            self._segment_manifest = os.path.splitext(self._base_name)[0] + self.SEGMENT_MANIFEST_SUFFIX
+        else:
+            self._file_name = self._base_name
+            self._segment_manifest = None
 
         # Check for existing file
         if os.path.isfile(self._file_name):
             raise FileExistsError()
 
+        # Row encoder is compiled from the first capture, columns stay fixed for the rest of the run
+        self._float_format = float_format
+        self._flatten_limit = flatten_limit
+        self._missing = missing
+        self._encoder = None
+        self._header = None
         self._fields = None
-        self._header_written = False
+        self._checked_keys = None
+        self._ignored = set()
+
+        # Arrays with at least sidecar_threshold values are written to a binary sidecar file per field
+        self._sidecar_threshold = sidecar_threshold
+
+        # Fields matching state_fields are written to a companion file only when they change
+        if state_fields is not None and type(state_fields) is not list:
+            state_fields = [state_fields]
+
+        self._state_patterns = state_fields
+        self._state_fields = []
+        self._state_file = None
+        self._index_column = False
+        self._index = None
+
+        self._start_segment()
 
     def export(self, identifier, export_data):
-        fields = export_data.keys()
-        values = export_data.values()
+        if self._encoder is None:
+            self._compile_encoder(export_data)
 
-        with open(self._file_name, 'a') as f:
-            if self._text_header is not None and not self._header_written:
-                f.write(self._text_header + self._text_delimiter.join(fields) + self._line_separator)
+        closed_files = ()
 
-                self._header_written = True
+        if self._segment_rows and self._rotating and self._is_rotation_due():
+            closed_files = self._rotate_segment()
 
-            f.write(self._text_delimiter.join(str(x) for x in values) + self._line_separator)
+        if self._file is None:
+            self._file = open(self._file_name, 'a', buffering=self._buffer_size)
+
+        if self._text_header is not None and not self._header_written:
+            header = self._text_header + self._text_delimiter.join([self._quote(h) for h in self._header]) + \
+                self._line_separator
+            self._file.write(header)
+            self._segment_bytes += len(header)
+
+            self._header_written = True
+
+        self._index = export_data.get(StateReader.INDEX_FIELD, self._rows + 1)
+
+        line = self._encode(export_data)
+        self._file.write(line)
+        self._segment_bytes += len(line)
+
+        self._pending_rows += 1
+        self._segment_rows += 1
+        self._rows += 1
+
+        if self._rotating:
+            self._update_segment(identifier)
+
+        if (self._flush_rows and self._pending_rows >= self._flush_rows) or \
+                (self._flush_interval is not None and time.time() - self._flush_time >= self._flush_interval):
+            self.flush()
 
         self._log.debug("Appended to {}".format(self._file_name))
 
-        return self._file_name,
+        if closed_files:
+            # Final contents of the previous segment haven't been post-exported yet
+            return tuple(collections.OrderedDict.fromkeys(closed_files + self._files))
+
+        return self._files
+
+    def flush(self):
+        if self._file is None:
+            return
+
+        # Sidecar and state data first so rows never reference values that aren't on disk yet
+        for handle in [s['handle'] for s in self._sidecars.values()] + \
+                ([self._state_file] if self._state_file is not None else []):
+            handle.flush()
+
+            if self._durable:
+                os.fsync(handle.fileno())
+
+        self._file.flush()
+
+        if self._durable:
+            os.fsync(self._file.fileno())
+
+        self._pending_rows = 0
+        self._flush_time = time.time()
+
+    def close(self):
+        if self._file is None:
+            return None
+
+        self.flush()
+        self._file.close()
+        self._file = None
+
+        for sidecar in self._sidecars.values():
+            sidecar['handle'].close()
+
+        if self._state_file is not None:
+            self._state_file.close()
+            self._state_file = None
+
+        if self._segments:
+            self._segments[-1]['complete'] = True
+            self._write_segment_manifest()
+
+        self._log.debug("Closed {}".format(self._file_name))
+
+        return self._files
+
+    def _segment_name(self, segment):
+        (root, extension) = os.path.splitext(self._base_name)
+
+        return "{}{}{:04d}{}".format(root, self._FILE_DELIMITER, segment, extension)
+
+    def _start_segment(self):
+        self._header_written = False
+
+        self._segment_rows = 0
+        self._segment_bytes = 0
+        self._segment_time = time.time()
+
+        # Sidecars and state belong to a segment so they rotate with it, each segment starts with the full state
+        self._sidecar_manifest = os.path.splitext(self._file_name)[0] + SidecarReader.MANIFEST_SUFFIX
+        self._sidecars = collections.OrderedDict()
+
+        self._state_name = os.path.splitext(self._file_name)[0] + StateReader.SUFFIX
+        self._state = {}
+
+        self._update_files()
+
+    def _update_files(self):
+        # Only the current segment and its sidecars are reported, so downstream steps don't touch older segments
+        files = [self._file_name]
+
+        if self._sidecars:
+            files.append(self._sidecar_manifest)
+            files.extend(os.path.join(os.path.dirname(self._file_name), s['file']) for s in self._sidecars.values())
+
+        if self._state_fields:
+            files.append(self._state_name)
+
+        if self._segment_manifest:
+            files.append(self._segment_manifest)
+
+        self._files = tuple(files)
+
+    def _is_rotation_due(self):
+        return (self._rotate_rows is not None and self._segment_rows >= self._rotate_rows) or \
+            (self._rotate_bytes is not None and self._segment_bytes >= self._rotate_bytes) or \
+            (self._rotate_interval is not None and time.time() - self._segment_time >= self._rotate_interval)
+
+    def _rotate_segment(self):
+        closed_files = self.close()
+
+        self._segment += 1
+        self._file_name = self._segment_name(self._segment)
+
+        if os.path.isfile(self._file_name):
+            raise FileExistsError()
+
+        self._start_segment()
+
+        self._log.info("Rotated to segment {}".format(self._file_name))
+
+        return closed_files
+
+    def _update_segment(self, identifier):
+        if self._segment_rows == 1:
+            self._segments.append(collections.OrderedDict([
+                ('file', os.path.basename(self._file_name)),
+                ('first_cap_index', self._index),
+                ('first_capture', identifier),
+                ('start_time', self._segment_time),
+                ('rows', 0),
+                ('last_cap_index', None),
+                ('last_capture', None),
+                ('complete', False)
+            ]))
+
+            # Make the new segment visible straight away, row counts are filled in when it's closed
+            self._write_segment_manifest()
+
+        segment = self._segments[-1]
+        segment['rows'] = self._segment_rows
+        segment['last_cap_index'] = self._index
+        segment['last_capture'] = identifier
+
+    def _write_segment_manifest(self):
+        manifest = collections.OrderedDict([
+            ('rows', self._rows),
+            ('segments', self._segments)
+        ])
+
+        util.write_json(self._segment_manifest, manifest, indent=2)
+
+    def _compile_encoder(self, export_data):
+        # (field, width, formatter), width is None for scalar fields
+        self._encoder = []
+        self._header = []
+
+        for (field, value) in export_data.items():
+            if field != StateReader.INDEX_FIELD and self._state_patterns and \
+                    any(fnmatch.fnmatchcase(field, p) for p in self._state_patterns):
+                self._state_fields.append(field)
+                continue
+
+            if self._is_sequence(value) and 0 < len(value) <= self._flatten_limit:
+                width = len(value)
+                formatter = self._get_formatter(value[0])
+
+                self._header.extend("{}[{}]".format(field, n) for n in range(width))
+            elif self._sidecar_threshold is not None and self._is_array(value):
+                width = None
+                formatter = self._get_sidecar_formatter(field)
+
+                self._header.append(field)
+            else:
+                width = None
+                formatter = self._get_formatter(value)
+
+                self._header.append(field)
+
+            self._encoder.append((field, width, formatter))
+
+        self._fields = frozenset([f for (f, _, _) in self._encoder] + self._state_fields)
+
+        if self._state_fields:
+            if StateReader.INDEX_FIELD not in self._fields:
+                self._index_column = True
+                self._header.insert(0, StateReader.INDEX_FIELD)
+
+            self._update_files()
+
+    def _get_formatter(self, value):
+        if self._float_format is not None and isinstance(value, float):
+            float_format = self._float_format.format
+
+            def format_float(x):
+                # Column may still receive other types, format those generically
+                return float_format(x) if isinstance(x, float) else str(x)
+
+            return format_float
+
+        return str
+
+    def _get_sidecar_formatter(self, field):
+        def format_sidecar(x):
+            reference = self._write_sidecar(field, x)
+
+            # Small or non-numeric values are still written inline
+            return reference if reference is not None else self._to_str(x)
+
+        return format_sidecar
+
+    def _write_sidecar(self, field, value):
+        if not self._is_array(value):
+            return None
+
+        array = np.asarray(value)
+
+        if array.size < self._sidecar_threshold or array.dtype.kind not in 'biufc':
+            return None
+
+        sidecar = self._sidecars.get(field)
+
+        if sidecar is None:
+            sidecar = self._add_sidecar(field, array.dtype, array.shape[1:])
+        elif (array.dtype != sidecar['dtype'] and not np.can_cast(array.dtype, sidecar['dtype'], 'same_kind')) or \
+                array.shape[1:] != sidecar['shape']:
+            if field not in self._ignored:
+                self._ignored.add(field)
+                self._log.warning("Field {} no longer matches sidecar type {} and shape {}, writing inline".format(
+                    field, sidecar['dtype'].str, ('*',) + sidecar['shape']))
+
+            return None
+
+        # Write straight from the array buffer, no copy if it already has the sidecar type and layout
+        array = np.ascontiguousarray(array, dtype=sidecar['dtype'])
+        sidecar['handle'].write(memoryview(array).cast('B'))
+        self._segment_bytes += array.nbytes
+
+        start = sidecar['count']
+        sidecar['count'] += array.size
+
+        return SidecarReader.REFERENCE_FORMAT.format(file=sidecar['file'], start=start, stop=sidecar['count'])
+
+    def _add_sidecar(self, field, dtype, shape):
+        base_name = os.path.splitext(os.path.basename(self._file_name))[0]
+        file_name = "{}-{}".format(base_name, self._UNSAFE_CHARACTERS.sub('_', field))
+
+        while any(s['file'] == file_name + '.bin' for s in self._sidecars.values()):
+            file_name += '_'
+
+        path = os.path.join(os.path.dirname(self._file_name), file_name + '.bin')
+
+        # Arrays are stacked along their first dimension, the remaining dimensions are fixed by the first value
+        sidecar = {
+            'file': file_name + '.bin',
+            'dtype': dtype,
+            'shape': shape,
+            'count': 0,
+            'handle': open(path, 'ab')
+        }
+
+        self._sidecars[field] = sidecar
+        self._update_files()
+
+        manifest = collections.OrderedDict((f, {
+            'file': s['file'],
+            'dtype': s['dtype'].str,
+            'shape': list(s['shape'])
+        }) for (f, s) in self._sidecars.items())
+
+        util.write_json(self._sidecar_manifest, manifest, indent=2)
+
+        self._log.info("Writing field {} to sidecar {}".format(field, sidecar['file']))
+
+        return sidecar
+
+    def _encode(self, export_data):
+        missing = self._missing
+        cells = []
+
+        if self._state_fields:
+            if self._index_column:
+                cells.append(str(self._index))
+
+            self._encode_state(export_data)
+
+        for (field, width, formatter) in self._encoder:
+            if field not in export_data:
+                cells.extend([missing] * (width if width is not None else 1))
+                continue
+
+            value = export_data[field]
+
+            if width is None:
+                cells.append(formatter(value))
+            elif self._is_sequence(value) and len(value) == width:
+                cells.extend([formatter(x) for x in value])
+            else:
+                # Length differs from the first capture, keep the whole value in the first column
+                if field not in self._ignored:
+                    self._ignored.add(field)
+                    self._log.warning("Field {} no longer has {} values, writing in column {}[0]".format(
+                        field, width, field))
+
+                cells.append(self._to_str(value))
+                cells.extend([missing] * (width - 1))
+
+        # Records share their schema's field tuple, so only check for new fields when the schema changes
+        keys = export_data.schema.fields if isinstance(export_data, record.Record) else export_data.keys()
+
+        if keys is not self._checked_keys:
+            if type(keys) is tuple:
+                self._checked_keys = keys
+
+            for field in keys:
+                if field not in self._fields and field not in self._ignored:
+                    self._ignored.add(field)
+                    self._log.warning("Field {} not in header, ignoring".format(field))
+
+        return self._text_delimiter.join([self._quote(c) for c in cells]) + self._line_separator
+
+    def _quote(self, cell):
+        if self._quote_pattern.search(cell):
+            return '"' + cell.replace('"', '""') + '"'
+
+        return cell
+
+    def _encode_state(self, export_data):
+        changes = collections.OrderedDict()
+
+        for field in self._state_fields:
+            value = export_data.get(field)
+
+            if field not in self._state or not self._is_equal(self._state[field], value):
+                self._state[field] = value
+                changes[field] = value
+
+        if not changes:
+            return
+
+        if self._state_file is None:
+            self._state_file = open(self._state_name, 'a', buffering=self._buffer_size)
+
+        self._state_file.write(json.dumps({StateReader.INDEX_FIELD: self._index, 'state': changes},
+                                          default=self._to_json) + '\n')
+
+    @staticmethod
+    def _to_str(value):
+        # Arrays as nested lists, numpy abbreviates large arrays and wraps lines
+        return str(value.tolist() if isinstance(value, np.ndarray) else value)
+
+    @staticmethod
+    def _is_equal(a, b):
+        if isinstance(a, np.ndarray) or isinstance(b, np.ndarray):
+            return np.array_equal(a, b)
+
+        return type(a) is type(b) and a == b
+
+    @staticmethod
+    def _is_sequence(value):
+        return type(value) in (list, tuple) or (isinstance(value, np.ndarray) and value.ndim == 1)
+
+    @staticmethod
+    def _is_array(value):
+        return type(value) in (list, tuple) or isinstance(value, np.ndarray)
 
 
 class CSVExporter(_DelimitedTextExporter):
@@ -103,19 +564,645 @@ class CSVExporter(_DelimitedTextExporter):
 class MatfileExporter(Exporter):
     EXTENSION = 'mat'
 
-    def __init__(self, result_directory, compress=True, **kwargs):
+    def __init__(self, result_directory, compress=False, aggregate=None, aggregate_interval=None,
+                 aggregate_memory=None, **kwargs):
         super().__init__('matfile', self.EXTENSION, result_directory, **kwargs)
 
         self._compress = compress
 
+        # Write one file every aggregate captures, aggregate_interval seconds or aggregate_memory bytes
+        self._aggregate = aggregate
+        self._aggregate_interval = aggregate_interval
+        self._aggregate_memory = aggregate_memory
+
+        self._buffer = []
+        self._buffer_identifier = None
+        self._buffer_size = 0
+        self._buffer_time = time.time()
+
     def export(self, identifier, export_data):
-        filename = self._generate_name(identifier)
+        if not (self._aggregate or self._aggregate_interval or self._aggregate_memory):
+            filename = self._generate_name(identifier)
+
+            sio.savemat(filename, export_data, do_compression=self._compress)
+
+            self._log.debug("Wrote to {}".format(filename))
+
+            return filename,
+
+        if not self._buffer:
+            self._buffer_identifier = identifier
+            self._buffer_time = time.time()
+
+        # Copy so buffered captures don't hold references to the caller's data structures
+        capture_data = dict(export_data)
+
+        self._buffer.append(capture_data)
+        self._buffer_size += sum(self._estimate_size(v) for v in capture_data.values())
+
+        if (self._aggregate and len(self._buffer) >= self._aggregate) or \
+                (self._aggregate_interval and time.time() - self._buffer_time >= self._aggregate_interval) or \
+                (self._aggregate_memory and self._buffer_size >= self._aggregate_memory):
+            return self._write_aggregate(),
+
+        return None
+
+    def close(self):
+        if self._buffer:
+            return self._write_aggregate(),
+
+        return None
+
+    def _write_aggregate(self):
+        filename = self._generate_name(self._buffer_identifier)
+
+        # Preserve first-seen field order across all buffered captures
+        fields = collections.OrderedDict()
+
+        for capture_data in self._buffer:
+            for key in capture_data:
+                fields[key] = None
+
+        export_data = {key: self._stack([c.get(key) for c in self._buffer]) for key in fields}
 
         sio.savemat(filename, export_data, do_compression=self._compress)
 
-        self._log.debug("Wrote to {}".format(filename))
+        self._log.debug("Wrote {} captures to {}".format(len(self._buffer), filename))
 
-        return filename,
+        self._buffer = []
+        self._buffer_size = 0
+
+        return filename
+
+    @staticmethod
+    def _stack(values):
+        # Stack scalars and equal shaped arrays, anything else becomes a cell array
+        try:
+            arrays = [np.asarray(v) for v in values]
+        except (TypeError, ValueError):
+            arrays = None
+
+        if arrays and all(a.dtype.kind in 'biuf' for a in arrays) and \
+                all(a.shape == arrays[0].shape for a in arrays):
+            return np.stack(arrays)
+
+        cell = np.empty(len(values), dtype=object)
+
+        for (i, v) in enumerate(values):
+            cell[i] = v if v is not None else np.zeros((0, 0))
+
+        return cell
+
+    @staticmethod
+    def _estimate_size(value):
+        try:
+            return np.asarray(value).nbytes
+        except (TypeError, ValueError):
+            return len(str(value))
+
+
+class ColumnarExporter(Exporter):
+    """
+    Appends numeric fields to per-column memory-mapped files, growing each file in chunks
+    """
+
+    EXTENSION = 'col'
+    MANIFEST = 'columns.json'
+
+    def __init__(self, result_directory, field=None, chunk_rows=4096, sync_rows=256, **kwargs):
+        super().__init__('columnar', self.EXTENSION, result_directory, **kwargs)
+
+        self._field_filter = data.generate_data_field_list(field)
+        self._chunk_rows = chunk_rows
+        self._sync_rows = sync_rows
+
+        # Run is stored as a directory of raw column files and a manifest describing them
+        self._directory = self._generate_name(None)
+        os.makedirs(self._directory, exist_ok=False)
+
+        self._columns = collections.OrderedDict()
+        self._skipped = set()
+        self._rows = 0
+        self._capacity = 0
+
+    def export(self, identifier, export_data):
+        values = self._get_values(export_data)
+
+        # Columns are fixed by the first capture, fields that appear later are ignored
+        if not self._columns:
+            for (name, value) in values.items():
+                self._add_column(name, value)
+
+        if self._rows >= self._capacity:
+            self._grow()
+
+        for (name, column) in self._columns.items():
+            value = values.get(name)
+
+            try:
+                column['map'][self._rows] = value if value is not None else column['fill']
+            except (TypeError, ValueError):
+                # Shape or type differs from the first capture
+                column['map'][self._rows] = column['fill']
+
+                if name not in self._skipped:
+                    self._skipped.add(name)
+                    self._log.warning("Field {} doesn't match its column, filling".format(name))
+
+        self._rows += 1
+
+        if self._rows % self._sync_rows == 0:
+            for column in self._columns.values():
+                column['map'].flush()
+
+            self._write_manifest()
+
+            # Files are only reported once the manifest covers the rows written to them
+            return self._get_files()
+
+        return None
+
+    def close(self):
+        if not self._columns:
+            return None
+
+        # Trim preallocated space so files hold exactly the captured rows
+        for column in self._columns.values():
+            column['map'].flush()
+            column['map'] = None
+
+            with open(os.path.join(self._directory, column['file']), 'r+b') as f:
+                f.truncate(self._rows * column['row_size'])
+
+        self._capacity = 0
+
+        self._write_manifest()
+
+        self._log.info("Wrote {} rows to {}".format(self._rows, self._directory))
+
+        return self._get_files()
+
+    def _get_files(self):
+        return (os.path.join(self._directory, self.MANIFEST),) + \
+            tuple(os.path.join(self._directory, c['file']) for c in self._columns.values())
+
+    def _get_values(self, export_data):
+        if self._field_filter:
+            return collections.OrderedDict((self._field_name(f), f.get_value(export_data))
+                                           for f in self._field_filter if f.in_dict(export_data))
+        else:
+            return export_data
+
+    @staticmethod
+    def _field_name(field):
+        return field.name if field.index is None else "{}[{}]".format(field.name, field.index)
+
+    def _add_column(self, name, value):
+        try:
+            array = np.asarray(value)
+        except (TypeError, ValueError):
+            array = None
+
+        if array is None or array.dtype.kind not in 'biuf':
+            self._log.debug("Skipping non-numeric field {}".format(name))
+            return
+
+        dtype = np.dtype('float64') if array.dtype.kind == 'f' else \
+            np.dtype('bool') if array.dtype.kind == 'b' else np.dtype('int64')
+
+        file_name = self._UNSAFE_CHARACTERS.sub('_', name)
+
+        while any(c['file'] == file_name + '.bin' for c in self._columns.values()):
+            file_name += '_'
+
+        self._columns[name] = {
+            'file': file_name + '.bin',
+            'dtype': dtype.str,
+            'shape': list(array.shape),
+            'row_size': dtype.itemsize * int(np.prod(array.shape, dtype=np.int64)),
+            'fill': np.nan if dtype.kind == 'f' else 0,
+            'map': None
+        }
+
+    def _grow(self):
+        self._capacity += self._chunk_rows
+
+        for column in self._columns.values():
+            path = os.path.join(self._directory, column['file'])
+
+            if column['map'] is not None:
+                column['map'].flush()
+                column['map'] = None
+
+            # Extending the file is cheap, remapping avoids copying existing rows
+            with open(path, 'ab') as f:
+                f.truncate(self._capacity * column['row_size'])
+
+            column['map'] = np.memmap(path, dtype=np.dtype(column['dtype']), mode='r+',
+                                      shape=tuple([self._capacity] + column['shape']))
+
+    def _write_manifest(self):
+        manifest = {
+            'rows': self._rows,
+            'columns': collections.OrderedDict((name, {
+                'file': c['file'],
+                'dtype': c['dtype'],
+                'shape': c['shape']
+            }) for (name, c) in self._columns.items())
+        }
+
+        # Readers use the row count to ignore preallocated space
+        util.write_json(os.path.join(self._directory, self.MANIFEST), manifest, indent=2)
+
+
+class ColumnarReader(object):
+    """
+    Zero-copy read access to a run written by ColumnarExporter
+    """
+
+    def __init__(self, path):
+        self._path = path
+
+        with open(os.path.join(path, ColumnarExporter.MANIFEST), 'r') as f:
+            self._manifest = json.load(f, object_pairs_hook=collections.OrderedDict)
+
+        self.rows = self._manifest['rows']
+
+    def columns(self):
+        return list(self._manifest['columns'].keys())
+
+    def __getitem__(self, name):
+        column = self._manifest['columns'][name]
+        dtype = np.dtype(column['dtype'])
+
+        if self.rows == 0:
+            return np.zeros([0] + column['shape'], dtype=dtype)
+
+        return np.memmap(os.path.join(self._path, column['file']), dtype=dtype, mode='r',
+                         shape=tuple([self.rows] + column['shape']))
+
+    def to_dict(self):
+        return collections.OrderedDict((name, self[name]) for name in self.columns())
+
+
+class SQLiteExporter(Exporter):
+    """
+    Inserts captures as rows of an SQLite database in WAL mode, committing in batches
+    """
+
+    EXTENSION = 'sqlite'
+
+    TABLE = 'capture'
+    COLUMN_TABLE = 'capture_column'
+
+    KIND_INTEGER = 'integer'
+    KIND_REAL = 'real'
+    KIND_TEXT = 'text'
+    KIND_JSON = 'json'
+    KIND_ARRAY = 'array'
+
+    _COLUMN_TYPES = {
+        KIND_INTEGER: 'INTEGER',
+        KIND_REAL: 'REAL',
+        KIND_TEXT: 'TEXT',
+        KIND_JSON: 'TEXT',
+        KIND_ARRAY: 'BLOB'
+    }
+
+    # Primary key, taken from the capture's cap_index or counted here for data without one
+    INDEX_FIELD = 'cap_index'
+
+    DEFAULT_COMMIT_ROWS = 100
+    DEFAULT_COMMIT_INTERVAL = 5.0
+
+    def __init__(self, result_directory, commit_rows=None, commit_interval=None, **kwargs):
+        super().__init__('sqlite', self.EXTENSION, result_directory, **kwargs)
+
+        self._commit_rows = commit_rows if commit_rows is not None else self.DEFAULT_COMMIT_ROWS
+        self._commit_interval = commit_interval if commit_interval is not None else self.DEFAULT_COMMIT_INTERVAL
+
+        self._file_name = self._generate_name(None)
+
+        if os.path.isfile(self._file_name):
+            raise FileExistsError()
+
+        # May be driven from a background writer thread, only one thread uses the connection at a time
+        self._connection = sqlite3.connect(self._file_name, check_same_thread=False)
+
+        # WAL lets analysis read the database while captures are still being written
+        self._connection.execute('PRAGMA journal_mode=WAL')
+        self._connection.execute('PRAGMA synchronous=NORMAL')
+
+        # Capture table is created with the first capture's fields, see _add_columns
+        self._connection.execute("CREATE TABLE {} (name TEXT PRIMARY KEY, kind TEXT, dtype TEXT, shape TEXT)".format(
+            util.sql_identifier(self.COLUMN_TABLE)))
+        self._connection.commit()
+        self._connection.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+
+        # Converter for each column, chosen from the first value written to it
+        self._columns = collections.OrderedDict()
+        self._checked_keys = None
+        self._insert = None
+
+        self._rows = 0
+        self._pending = 0
+        self._commit_time = time.time()
+
+    def export(self, identifier, export_data):
+        keys = export_data.keys()
+
+        # Records share their schema's field tuple, so only look for new fields when the schema changes
+        if keys is not self._checked_keys:
+            if type(keys) is tuple:
+                self._checked_keys = keys
+
+            fields = [field for field in keys if field not in self._columns and field != self.INDEX_FIELD]
+
+            if fields or self._insert is None:
+                self._add_columns(fields, export_data)
+
+        values = [export_data.get(self.INDEX_FIELD, self._rows + 1)] + \
+            [convert(export_data[field]) if field in export_data else None
+             for (field, convert) in self._columns.items()]
+
+        self._connection.execute(self._insert, values)
+
+        self._rows += 1
+        self._pending += 1
+
+        if self._pending >= self._commit_rows or time.time() - self._commit_time >= self._commit_interval:
+            self._commit()
+
+            # Database file only changes on commit, report it then so copies are never behind
+            return self._file_name,
+
+        return None
+
+    def close(self):
+        if self._connection is None:
+            return None
+
+        if self._insert is None:
+            # Nothing captured, still leave an empty table for readers
+            self._add_columns([], {})
+
+        self._commit()
+        self._connection.close()
+        self._connection = None
+
+        self._log.info("Wrote {} rows to {}".format(self._rows, self._file_name))
+
+        return self._file_name,
+
+    def _commit(self):
+        self._connection.commit()
+
+        # Fold the write-ahead log back into the database so a copy of the single file is complete
+        self._connection.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+
+        self._pending = 0
+        self._commit_time = time.time()
+
+    def _add_columns(self, fields, export_data):
+        columns = [(field,) + self._get_column_kind(export_data[field]) for field in fields]
+
+        if self._insert is None:
+            # Single statement for every field of the first capture
+            self._connection.execute("CREATE TABLE {} ({})".format(
+                util.sql_identifier(self.TABLE),
+                ', '.join(["{} INTEGER PRIMARY KEY".format(util.sql_identifier(self.INDEX_FIELD))] +
+                          ["{} {}".format(util.sql_identifier(field), self._COLUMN_TYPES[kind])
+                           for (field, kind, _, _) in columns])))
+        else:
+            for (field, kind, _, _) in columns:
+                self._connection.execute("ALTER TABLE {} ADD COLUMN {} {}".format(
+                    util.sql_identifier(self.TABLE), util.sql_identifier(field), self._COLUMN_TYPES[kind]))
+
+                self._log.warning("Field {} added after the first capture".format(field))
+
+        self._connection.executemany("INSERT INTO {} (name, kind, dtype, shape) VALUES (?, ?, ?, ?)".format(
+            util.sql_identifier(self.COLUMN_TABLE)),
+            [(field, kind, dtype.str if dtype is not None else None, json.dumps(shape) if shape else None)
+             for (field, kind, dtype, shape) in columns])
+
+        for (field, kind, dtype, _) in columns:
+            if kind in (self.KIND_INTEGER, self.KIND_REAL):
+                self._columns[field] = self._to_scalar
+            elif kind == self.KIND_ARRAY:
+                self._columns[field] = self._get_blob_converter(dtype)
+            else:
+                self._columns[field] = self._to_text
+
+        # Statement is rebuilt only when the columns change
+        self._insert = "INSERT INTO {} ({}) VALUES ({})".format(
+            util.sql_identifier(self.TABLE),
+            ', '.join(util.sql_identifier(f) for f in (self.INDEX_FIELD,) + tuple(self._columns)),
+            ', '.join('?' * (len(self._columns) + 1)))
+
+    def _get_column_kind(self, value):
+        # Column kind is recorded for readers, lists and other values that aren't numeric arrays are stored as JSON
+        if isinstance(value, (bool, int, np.integer)):
+            return self.KIND_INTEGER, None, None
+        elif isinstance(value, (float, np.floating)):
+            return self.KIND_REAL, None, None
+        elif type(value) is str:
+            return self.KIND_TEXT, None, None
+        elif type(value) in (list, tuple) or isinstance(value, np.ndarray):
+            array = np.asarray(value)
+
+            if array.dtype.kind in 'biufc':
+                # Numeric arrays are stored as raw bytes
+                return self.KIND_ARRAY, array.dtype, list(array.shape)
+
+        return self.KIND_JSON, None, None
+
+    def _get_blob_converter(self, dtype):
+        def to_blob(value):
+            try:
+                array = np.asarray(value)
+
+                if array.dtype.kind in 'biufc' and np.can_cast(array.dtype, dtype, 'same_kind'):
+                    return memoryview(np.ascontiguousarray(array, dtype=dtype)).cast('B')
+            except (TypeError, ValueError):
+                pass
+
+            # Values that don't fit the column type are kept as JSON text
+            return self._to_text(value)
+
+        return to_blob
+
+    @staticmethod
+    def _to_scalar(value):
+        if isinstance(value, np.generic):
+            return value.item()
+        elif value is None or type(value) in (bool, int, float):
+            return value
+        else:
+            return str(value)
+
+    @classmethod
+    def _to_text(cls, value):
+        if value is None or type(value) is str:
+            return value
+
+        return json.dumps(value, default=cls._to_json)
+
+
+class SQLiteReader(object):
+    """
+    Read access to a database written by SQLiteExporter, decoding array columns
+    """
+
+    def __init__(self, path):
+        # Read only, the exporter may still be writing
+        self._connection = sqlite3.connect("file:{}?mode=ro".format(path), uri=True)
+
+        self._columns = collections.OrderedDict()
+
+        for (name, kind, dtype, shape) in self._connection.execute(
+                "SELECT name, kind, dtype, shape FROM {} ORDER BY rowid".format(
+                    util.sql_identifier(SQLiteExporter.COLUMN_TABLE))):
+            self._columns[name] = (kind, np.dtype(dtype) if dtype else None, json.loads(shape) if shape else None)
+
+    def fields(self):
+        return list(self._columns.keys())
+
+    def rows(self, where=None, parameters=()):
+        query = "SELECT * FROM {}".format(util.sql_identifier(SQLiteExporter.TABLE))
+
+        if where:
+            query += ' WHERE ' + where
+
+        query += ' ORDER BY cap_index'
+
+        cursor = self._connection.execute(query, parameters)
+        names = [d[0] for d in cursor.description]
+
+        for row in cursor:
+            yield collections.OrderedDict((name, self._decode(name, value)) for (name, value) in zip(names, row))
+
+    def close(self):
+        self._connection.close()
+
+    def _decode(self, name, value):
+        if name not in self._columns or value is None:
+            return value
+
+        (kind, dtype, shape) = self._columns[name]
+
+        if type(value) is bytes and dtype is not None:
+            array = np.frombuffer(value, dtype=dtype)
+
+            # Arrays are flattened when written, restore the shape if it matches the first capture
+            if shape and int(np.prod(shape)) == array.size:
+                array = array.reshape(shape)
+
+            return array
+        elif type(value) is str and kind != SQLiteExporter.KIND_TEXT:
+            # JSON columns, or values that didn't fit a typed column
+            try:
+                return json.loads(value)
+            except ValueError:
+                return value
+
+        return value
+
+
+class SidecarReader(object):
+    """
+    Read access to array fields written to sidecar files by delimited text exporters
+    """
+
+    MANIFEST_SUFFIX = '-sidecar.json'
+
+    # Reference left in the text row, start and stop are value offsets into the sidecar file
+    REFERENCE_FORMAT = '{file}[{start}:{stop}]'
+    _REFERENCE = re.compile(r'^(.+)\[(\d+):(\d+)\]$')
+
+    def __init__(self, path):
+        # Path to the exported text file
+        self._directory = os.path.dirname(path)
+
+        with open(os.path.splitext(path)[0] + self.MANIFEST_SUFFIX, 'r') as f:
+            self._manifest = json.load(f, object_pairs_hook=collections.OrderedDict)
+
+        self._dtypes = {s['file']: np.dtype(s['dtype']) for s in self._manifest.values()}
+        self._shapes = {s['file']: tuple(s.get('shape', ())) for s in self._manifest.values()}
+
+    def fields(self):
+        return list(self._manifest.keys())
+
+    def is_reference(self, value):
+        match = self._REFERENCE.match(value.strip())
+
+        return match is not None and match.group(1) in self._dtypes
+
+    def read(self, reference):
+        match = self._REFERENCE.match(reference.strip())
+
+        if match is None or match.group(1) not in self._dtypes:
+            raise ValueError("Not a sidecar reference: {}".format(reference))
+
+        dtype = self._dtypes[match.group(1)]
+        shape = self._shapes[match.group(1)]
+        start = int(match.group(2))
+        stop = int(match.group(3))
+
+        if stop == start:
+            return np.zeros((0,) + shape, dtype=dtype)
+
+        # Values are flattened in row-major order when written, offsets count single values
+        return np.memmap(os.path.join(self._directory, match.group(1)), dtype=dtype, mode='r',
+                         offset=start * dtype.itemsize, shape=(stop - start,)).reshape((-1,) + shape)
+
+
+class StateReader(object):
+    """
+    Expands state fields written by delimited text exporters as change records
+    """
+
+    SUFFIX = '.state'
+
+    # Row column used to look up state
+    INDEX_FIELD = 'cap_index'
+
+    def __init__(self, path):
+        # Path to the exported text file, each record holds the fields that changed at its row
+        self._rows = []
+        self._states = []
+
+        state = {}
+
+        with open(os.path.splitext(path)[0] + self.SUFFIX, 'r') as f:
+            for line in f:
+                if not line.strip():
+                    continue
+
+                record = json.loads(line, object_pairs_hook=collections.OrderedDict)
+
+                state = state.copy()
+                state.update(record['state'])
+
+                self._rows.append(record[self.INDEX_FIELD])
+                self._states.append(state)
+
+    def fields(self):
+        return list(self._states[-1].keys()) if self._states else []
+
+    def changes(self):
+        return list(self._rows)
+
+    def get(self, cap_index):
+        # State in effect at the given row, the latest change at or before it
+        n = bisect.bisect_right(self._rows, int(cap_index)) - 1
+
+        if n < 0:
+            raise KeyError(cap_index)
+
+        return self._states[n]
+
+    def expand(self, field, cap_indices):
+        return [self.get(i).get(field) for i in cap_indices]
 
 
 class MKSPressureExporter(_DelimitedTextExporter):
@@ -186,3 +1273,70 @@ class SummaryTextExporter(Exporter):
         self._log.debug("Wrote to {}".format(filename))
 
         return filename,
+
+
+class BackgroundExporterWrapper(Exporter):
+    """
+    Runs another exporter on its own writer thread behind a bounded queue
+    """
+
+    DEFERRED = True
+
+    def __init__(self, wrapped_class, depth=None, policy=None, **kwargs):
+        super().__init__(None, None, kwargs.get('result_directory'))
+
+        # Create child class, all other options are passed through
+        self._wrapped_class = util.class_instance_from_dict(wrapped_class, __name__, **kwargs)
+
+        # Files are only known once the writer thread has exported a capture, they are reported by pop_completed
+        self._completed = []
+        self._completed_lock = threading.Lock()
+
+        self._stage = pipeline.PipelineStage("export-{}".format(type(self._wrapped_class).__name__), self._write,
+                                             depth, policy, drop_function=self._drop)
+        self._stage.start()
+
+    def get_label(self):
+        return type(self._wrapped_class).__name__
+
+    def get_high_water(self):
+        return self._stage.get_high_water()
+
+    def get_dropped(self):
+        return self._stage.get_dropped()
+
+    def export(self, identifier, export_data):
+        # Raises if the writer thread failed since the last call
+        self._stage.put((identifier, export_data))
+
+        return None
+
+    def close(self):
+        try:
+            # Wait for queued captures to be written
+            self._stage.stop()
+        finally:
+            files = self._wrapped_class.close()
+
+        self._stage.check()
+
+        return files
+
+    def pop_completed(self):
+        with self._completed_lock:
+            completed = self._completed
+            self._completed = []
+
+        return completed
+
+    def _write(self, item):
+        files = self._wrapped_class.export(*item)
+
+        with self._completed_lock:
+            self._completed.append((item[0], tuple(files) if files is not None else None))
+
+        return None
+
+    def _drop(self, item):
+        with self._completed_lock:
+            self._completed.append((item[0], None))
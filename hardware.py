@@ -1,8 +1,13 @@
+import asyncio
+import concurrent.futures
 import contextlib
 import enum
 import logging
+import random
 import struct
 import threading
+import time
+import weakref
 
 import serial
 import visa
@@ -21,20 +26,48 @@ class HardwareException(Exception):
 
 
 class Connector(object):
+    # Interval between attempts to take the thread lock from the event loop
+    _async_lock_poll = 0.001
+
     def __init__(self, name):
         self._name = name
 
         self._lock = threading.RLock()
+        self._async_locks = weakref.WeakKeyDictionary()
+        self._async_locks_lock = threading.Lock()
         self._log = logging.getLogger(type(self).__name__)
 
     @contextlib.contextmanager
     def get_lock(self, **kwargs):
         result = self._lock.acquire(**kwargs)
 
-        yield result
+        try:
+            yield result
+        finally:
+            if result:
+                self._lock.release()
 
-        if result:
-            self._lock.release()
+    @contextlib.asynccontextmanager
+    async def get_async_lock(self):
+        root = self.get_root()
+
+        # Serialise coroutines on each event loop first, then exclude threads using the blocking interface
+        loop = asyncio.get_running_loop()
+
+        with root._async_locks_lock:
+            async_lock = root._async_locks.get(loop)
+
+            if async_lock is None:
+                async_lock = root._async_locks[loop] = asyncio.Lock()
+
+        async with async_lock:
+            while not root._lock.acquire(blocking=False):
+                await asyncio.sleep(self._async_lock_poll)
+
+            try:
+                yield True
+            finally:
+                root._lock.release()
 
     def get_address(self):
         raise NotImplementedError()
@@ -42,6 +75,10 @@ class Connector(object):
     def get_name(self):
         return self._name
 
+    def get_root(self):
+        # Connector that owns the physical resource, connectors sharing a root can't be used concurrently
+        return self
+
     def reset(self):
         pass
 
@@ -60,6 +97,140 @@ class Connector(object):
     def query_raw(self, data, read_size=None):
         raise NotImplementedError()
 
+    async def async_read(self, size=None, timeout=None):
+        return await self._async_call(self._async_read, timeout, size)
+
+    async def async_write(self, data, timeout=None):
+        return await self._async_call(self._async_write, timeout, data)
+
+    async def async_query(self, data, read_size=None, timeout=None):
+        return await self._async_call(self._async_query, timeout, data, read_size)
+
+    async def async_query_raw(self, data, read_size=None, timeout=None):
+        return await self._async_call(self._async_query_raw, timeout, data, read_size)
+
+    async def _async_call(self, function, timeout, *args):
+        async with self.get_async_lock():
+            try:
+                return await asyncio.wait_for(function(*args), timeout)
+            except asyncio.TimeoutError:
+                # Leave the connector in a known state for the next caller
+                self.reset()
+
+                raise ConnectorException("Timeout after {} seconds on {}".format(timeout, self._name))
+
+    # Connectors without native non-blocking I/O run the blocking method on the loop's executor
+    async def _async_read(self, size):
+        return await self._async_executor(self.read, size)
+
+    async def _async_write(self, data):
+        return await self._async_executor(self.write, data)
+
+    async def _async_query(self, data, read_size):
+        return await self._async_executor(self.query, data, read_size)
+
+    async def _async_query_raw(self, data, read_size):
+        return await self._async_executor(self.query_raw, data, read_size)
+
+    @staticmethod
+    async def _async_executor(function, *args):
+        future = asyncio.get_running_loop().run_in_executor(None, function, *args)
+
+        try:
+            return await asyncio.shield(future)
+        except asyncio.CancelledError:
+            # Hold the lock until the executor thread is done with the instrument
+            await asyncio.wait({future})
+
+            if not future.cancelled():
+                future.exception()
+
+            raise
+
+
+class ConnectorEventLoop(object):
+    """
+    Event loop on a single background thread servicing asynchronous connector I/O and periodic tasks
+    """
+
+    def __init__(self, name='connector'):
+        self._name = name
+
+        self._loop = asyncio.new_event_loop()
+
+        self._thread = threading.Thread(target=self._run, name="{}-loop".format(self._name))
+        self._thread.daemon = True
+
+        self._log = logging.getLogger(type(self).__name__)
+
+    def get_loop(self):
+        return self._loop
+
+    def start(self):
+        self._thread.start()
+
+        self._log.info("Started event loop {}".format(self._name))
+
+    def stop(self, timeout=None):
+        if not self._thread.is_alive():
+            return
+
+        # Cancel outstanding tasks and let them unwind before stopping the loop
+        asyncio.run_coroutine_threadsafe(self._shutdown(), self._loop)
+        self._thread.join(timeout)
+
+        if not self._thread.is_alive():
+            self._loop.close()
+
+        self._log.info("Stopped event loop {}".format(self._name))
+
+    def submit(self, coroutine):
+        # Returns a concurrent.futures.Future that may be waited on or cancelled from any thread
+        return asyncio.run_coroutine_threadsafe(coroutine, self._loop)
+
+    def run(self, coroutine, timeout=None):
+        # Blocking call for synchronous code, must not be used from the loop thread itself
+        future = self.submit(coroutine)
+
+        try:
+            return future.result(timeout)
+        except concurrent.futures.TimeoutError:
+            future.cancel()
+
+            raise ConnectorException("Timeout after {} seconds in event loop {}".format(timeout, self._name))
+
+    def schedule_periodic(self, function, interval, *args, **kwargs):
+        # Repeatedly await function(*args, **kwargs) every interval seconds until stopped or cancelled
+        return self.submit(self._periodic_task(function, interval, args, kwargs))
+
+    async def _periodic_task(self, function, interval, args, kwargs):
+        while True:
+            start_time = self._loop.time()
+
+            try:
+                await function(*args, **kwargs)
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                self._log.exception("Exception in periodic task {}".format(function), exc_info=True)
+
+            await asyncio.sleep(max(interval - (self._loop.time() - start_time), 0))
+
+    async def _shutdown(self):
+        tasks = [t for t in asyncio.all_tasks(self._loop) if t is not asyncio.current_task()]
+
+        for t in tasks:
+            t.cancel()
+
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+        self._loop.stop()
+
+    def _run(self):
+        asyncio.set_event_loop(self._loop)
+
+        self._loop.run_forever()
+
 
 rs232retry = util.decorator_factory(util.ExceptionRetry, [serial.SerialException], log_attribute='_log',
                                     retry_attribute='_retry_attempt', reset_method='reset',
@@ -70,6 +241,9 @@ class RS232Connector(Connector):
     _retry_delay = 1
     _retry_attempt = 3
 
+    # Polling interval for non-blocking reads and writes
+    _async_poll = 0.002
+
     def __init__(self, name, **kwargs):
         super().__init__(name)
 
@@ -108,6 +282,74 @@ class RS232Connector(Connector):
     def query_raw(self, data, read_size=None):
         return self.query(data, read_size)
 
+    async def _async_retry(self, function, *args):
+        for attempt in range(self._retry_attempt):
+            try:
+                return await function(*args)
+            except serial.SerialException:
+                if attempt == self._retry_attempt - 1:
+                    raise
+
+                self._log.warning("Ignoring exception during asynchronous I/O, {} attempt{} remaining".format(
+                    self._retry_attempt - attempt - 1, 's' if self._retry_attempt - attempt - 1 != 1 else ''),
+                    exc_info=True)
+
+                self.reset()
+
+                await asyncio.sleep(self._retry_delay)
+
+    async def _async_read(self, size):
+        return await self._async_retry(self._async_read_once, size)
+
+    async def _async_write(self, data):
+        return await self._async_retry(self._async_write_once, data)
+
+    async def _async_query(self, data, read_size):
+        return await self._async_retry(self._async_query_once, data, read_size)
+
+    async def _async_query_raw(self, data, read_size):
+        return await self._async_query(data, read_size)
+
+    async def _async_read_once(self, size):
+        buffer = bytearray()
+
+        loop = asyncio.get_running_loop()
+        deadline = None if self._serial.timeout is None else loop.time() + self._serial.timeout
+
+        # Only read bytes already received so the event loop is never blocked by the port timeout
+        while True:
+            waiting = self._serial.in_waiting
+
+            if not waiting:
+                # Same as a blocking read, return whatever arrived once the port timeout expires
+                if deadline is not None and loop.time() >= deadline:
+                    return bytes(buffer)
+
+                await asyncio.sleep(self._async_poll)
+                continue
+
+            if size:
+                buffer += self._serial.read(min(waiting, size - len(buffer)))
+
+                if len(buffer) >= size:
+                    return bytes(buffer)
+            else:
+                # Read byte by byte to avoid consuming data past the end of line
+                for _ in range(waiting):
+                    buffer += self._serial.read(1)
+
+                    if buffer.endswith(b'\n'):
+                        return bytes(buffer)
+
+    async def _async_write_once(self, data):
+        # Writes go to the OS transmit buffer so they return without waiting on the line
+        return self._serial.write(data)
+
+    async def _async_query_once(self, data, read_size):
+        await self._async_write_once(data)
+
+        return await self._async_read_once(read_size)
+
 
 class RS232toRS485BusConnector(RS232Connector):
     def __init__(self, name, port, **kwargs):
@@ -129,17 +371,22 @@ class RS485AdapterConnector(Connector):
 
         self._bus_address = bus_address
 
+    def get_root(self):
+        return self._parent.get_root()
+
+    @contextlib.contextmanager
     def get_lock(self, **kwargs):
-        with self._parent.get_lock() as lock:
-            if lock:
-                super().get_lock(**kwargs)
-            else:
+        with self._parent.get_lock(**kwargs) as parent_lock:
+            if not parent_lock:
                 raise HardwareException('Cannot acquire parent RS232 resource lock')
 
+            with super().get_lock(**kwargs) as lock:
+                yield lock
+
 
 class VISAConnector(Connector):
     def __init__(self, visa_address, term_char=None):
-        super().__init__()
+        super().__init__(visa_address)
 
         self._visa_address = visa_address
 
@@ -212,7 +459,7 @@ class VISABusAddressConnector(Connector):
     _visa_connectors = {}
 
     def __init__(self, visa_address, bus_address, term_char=None):
-        super().__init__()
+        super().__init__(visa_address)
 
         self._visa_address = visa_address
         self._term_char = term_char
@@ -223,6 +470,9 @@ class VISABusAddressConnector(Connector):
 
         self._bus_address = bus_address
 
+    def get_root(self):
+        return VISABusAddressConnector._visa_connectors[self._visa_address][0].get_root()
+
     def reset(self):
         VISABusAddressConnector._visa_connectors[self._visa_address][1] = None
 
@@ -260,6 +510,76 @@ class VISABusAddressConnector(Connector):
             self._get_visa_connector().write("*ADR {}".format(self._bus_address))
 
 
+class SimulatedConnector(Connector):
+    """
+    Instrument stand-in with configurable response latency, for benchmarking without hardware
+    """
+
+    def __init__(self, name, latency=0.0, jitter=0.0, baud=None, response=None):
+        super().__init__(name)
+
+        self._latency = latency
+        self._jitter = jitter
+        self._baud = baud
+        self._response = response if response is not None else b'0.0\n'
+
+    def get_address(self):
+        return "sim://{}".format(self._name)
+
+    def read(self, size=None):
+        time.sleep(self._response_time(size))
+
+        return self._get_response(size)
+
+    def write(self, data):
+        time.sleep(self._transfer_time(len(data)))
+
+        return len(data)
+
+    def write_raw(self, data, raw_data):
+        return self.write(data + raw_data)
+
+    def query(self, data, read_size=None):
+        self.write(data)
+
+        return self.read(read_size)
+
+    def query_raw(self, data, read_size=None):
+        return self.query(data, read_size)
+
+    async def _async_read(self, size):
+        await asyncio.sleep(self._response_time(size))
+
+        return self._get_response(size)
+
+    async def _async_write(self, data):
+        await asyncio.sleep(self._transfer_time(len(data)))
+
+        return len(data)
+
+    async def _async_query(self, data, read_size):
+        await self._async_write(data)
+
+        return await self._async_read(read_size)
+
+    async def _async_query_raw(self, data, read_size):
+        return await self._async_query(data, read_size)
+
+    def _get_response(self, size):
+        if size:
+            return (self._response * (size // len(self._response) + 1))[:size]
+
+        return self._response
+
+    def _response_time(self, size):
+        return max(self._latency + random.uniform(-self._jitter, self._jitter), 0) + \
+            self._transfer_time(size if size else len(self._response))
+
+    def _transfer_time(self, size):
+        # 10 bits per byte on an 8N1 serial line
+        return size * 10.0 / self._baud if self._baud else 0.0
+
+
 class Hardware(object):
     def __init__(self, connector):
         self._connector = connector
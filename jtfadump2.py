@@ -13,9 +13,14 @@ import serial
 import pyvisa
 import yaml
 
+import acquisition
 import capture
+import catalog
+import checkpoint
 import experiment
 import exporter
+import metrics
+import plan
 import post_export
 import post_process
 import util
@@ -27,6 +32,8 @@ __maintainer__ = 'Christopher Harrison'
 __email__ = 'dev@ravngr.com'
 __status__ = 'Development'
 
+_CONFIG_FILENAME = 'config.yaml'
+
 
 class ExperimentNode:
     def __init__(self, exp, children=None):
@@ -72,6 +79,75 @@ def _generate_experiment_tree(module_config, global_module_config):
     return ExperimentNode(c(**config), child_nodes)
 
 
+def _print_plan(config, reference_path=None):
+    global_module_config = config.get('modules', {})
+    plan_config = config.get('plan', {}) or {}
+
+    experiment_plan = plan.ExperimentPlan([_generate_experiment_tree(c, global_module_config)
+                                           for c in config['experiment']])
+
+    capture_time = plan_config.get('capture_time', 0.0)
+    step_time = plan_config.get('step_time', 0.0)
+    export_size = {}
+
+    export_names = [m['class'] for m in config['export']]
+
+    for name in export_names:
+        if name in plan_config.get('export_size', {}):
+            export_size[name] = plan_config['export_size'][name]
+
+    if reference_path:
+        # Measure costs from a previous run, mapping file extensions back to exporter classes
+        with open(os.path.join(reference_path, _CONFIG_FILENAME), 'r') as h:
+            reference_config = yaml.safe_load(h)
+
+        reference_plan = plan.ExperimentPlan([_generate_experiment_tree(c, reference_config.get('modules', {}))
+                                              for c in reference_config['experiment']])
+
+        export_extensions = {}
+
+        for name in export_names:
+            extension = getattr(util.class_from_str(name, exporter.__name__), 'EXTENSION', None)
+
+            if extension:
+                export_extensions[extension] = name
+
+        (reference_capture_time, reference_export_size) = plan.measure_reference(reference_path, reference_plan,
+                                                                                  export_extensions)
+
+        if reference_capture_time is not None:
+            capture_time = reference_capture_time
+
+        export_size.update(reference_export_size)
+
+    estimate = experiment_plan.estimate(capture_time, step_time, export_size)
+
+    print('Experiment plan:')
+
+    for line in experiment_plan.describe():
+        print('\t' + line)
+
+    print("\nCaptures: {}".format(estimate['captures']))
+    print("Experiment steps: {}".format(estimate['steps']))
+    print("Scheduled delay: {}".format(plan.format_duration(estimate['delay'])))
+    print("Capture time: {:.3f} s per capture, {} total".format(capture_time,
+                                                               plan.format_duration(estimate['capture_time'])))
+
+    if step_time:
+        print("Step time: {:.3f} s per step, {} total".format(step_time, plan.format_duration(estimate['step_time'])))
+
+    print("Estimated wall time: {}".format(plan.format_duration(estimate['wall_time'])))
+
+    print('\nExport size:')
+
+    for name in export_names:
+        if name in estimate['export_size']:
+            print("\t{}: {} per capture, {} total".format(name, plan.format_size(export_size[name]),
+                                                          plan.format_size(estimate['export_size'][name])))
+        else:
+            print("\t{}: unknown".format(name))
+
+
 def main():
     # Get start time
     start_time = time.gmtime()
@@ -97,8 +173,17 @@ def main():
     parse = argparse.ArgumentParser(description='jtfadump2 Experiment System',
                                     formatter_class=argparse.RawDescriptionHelpFormatter, epilog=module_list)
 
-    parse.add_argument('name', help='Prefix for results folder')
-    parse.add_argument('config', help='YAML configuration file(s)', nargs='+')
+    parse.add_argument('name', help='Prefix for results folder', nargs='?')
+    parse.add_argument('config', help='YAML configuration file(s)', nargs='*')
+
+    parse.add_argument('--resume', help='Resume an interrupted run from its result directory', dest='resume',
+                       metavar='RESULT_DIR')
+    parse.add_argument('--plan', help='Print experiment schedule and estimates then exit without running',
+                       dest='plan', action='store_true')
+    parse.set_defaults(plan=False)
+    parse.add_argument('--plan-reference', help='Result directory of a previous run used to measure capture time '
+                                                'and export size for --plan', dest='plan_reference',
+                       metavar='RESULT_DIR')
 
     parse.add_argument('-v', '--verbose', help='Verbose output', dest='display_verbose', action='store_true')
     parse.set_defaults(display_verbose=False)
@@ -112,28 +197,59 @@ def main():
 
     args = parse.parse_args()
 
-    # Get experiment prefix
-    experiment_name = args.name.strip().replace(' ', '_')
+    resume_record = None
 
-    # Load configuration YAML file(s)
-    config = {}
+    if args.resume:
+        # Reuse the configuration and result directory of the interrupted run
+        result_path = os.path.realpath(args.resume)
 
-    for f in args.config:
-        with open(f, 'r') as h:
-            config.update(yaml.load(h))
+        try:
+            resume_record = checkpoint.CheckpointJournal.load(result_path)
+        except checkpoint.CheckpointException as e:
+            parse.error(str(e))
 
-    # Setup directories
-    result_path = os.path.realpath(config['result']['path'])
+        if not os.path.isfile(os.path.join(result_path, _CONFIG_FILENAME)):
+            parse.error("No configuration to resume in {}".format(result_path))
 
-    if not os.path.exists(result_path) or not os.path.isdir(result_path):
-        print("Result directory {} either doesn't exist or is not a writable directory".format(result_path),
-              file=sys.stderr)
-        return
+        # Result directory is named <experiment name>-<start time>
+        experiment_name = os.path.basename(result_path).rsplit('-', 1)[0]
+
+        with open(os.path.join(result_path, _CONFIG_FILENAME), 'r') as h:
+            config = yaml.safe_load(h)
+    else:
+        if not args.name or not args.config:
+            parse.error('name and config are required unless resuming')
+
+        # Get experiment prefix
+        experiment_name = args.name.strip().replace(' ', '_')
+
+        # Load configuration YAML file(s)
+        config = {}
 
-    result_path = os.path.join(result_path, "{}-{}".format(experiment_name, start_time_str))
+        for f in args.config:
+            with open(f, 'r') as h:
+                config.update(yaml.safe_load(h))
 
-    # Create result directory
-    os.makedirs(result_path, exist_ok=False)
+        if args.plan:
+            _print_plan(config, args.plan_reference)
+            return
+
+        # Setup directories
+        result_path = os.path.realpath(config['result']['path'])
+
+        if not os.path.exists(result_path) or not os.path.isdir(result_path):
+            print("Result directory {} either doesn't exist or is not a writable directory".format(result_path),
+                  file=sys.stderr)
+            return
+
+        result_path = os.path.join(result_path, "{}-{}".format(experiment_name, start_time_str))
+
+        # Create result directory
+        os.makedirs(result_path, exist_ok=False)
+
+        # Keep a copy of the combined configuration so the run can be resumed
+        with open(os.path.join(result_path, _CONFIG_FILENAME), 'w') as h:
+            yaml.dump(config, h)
 
     log_path = os.path.realpath(config['logging'].get('path', result_path))
 
@@ -169,6 +285,9 @@ def main():
     root_logger.info("Launch command: {}".format(' '.join(sys.argv)))
     root_logger.info("Result directory: {}".format(result_path))
 
+    if resume_record:
+        root_logger.info("Resuming from checkpoint at capture {}".format(resume_record['capture']))
+
     # Dump configuration to log
     root_logger.debug('--- BEGIN CONFIGURATION ---')
 
@@ -245,83 +364,60 @@ def main():
     root_logger.info("Loaded {} post-export module{}".format(post_export_module_count,
                                                              's' if post_export_module_count is not 1 else ''))
 
-    # Track running experiments in order to stop them properly
-    running_experiments = []
+    # Optional pipelined processing of captures
+    pipeline_config = config.pop('pipeline', None)
+
+    if pipeline_config is not None:
+        root_logger.info('Pipeline mode enabled')
+
+    # Optional concurrent capture across modules that don't share a connector
+    parallel_capture_config = config.pop('parallel_capture', None)
+
+    if parallel_capture_config is not None:
+        root_logger.info('Parallel capture enabled')
+
+    # Optional post-export on worker threads, coalescing repeated requests for the same file
+    post_export_pool_config = config.pop('post_export_pool', None)
+
+    if post_export_pool_config is not None:
+        root_logger.info('Post-export pool enabled')
+
+    # Checkpoint journal for resuming after a crash, enabled unless set to false
+    checkpoint_config = config.pop('checkpoint', {})
+    checkpoint_journal = None
+
+    if checkpoint_config is not False:
+        checkpoint_journal = checkpoint.CheckpointJournal(result_path, **(checkpoint_config or {}))
+    elif resume_record:
+        root_logger.warning('Checkpoint journal disabled, resumed run cannot be resumed again')
+
+    # Index of captures by experiment primary key, enabled unless set to false
+    catalog_config = config.pop('catalog', {})
+    catalog_index = None
+
+    if catalog_config is not False:
+        catalog_index = catalog.CatalogIndex(result_path, **(catalog_config or {}))
+
+    # Stage timing, summaries are written periodically to the result directory
+    metrics_config = config.pop('metrics', {})
+    metrics_registry = metrics.MetricsRegistry(result_path, **(metrics_config or {}))
+
+    acquisition_loop = acquisition.Acquisition(experiment_nodes, capture_modules, post_process_modules,
+                                               export_modules, post_export_modules,
+                                               pipeline_config=pipeline_config,
+                                               parallel_capture_config=parallel_capture_config,
+                                               checkpoint_journal=checkpoint_journal,
+                                               resume_record=resume_record,
+                                               metrics_registry=metrics_registry,
+                                               catalog_index=catalog_index,
+                                               post_export_pool_config=post_export_pool_config)
+
+    finished = False
 
     # Catch all exceptions for logging
     try:
-        # Step experiment stack
-        active_experiments = []
-
-        while experiment_nodes:
-            current_node = experiment_nodes[0]
-            current_experiment = current_node.experiment
-
-            if current_experiment.has_next():
-                # Add experiment to active list
-                if current_experiment not in active_experiments:
-                    active_experiments.append(current_experiment)
-
-                if current_experiment not in running_experiments:
-                    running_experiments.append(current_experiment)
-
-                # Step the active experiment
-                current_experiment.step()
-
-                if current_node.children:
-                    # Append children to node stack
-                    experiment_nodes[:0] = current_node.children
-                else:
-                    # Save data from this experiment
-                    # Generate a unique identifier for the capture
-                    capture_id = util.rand_hex_str(64)
-                    capture_id_short = capture_id[-8::]
-
-                    # Timestamp data and attach unique id
-                    data = {
-                        'cap_id': capture_id,
-                        'cap_time': time.strftime('%a, %d %b %Y %H:%M:%S +0000'),
-                        'cap_timestamp': time.time()
-                    }
-
-                    # Get current state of experiment
-                    for e in active_experiments:
-                        data.update(e.get_state())
-
-                    # Capture data from all sources
-                    for c in capture_modules:
-                        data.update(c.get_data(active_experiments))
-
-                    # Apply optional post-processors to data
-                    if post_process_modules:
-                        for p in post_process_modules:
-                            d = p.process(data)
-
-                            # Don't let badly written post-processors wipe out data
-                            if d is not None:
-                                data = d
-                            else:
-                                root_logger.warn("PostProcessor {} returning no data".format(p.__name__))
-
-                    # Export data
-                    exported_files = []
-
-                    for e in export_modules:
-                        f = e.export(capture_id_short, data)
-
-                        if f is not None:
-                            exported_files.extend(f)
-
-                    # Post-export
-                    for pe in post_export_modules:
-                        pe.process(exported_files)
-            else:
-                # Remove experiment both from the stack and from the active list
-                experiment_nodes.pop(0)
-                active_experiments.remove(current_experiment)
-
-                # Reset experiment state in case it is re-used
-                current_experiment.reset()
+        acquisition_loop.run()
+        finished = True
 
         root_logger.info('Experiment finished normally')
     except:
@@ -334,9 +430,13 @@ def main():
 
         raise
     finally:
-        # Stop all running experiments
-        for e in running_experiments:
-            e.stop()
+        # Finish pending work and stop all running experiments
+        try:
+            acquisition_loop.stop()
+        except Exception:
+            # Already logged, don't replace the exception that ended the run
+            if finished:
+                raise
 
     root_logger.info('Exiting')
 
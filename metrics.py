@@ -0,0 +1,154 @@
+import logging
+import math
+import os
+import threading
+import time
+
+import util
+
+__author__ = 'chris'
+
+
+class Histogram(object):
+    """
+    Fixed log-scale histogram of durations, constant memory and O(1) insertion
+    """
+
+    # Buckets span 1 us to ~1000 s with 8 buckets per factor of two (~9% resolution)
+    _MINIMUM = 1e-6
+    _BUCKETS_PER_OCTAVE = 8
+    _BUCKET_COUNT = 8 * 30
+
+    def __init__(self):
+        self._buckets = [0] * (self._BUCKET_COUNT + 1)
+
+        self.count = 0
+        self.total = 0.0
+        self.minimum = None
+        self.maximum = None
+
+    def add(self, value):
+        if value <= self._MINIMUM:
+            index = 0
+        else:
+            index = min(int(math.log2(value / self._MINIMUM) * self._BUCKETS_PER_OCTAVE) + 1, self._BUCKET_COUNT)
+
+        self._buckets[index] += 1
+
+        self.count += 1
+        self.total += value
+
+        if self.minimum is None or value < self.minimum:
+            self.minimum = value
+
+        if self.maximum is None or value > self.maximum:
+            self.maximum = value
+
+    def get_mean(self):
+        return self.total / self.count if self.count else None
+
+    def get_percentile(self, fraction):
+        if not self.count:
+            return None
+
+        target = fraction * self.count
+        cumulative = 0
+
+        for (index, n) in enumerate(self._buckets):
+            cumulative += n
+
+            if cumulative >= target and n:
+                if index == self._BUCKET_COUNT:
+                    # Last bucket holds everything beyond the range and has no upper edge
+                    return self.maximum
+
+                # Report the upper edge of the bucket, clamped to the observed range
+                value = self._MINIMUM * 2 ** (index / float(self._BUCKETS_PER_OCTAVE))
+
+                return min(max(value, self.minimum), self.maximum)
+
+        return self.maximum
+
+    def summary(self):
+        return {
+            'count': self.count,
+            'total': self.total,
+            'mean': self.get_mean(),
+            'min': self.minimum,
+            'p50': self.get_percentile(0.5),
+            'p90': self.get_percentile(0.9),
+            'p99': self.get_percentile(0.99),
+            'max': self.maximum
+        }
+
+
+class MetricsRegistry(object):
+    """
+    Named histograms for acquisition loop stages, optionally written periodically to a JSON file
+    """
+
+    FILENAME = 'metrics.json'
+
+    DEFAULT_WRITE_INTERVAL = 60.0
+
+    def __init__(self, result_directory=None, write_interval=None):
+        self._histograms = {}
+        self._lock = threading.Lock()
+
+        self._path = os.path.join(result_directory, self.FILENAME) if result_directory else None
+        self._write_interval = write_interval if write_interval is not None else self.DEFAULT_WRITE_INTERVAL
+        self._write_time = time.time()
+        self._start_time = self._write_time
+
+        self._log = logging.getLogger(type(self).__name__)
+
+    def get_histogram(self, name):
+        # Histograms are created once, callers should keep the reference for the hot path
+        with self._lock:
+            if name not in self._histograms:
+                self._histograms[name] = Histogram()
+
+            return self._histograms[name]
+
+    def record(self, name, value):
+        self.get_histogram(name).add(value)
+
+    def summary(self):
+        with self._lock:
+            return {name: h.summary() for (name, h) in self._histograms.items()}
+
+    def poll(self):
+        # Cheap check from the acquisition loop, only writes once the interval has passed
+        if self._path and time.time() - self._write_time >= self._write_interval:
+            self.write()
+
+    def write(self):
+        if not self._path:
+            return
+
+        self._write_time = time.time()
+
+        output = {
+            'time': self._write_time,
+            'elapsed': self._write_time - self._start_time,
+            'stages': self.summary()
+        }
+
+        util.write_json(self._path, output, indent=2, sort_keys=True)
+
+    def log_summary(self, level=logging.INFO):
+        summary = self.summary()
+
+        if not summary:
+            return
+
+        self._log.log(level, 'Stage timing (ms): count, mean, p50, p90, p99, max, total (s)')
+
+        # Most expensive stages first
+        for (name, s) in sorted(summary.items(), key=lambda x: x[1]['total'], reverse=True):
+            if not s['count']:
+                continue
+
+            self._log.log(level, "{}: {}, {:.3f}, {:.3f}, {:.3f}, {:.3f}, {:.3f}, {:.1f}".format(
+                name, s['count'], s['mean'] * 1e3, s['p50'] * 1e3, s['p90'] * 1e3, s['p99'] * 1e3,
+                s['max'] * 1e3, s['total']))
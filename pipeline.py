@@ -0,0 +1,226 @@
+import logging
+import queue
+import threading
+
+__author__ = 'chris'
+
+
+class PipelineException(Exception):
+    pass
+
+
+class WorkerFailure(object):
+    """
+    First exception raised on a worker thread, later work is discarded and the exception raised on the producer
+    """
+
+    def __init__(self, exception_class, message):
+        self._exception_class = exception_class
+        self._message = message
+        self._exception = None
+
+    def is_set(self):
+        return self._exception is not None
+
+    def set(self, exception):
+        if self._exception is None:
+            self._exception = exception
+
+    def check(self):
+        if self._exception is not None:
+            raise self._exception_class(self._message) from self._exception
+
+
+class PipelineStage(object):
+    POLICY_BLOCK = 'block'
+    POLICY_DROP = 'drop'
+    POLICY_DROP_OLDEST = 'drop_oldest'
+
+    POLICIES = (POLICY_BLOCK, POLICY_DROP, POLICY_DROP_OLDEST)
+
+    DEFAULT_DEPTH = 16
+
+    # Interval to re-check for worker failure while blocked on a full queue
+    _PUT_TIMEOUT = 0.5
+
+    _STOP = object()
+
+    def __init__(self, name, function, depth=None, policy=None, next_stage=None, drop_function=None):
+        self._name = name
+        self._function = function
+        self._drop_function = drop_function
+        self._depth = depth if depth is not None else self.DEFAULT_DEPTH
+        self._policy = policy if policy else self.POLICY_BLOCK
+        self._next_stage = next_stage
+
+        if self._policy not in self.POLICIES:
+            raise PipelineException("Unknown queue policy {} for stage {}".format(self._policy, self._name))
+
+        if self._depth < 1:
+            raise PipelineException("Queue depth for stage {} must be at least 1".format(self._name))
+
+        self._queue = queue.Queue(maxsize=self._depth)
+
+        # Statistics
+        self._stats_lock = threading.Lock()
+        self._processed = 0
+        self._dropped = 0
+        self._high_water = 0
+
+        self._failure = WorkerFailure(PipelineException, "Stage {} failed".format(self._name))
+
+        self._thread = threading.Thread(target=self._run, name="pipeline-{}".format(self._name))
+        self._thread.daemon = True
+
+        self._log = logging.getLogger("{}[{}]".format(type(self).__name__, self._name))
+        self._log.info("Stage {}: queue depth {}, {} policy".format(self._name, self._depth, self._policy))
+
+    def get_name(self):
+        return self._name
+
+    def get_high_water(self):
+        return self._high_water
+
+    def get_dropped(self):
+        return self._dropped
+
+    def start(self):
+        self._thread.start()
+
+    def check(self):
+        self._failure.check()
+
+    def put(self, item):
+        self.check()
+
+        if self._policy == self.POLICY_BLOCK:
+            while True:
+                try:
+                    self._queue.put(item, timeout=self._PUT_TIMEOUT)
+                    break
+                except queue.Full:
+                    # Don't wait forever on a worker that has died
+                    self.check()
+        elif self._policy == self.POLICY_DROP:
+            try:
+                self._queue.put_nowait(item)
+            except queue.Full:
+                self._drop(item, "Stage {} queue full, dropped incoming item".format(self._name))
+                return
+        else:
+            while True:
+                try:
+                    self._queue.put_nowait(item)
+                    break
+                except queue.Full:
+                    try:
+                        dropped = self._queue.get_nowait()
+                        self._queue.task_done()
+                        self._drop(dropped, "Stage {} queue full, dropped oldest item".format(self._name))
+                    except queue.Empty:
+                        pass
+
+        size = self._queue.qsize()
+
+        with self._stats_lock:
+            if size > self._high_water:
+                self._high_water = size
+
+                if size == self._depth:
+                    self._log.warning("Stage {} queue reached capacity ({})".format(self._name, self._depth))
+
+    def stop(self):
+        # Wait for queued items to be processed before returning
+        if self._thread.is_alive():
+            self._queue.put(self._STOP)
+            self._thread.join()
+
+        self._log.info("Stage {}: processed {}, dropped {}, queue high-water {}/{}".format(
+            self._name, self._processed, self._dropped, self._high_water, self._depth))
+
+    def _drop(self, item, message):
+        with self._stats_lock:
+            self._dropped += 1
+
+        self._log.warning(message)
+
+        if self._drop_function is not None:
+            self._drop_function(item)
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+
+            try:
+                if item is self._STOP:
+                    return
+
+                if self._failure.is_set():
+                    continue
+
+                try:
+                    result = self._function(item)
+
+                    if self._next_stage is not None and result is not None:
+                        self._next_stage.put(result)
+                except Exception as e:
+                    self._log.exception("Exception in stage {}".format(self._name), exc_info=True)
+                    self._failure.set(e)
+
+                with self._stats_lock:
+                    self._processed += 1
+            finally:
+                self._queue.task_done()
+
+
+class Pipeline(object):
+    def __init__(self, stages):
+        # Stages are given in processing order, each forwards its result to the next
+        self._stages = stages
+
+        self._log = logging.getLogger(type(self).__name__)
+
+    @classmethod
+    def from_config(cls, stage_functions, depth=None, policy=None, stage=None):
+        stage_config = stage if stage else {}
+
+        stages = []
+        next_stage = None
+
+        # Build stages in reverse so each knows the stage that follows it
+        for (name, function) in reversed(stage_functions):
+            options = stage_config.get(name, {})
+
+            next_stage = PipelineStage(name, function, options.get('depth', depth), options.get('policy', policy),
+                                       next_stage)
+            stages.insert(0, next_stage)
+
+        return cls(stages)
+
+    def start(self):
+        for s in self._stages:
+            s.start()
+
+    def check(self):
+        for s in self._stages:
+            s.check()
+
+    def get_stage(self, name):
+        for s in self._stages:
+            if s.get_name() == name:
+                return s
+
+        return None
+
+    def put(self, item):
+        # Worker failures in later stages should halt acquisition too
+        self.check()
+
+        self._stages[0].put(item)
+
+    def stop(self):
+        # Drain each stage in order so every queued item reaches the end of the pipeline
+        for s in self._stages:
+            s.stop()
+
+        self.check()
@@ -0,0 +1,191 @@
+import collections
+import datetime
+import json
+import os
+
+import checkpoint
+
+__author__ = 'chris'
+
+
+class PlanException(Exception):
+    pass
+
+
+# A single capture in the schedule, path holds (label, step) for each active experiment from the root down and
+# delay is the time spent in experiment steps since the previous capture
+PlanStep = collections.namedtuple('PlanStep', ['path', 'delay'])
+
+
+class ExperimentPlan(object):
+    """
+    Compiled schedule of an experiment tree, computed without stepping any experiment
+    """
+
+    def __init__(self, experiment_nodes):
+        self._experiment_nodes = experiment_nodes
+
+        # Delays are fixed by configuration, so gather them once per node
+        self._delays = {}
+
+        for node in experiment_nodes:
+            self._load_delays(node)
+
+        self.captures = sum(self._count_captures(n) for n in experiment_nodes)
+        self.steps = sum(self._count_steps(n) for n in experiment_nodes)
+        self.delay = sum(self._sum_delay(n) for n in experiment_nodes)
+
+    def schedule(self):
+        # Generator, a long run may have far too many captures to hold in memory
+        pending = [0.0]
+
+        for step in self._schedule(self._experiment_nodes, (), pending):
+            yield step
+
+    def estimate(self, capture_time=0.0, step_time=0.0, export_size=None):
+        estimate = {
+            'captures': self.captures,
+            'steps': self.steps,
+            'delay': self.delay,
+            'capture_time': capture_time * self.captures,
+            'step_time': step_time * self.steps,
+            'export_size': {}
+        }
+
+        estimate['wall_time'] = estimate['delay'] + estimate['capture_time'] + estimate['step_time']
+
+        if export_size:
+            for (name, size) in export_size.items():
+                estimate['export_size'][name] = size * self.captures
+
+        return estimate
+
+    def describe(self):
+        lines = []
+
+        for node in self._experiment_nodes:
+            self._describe(node, 0, lines)
+
+        return lines
+
+    def _load_delays(self, node):
+        try:
+            self._delays[node] = node.experiment.get_step_delays()
+        except NotImplementedError:
+            raise PlanException("Experiment {} ({}) cannot be planned".format(node.experiment.get_label(),
+                                                                             type(node.experiment).__name__))
+
+        if node.children:
+            for child in node.children:
+                self._load_delays(child)
+
+    def _count_captures(self, node):
+        if node.children:
+            return len(self._delays[node]) * sum(self._count_captures(c) for c in node.children)
+        else:
+            return len(self._delays[node])
+
+    def _count_steps(self, node):
+        if node.children:
+            return len(self._delays[node]) * (1 + sum(self._count_steps(c) for c in node.children))
+        else:
+            return len(self._delays[node])
+
+    def _sum_delay(self, node):
+        delay = sum(self._delays[node])
+
+        if node.children:
+            delay += len(self._delays[node]) * sum(self._sum_delay(c) for c in node.children)
+
+        return delay
+
+    def _schedule(self, nodes, path, pending):
+        for node in nodes:
+            label = node.experiment.get_label()
+
+            for (step, delay) in enumerate(self._delays[node]):
+                pending[0] += delay
+                step_path = path + ((label, step),)
+
+                if node.children:
+                    for s in self._schedule(node.children, step_path, pending):
+                        yield s
+                else:
+                    yield PlanStep(step_path, pending[0])
+
+                    pending[0] = 0.0
+
+    def _describe(self, node, depth, lines):
+        delays = self._delays[node]
+
+        lines.append("{}{} ({}): {} step{}, {} delay".format('\t' * depth, node.experiment.get_label(),
+                                                            type(node.experiment).__name__, len(delays),
+                                                            's' if len(delays) != 1 else '',
+                                                            format_duration(sum(delays))))
+
+        if node.children:
+            for child in node.children:
+                self._describe(child, depth + 1, lines)
+
+
+# Measure per-capture time and export size from a previous run's result directory
+def measure_reference(result_directory, reference_plan, export_extensions):
+    try:
+        record = checkpoint.CheckpointJournal.load(result_directory)
+    except checkpoint.CheckpointException as e:
+        raise PlanException(str(e))
+
+    captures = record['capture']
+
+    # Timestamps of the first and last capture bound the measured interval
+    with open(os.path.join(result_directory, checkpoint.CheckpointJournal.FILENAME), 'r') as f:
+        first_record = json.loads(f.readline())
+
+    elapsed = record['timestamp'] - first_record['timestamp']
+    measured = captures - first_record['capture']
+
+    capture_time = None
+
+    if measured > 0:
+        # Remove scheduled delays between the first and last measured capture from the elapsed time
+        delay = 0.0
+
+        for (n, step) in enumerate(reference_plan.schedule()):
+            if n >= captures:
+                break
+
+            if n >= first_record['capture']:
+                delay += step.delay
+
+        capture_time = max(elapsed - delay, 0.0) / measured
+
+    # Attribute files to exporters by extension
+    export_size = {}
+
+    for name in os.listdir(result_directory):
+        extension = os.path.splitext(name)[1].lstrip('.')
+
+        if extension in export_extensions:
+            exporter_name = export_extensions[extension]
+            size = os.path.getsize(os.path.join(result_directory, name))
+
+            export_size[exporter_name] = export_size.get(exporter_name, 0) + size
+
+    for exporter_name in export_size:
+        export_size[exporter_name] /= float(captures)
+
+    return capture_time, export_size
+
+
+def format_duration(seconds):
+    return str(datetime.timedelta(seconds=int(round(seconds))))
+
+
+def format_size(size):
+    for unit in ['B', 'kB', 'MB', 'GB']:
+        if abs(size) < 1000.0:
+            return "{:.1f} {}".format(size, unit)
+
+        size /= 1000.0
+
+    return "{:.1f} TB".format(size)
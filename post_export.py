@@ -1,7 +1,25 @@
+import collections
+import concurrent.futures
+import errno
+import gzip
+import hashlib
+import json
 import logging
 import os
 import shutil
+import threading
+import time
 import zipfile
+import zlib
+
+import numpy as np
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+import pipeline
 
 __author__ = 'chris'
 
@@ -11,21 +29,40 @@ class PostExporterException(Exception):
 
 
 class PostExporter(object):
+    # Post-exporters that replace the files they're given return the new paths, later ones get those instead
+    REPLACES_FILES = False
+
     def __init__(self, result_directory):
         self._log = logging.getLogger(type(self).__name__)
 
         self._result_directory = result_directory
 
+        # (original, replacement) path pairs from the last call to process or close
+        self.renamed_files = ()
+
     def process(self, exported_files):
         raise NotImplementedError()
 
+    def close(self):
+        # Called once at shutdown, after all exporters have been closed
+        pass
+
 
 class BackupCopy(PostExporter):
-    def __init__(self, result_directory, target_directory):
+    _COPY_BUFFER = 1024 * 1024
+
+    DEFAULT_VERIFY_SIZE = 64 * 1024
+
+    def __init__(self, result_directory, target_directory, incremental=False, verify_size=None):
         super().__init__(result_directory)
 
         self._target_directory = target_directory
 
+        # Incremental mode appends new bytes of growing files, falling back to a full copy
+        self._incremental = incremental
+        self._verify_size = verify_size if verify_size is not None else self.DEFAULT_VERIFY_SIZE
+        self._files = {}
+
     def process(self, exported_files):
         # Copy exported files to target directory
         backup_files = []
@@ -34,24 +71,106 @@ class BackupCopy(PostExporter):
             # Generate new path
             target_path = os.path.join(self._target_directory, os.path.basename(f))
 
-            self._log.debug("Copying file {} to {}".format(f, target_path))
+            if self._incremental:
+                self._sync(f, target_path)
+            else:
+                self._log.debug("Copying file {} to {}".format(f, target_path))
 
-            shutil.copyfile(f, target_path)
+                shutil.copyfile(f, target_path)
 
             backup_files.append(target_path)
 
         return tuple(backup_files)
 
+    def _sync(self, path, target_path):
+        stat = os.stat(path)
+        identity = (stat.st_dev, stat.st_ino)
+
+        state = self._files.get(path)
+
+        try:
+            target_size = os.path.getsize(target_path)
+        except OSError:
+            target_size = None
+
+        if state is not None and state['identity'] == identity and state['offset'] == target_size:
+            if stat.st_size == state['offset'] and stat.st_mtime_ns == state['mtime']:
+                # Nothing new
+                return
+
+            if stat.st_size > state['offset'] and self._checksum(path, state['offset']) == state['checksum']:
+                self._log.debug("Appending {} bytes of {} to {}".format(stat.st_size - state['offset'], path,
+                                                                       target_path))
+
+                with open(path, 'rb') as f_in, open(target_path, 'ab') as f_out:
+                    f_in.seek(state['offset'])
+                    self._copy(f_in, f_out, stat.st_size - state['offset'])
+
+                self._update_state(path, identity, stat)
+
+                return
+
+        # New, replaced, truncated or modified file or a missing or changed backup, copy all of it
+        self._log.debug("Copying file {} to {}".format(path, target_path))
+
+        with open(path, 'rb') as f_in, open(target_path, 'wb') as f_out:
+            self._copy(f_in, f_out, stat.st_size)
+
+        self._update_state(path, identity, stat)
+
+    def _update_state(self, path, identity, stat):
+        self._files[path] = {
+            'identity': identity,
+            'mtime': stat.st_mtime_ns,
+            'offset': stat.st_size,
+            'checksum': self._checksum(path, stat.st_size)
+        }
+
+    def _checksum(self, path, offset):
+        # Adler-32 of the window before offset, catches files rewritten rather than appended to
+        start = max(offset - self._verify_size, 0)
+
+        with open(path, 'rb') as f:
+            f.seek(start)
+
+            return zlib.adler32(f.read(offset - start))
+
+    def _copy(self, f_in, f_out, length):
+        # Copy only the bytes present when the file was checked, later growth is picked up next time
+        remaining = length
+
+        while remaining > 0:
+            buffer = f_in.read(min(self._COPY_BUFFER, remaining))
+
+            if not buffer:
+                raise PostExporterException("{} shrank while being copied".format(f_in.name))
+
+            f_out.write(buffer)
+            remaining -= len(buffer)
+
 
 class LatestCopy(BackupCopy):
-    def __init__(self, result_directory, target_directory):
+    # Linux ioctl to share extents between files on copy-on-write filesystems (btrfs, XFS)
+    _FICLONE = 0x40049409
+
+    # Errors meaning a method can't work between these directories, anything else may succeed on the next file
+    _UNSUPPORTED_ERRORS = {errno.EXDEV, errno.EPERM, errno.EOPNOTSUPP, errno.ENOTTY, errno.ENOSYS, errno.EINVAL}
+
+    def __init__(self, result_directory, target_directory, atomic=False):
         super().__init__(result_directory, target_directory)
 
         self.target_directory = target_directory
 
         self.created_files = ()
 
+        # Atomic mode replaces each copy with a rename, linking instead of copying where possible
+        self._atomic = atomic
+        self._unsupported = set()
+
     def process(self, exported_files):
+        if self._atomic:
+            return self._publish(exported_files)
+
         # Delete the previous copy in target directory
         if self.created_files:
             for f in self.created_files:
@@ -73,20 +192,952 @@ class LatestCopy(BackupCopy):
 
         return backup_files
 
+    def _publish(self, exported_files):
+        published_files = []
+
+        for f in exported_files:
+            target_path = os.path.join(self.target_directory, os.path.basename(f))
+
+            try:
+                if os.path.samefile(f, target_path):
+                    # Already published as a hard link, which follows the file as it grows
+                    published_files.append(target_path)
+                    continue
+            except OSError:
+                pass
+
+            temp_path = os.path.join(self.target_directory, '.' + os.path.basename(f) + '.tmp')
+
+            if os.path.lexists(temp_path):
+                os.remove(temp_path)
+
+            method = self._materialise(f, temp_path)
+
+            os.replace(temp_path, target_path)
+
+            self._log.debug("Published {} to {} ({})".format(f, target_path, method))
+
+            published_files.append(target_path)
+
+        # Only remove previous copies once their replacements are in place
+        for f in self.created_files:
+            if f not in published_files and os.path.isfile(f):
+                self._log.debug("Deleting previous copy {}".format(f))
+
+                try:
+                    os.remove(f)
+                except OSError:
+                    self._log.exception("Exception raised while attempting to delete previous copy {}".format(f),
+                                        exc_info=True)
+
+        self.created_files = tuple(published_files)
+
+        return self.created_files
+
+    def _materialise(self, path, target_path):
+        # Cheapest first, a method that isn't supported is not tried again for the rest of the run
+        if 'link' not in self._unsupported:
+            try:
+                os.link(path, target_path)
+
+                return 'link'
+            except OSError as e:
+                self._failed('link', e)
+
+        with open(path, 'rb') as f_in, open(target_path, 'wb') as f_out:
+            size = os.fstat(f_in.fileno()).st_size
+
+            for method in ('reflink', 'copy_file_range', 'sendfile'):
+                if method in self._unsupported:
+                    continue
+
+                try:
+                    getattr(self, '_' + method)(f_in.fileno(), f_out.fileno(), size)
+                    self._check_size(f_out, size)
+
+                    return method
+                except (AttributeError, OSError) as e:
+                    self._failed(method, e)
+
+                    f_in.seek(0)
+                    f_out.seek(0)
+                    f_out.truncate()
+
+            shutil.copyfileobj(f_in, f_out, self._COPY_BUFFER)
+            self._check_size(f_out, size)
+
+        return 'copy'
+
+    @staticmethod
+    def _check_size(f, size):
+        # Source may have grown since it was opened but never shrinks, a shorter copy is incomplete
+        copy_size = os.fstat(f.fileno()).st_size
+
+        if copy_size < size:
+            raise OSError("Copy stopped after {} of {} bytes".format(copy_size, size))
+
+    def _failed(self, method, e):
+        if isinstance(e, AttributeError) or e.errno in self._UNSUPPORTED_ERRORS:
+            self._unsupported.add(method)
+
+            self._log.debug("Publishing with {} not supported".format(method))
+        else:
+            # Short copies and other transient errors fall back for this file only
+            self._log.debug("Publishing with {} failed: {}".format(method, e))
+
+    def _reflink(self, fd_in, fd_out, size):
+        if fcntl is None:
+            raise AttributeError('fcntl not available')
+
+        fcntl.ioctl(fd_out, self._FICLONE, fd_in)
+
+    @staticmethod
+    def _copy_file_range(fd_in, fd_out, size):
+        remaining = size
+
+        while remaining > 0:
+            n = os.copy_file_range(fd_in, fd_out, remaining)
+
+            if n == 0:
+                raise OSError("copy_file_range stopped with {} bytes remaining".format(remaining))
+
+            remaining -= n
+
+    @staticmethod
+    def _sendfile(fd_in, fd_out, size):
+        offset = 0
+
+        while offset < size:
+            n = os.sendfile(fd_out, fd_in, offset, size - offset)
+
+            if n == 0:
+                raise OSError("sendfile stopped with {} bytes remaining".format(size - offset))
+
+            offset += n
+
 
 class ZipPostExporter(PostExporter):
+    """
+    Keeps a zip archive of exported files open for the whole run, appending only new or changed content
+    """
+
     EXTENSION = 'zip'
 
-    def __init__(self, result_directory):
+    DEFAULT_CHECKPOINT_INTERVAL = 60.0
+    DEFAULT_SEGMENT_SIZE = 1024 * 1024
+
+    _COMPRESSION = {
+        'stored': zipfile.ZIP_STORED,
+        'deflated': zipfile.ZIP_DEFLATED,
+        'bzip2': zipfile.ZIP_BZIP2,
+        'lzma': zipfile.ZIP_LZMA
+    }
+
+    # Segment members hold the bytes of a growing file from the offset in their comment
+    _SEGMENT_FORMAT = '{}.{:04d}'
+    _OFFSET_COMMENT = 'offset={}'
+
+    _COPY_BUFFER = 1024 * 1024
+
+    def __init__(self, result_directory, compression=None, checkpoint_interval=None, segment_size=None):
         super().__init__(result_directory)
 
         self._zip_filename = result_directory + '.' + self.EXTENSION
 
+        if compression is not None and compression not in self._COMPRESSION:
+            raise PostExporterException("Unknown zip compression {}".format(compression))
+
+        self._compression = self._COMPRESSION[compression] if compression else zipfile.ZIP_STORED
+
+        # Re-open the archive every checkpoint_interval seconds so a valid one is left on disk
+        self._checkpoint_interval = checkpoint_interval if checkpoint_interval is not None \
+            else self.DEFAULT_CHECKPOINT_INTERVAL
+
+        # Growth of a file already in the archive is held back until there is at least segment_size bytes of it
+        self._segment_size = segment_size if segment_size is not None else self.DEFAULT_SEGMENT_SIZE
+
+        self._zip = None
+        self._names = set()
+        self._files = {}
+        self._dirty = set()
+        self._checkpoint_time = time.time()
+
+        # Statistics
+        self._bytes = 0
+        self._bytes_checkpoint = 0
+        self._start_time = time.time()
+
     def process(self, exported_files):
-        with zipfile.ZipFile(self._zip_filename, 'a') as result_zip:
-            for f in exported_files:
-                result_zip.write(f)
+        if self._zip is None:
+            self._open()
 
-        self._log.info("Updated {}".format(self._zip_filename))
+        for f in exported_files:
+            self._update(f, False)
+
+        if time.time() - self._checkpoint_time >= self._checkpoint_interval:
+            self._checkpoint()
 
         return self._zip_filename,
+
+    def close(self):
+        if self._zip is None:
+            return
+
+        self._flush()
+
+        self._zip.close()
+        self._zip = None
+
+        elapsed = time.time() - self._start_time
+
+        self._log.info("Archived {} bytes to {} ({:.0f} bytes/s)".format(
+            self._bytes, self._zip_filename, self._bytes / elapsed if elapsed > 0 else 0.0))
+
+    # Rebuild archived files from their segments
+    @classmethod
+    def reassemble(cls, zip_filename, target_directory):
+        files = []
+
+        with zipfile.ZipFile(zip_filename, 'r') as archive:
+            # Members are in write order, a segment at offset 0 starts a new copy of the file
+            for info in archive.infolist():
+                (name, offset) = cls._parse_member(info)
+                target_path = os.path.join(target_directory, name)
+
+                os.makedirs(os.path.dirname(target_path), exist_ok=True)
+
+                with archive.open(info, 'r') as f_in, open(target_path, 'r+b' if offset else 'wb') as f_out:
+                    f_out.seek(offset)
+                    f_out.truncate()
+
+                    shutil.copyfileobj(f_in, f_out, cls._COPY_BUFFER)
+
+                if target_path not in files:
+                    files.append(target_path)
+
+        return files
+
+    @classmethod
+    def _parse_member(cls, info):
+        comment = info.comment.decode()
+
+        if comment.startswith(cls._OFFSET_COMMENT.format('')):
+            return info.filename.rsplit('.', 1)[0], int(comment[len(cls._OFFSET_COMMENT.format('')):])
+
+        return info.filename, 0
+
+    def _open(self):
+        self._zip = zipfile.ZipFile(self._zip_filename, 'a', compression=self._compression)
+
+        # Existing members are never replaced, e.g. when a run is resumed
+        self._names = set(self._zip.namelist())
+
+    def _update(self, path, flush):
+        stat = os.stat(path)
+        identity = (stat.st_dev, stat.st_ino)
+
+        state = self._files.get(path)
+
+        if state is not None and state['identity'] == identity and state['mtime'] == stat.st_mtime_ns and \
+                state['offset'] == stat.st_size:
+            # Unchanged since it was last archived
+            self._dirty.discard(path)
+            return
+
+        if state is None or state['identity'] != identity or stat.st_size <= state['offset']:
+            # New, replaced, truncated or rewritten in place, archive all of it
+            offset = 0
+        elif not flush and stat.st_size - state['offset'] < self._segment_size:
+            # Small amount of growth, wait for more
+            self._dirty.add(path)
+            return
+        else:
+            offset = state['offset']
+
+        self._write(path, offset, stat.st_size)
+
+        self._files[path] = {
+            'identity': identity,
+            'mtime': stat.st_mtime_ns,
+            'offset': stat.st_size
+        }
+
+        self._dirty.discard(path)
+
+    def _write(self, path, offset, size):
+        info = zipfile.ZipInfo.from_file(path)
+        name = info.filename
+
+        if offset or name in self._names:
+            # Appended bytes, or a new copy of a file already in the archive
+            n = 1
+
+            while self._SEGMENT_FORMAT.format(name, n) in self._names:
+                n += 1
+
+            info.filename = self._SEGMENT_FORMAT.format(name, n)
+            info.comment = self._OFFSET_COMMENT.format(offset).encode()
+
+        info.compress_type = self._compression
+        info.file_size = size - offset
+
+        # Only the bytes present when the file was checked, later growth is picked up next time
+        with open(path, 'rb') as f_in, self._zip.open(info, 'w', force_zip64=size - offset > 2 ** 31) as f_out:
+            f_in.seek(offset)
+            remaining = size - offset
+
+            while remaining > 0:
+                buffer = f_in.read(min(self._COPY_BUFFER, remaining))
+
+                if not buffer:
+                    raise PostExporterException("{} shrank while being archived".format(path))
+
+                f_out.write(buffer)
+                remaining -= len(buffer)
+
+        self._names.add(info.filename)
+        self._bytes += size - offset
+
+        self._log.debug("Archived {} bytes of {} as {}".format(size - offset, path, info.filename))
+
+    def _flush(self):
+        for path in list(self._dirty):
+            if os.path.isfile(path):
+                self._update(path, True)
+            else:
+                self._dirty.discard(path)
+
+    def _checkpoint(self):
+        self._flush()
+
+        # Closing writes the central directory, re-opening reads it back once
+        self._zip.close()
+        self._open()
+
+        now = time.time()
+        elapsed = now - self._checkpoint_time
+
+        self._log.info("Updated {}, {:.0f} bytes/s".format(
+            self._zip_filename, (self._bytes - self._bytes_checkpoint) / elapsed if elapsed > 0 else 0.0))
+
+        self._bytes_checkpoint = self._bytes
+        self._checkpoint_time = now
+
+
+class CompressPostExporter(PostExporter):
+    """
+    Compresses exported files with gzip in a pool of worker processes
+    """
+
+    EXTENSION = 'gz'
+
+    REPLACES_FILES = True
+
+    DEFAULT_LEVEL = 6
+
+    # Exporters that append to a single file for the whole run (e.g. CSV) shouldn't be compressed per capture
+    DEFAULT_FILE_EXTENSIONS = ('mat', 'txt')
+
+    def __init__(self, result_directory, level=None, file_extensions=None, keep=False, workers=None,
+                 max_pending=None):
+        super().__init__(result_directory)
+
+        self._level = level if level is not None else self.DEFAULT_LEVEL
+        self._file_extensions = tuple(file_extensions) if file_extensions is not None \
+            else self.DEFAULT_FILE_EXTENSIONS
+        self._keep = keep
+        self._workers = workers if workers else os.cpu_count()
+
+        # Bound the number of files waiting for a worker, process() blocks on the oldest beyond this
+        self._max_pending = max_pending if max_pending else 4 * self._workers
+
+        self._pool = None
+        self._pending = []
+        self._submitted = set()
+
+        # Statistics
+        self._files = 0
+        self._input_size = 0
+        self._output_size = 0
+
+        self._log.info("Compressing {} files with {} worker{}, level {}".format(
+            ', '.join(self._file_extensions), self._workers, 's' if self._workers != 1 else '', self._level))
+
+    def process(self, exported_files):
+        # Files that aren't compressed, or are kept, are passed on unchanged
+        forwarded_files = []
+
+        for f in exported_files:
+            extension = os.path.splitext(f)[1].lstrip('.')
+
+            if extension not in self._file_extensions or self._keep:
+                forwarded_files.append(f)
+
+            # Each file is compressed once, however many captures report it
+            if extension not in self._file_extensions or f in self._submitted:
+                continue
+
+            if self._pool is None:
+                self._pool = concurrent.futures.ProcessPoolExecutor(max_workers=self._workers)
+
+            self._submitted.add(f)
+            self._pending.append(self._pool.submit(_compress_file, f, self._level, self._keep))
+
+        renamed_files = []
+
+        # Collect finished files without waiting, in submission order
+        while self._pending and (self._pending[0].done() or len(self._pending) > self._max_pending):
+            renamed_files.append(self._complete(self._pending.pop(0)))
+
+        return self._forward(forwarded_files, renamed_files)
+
+    def close(self):
+        if self._pool is None:
+            return None
+
+        renamed_files = []
+
+        try:
+            while self._pending:
+                renamed_files.append(self._complete(self._pending.pop(0)))
+        finally:
+            self._pool.shutdown()
+            self._pool = None
+
+        if self._files:
+            self._log.info("Compressed {} file{}, {} to {} bytes ({:.1%})".format(
+                self._files, 's' if self._files != 1 else '', self._input_size, self._output_size,
+                self._output_size / float(self._input_size) if self._input_size else 1.0))
+
+        return self._forward([], renamed_files)
+
+    def _forward(self, forwarded_files, renamed_files):
+        self.renamed_files = () if self._keep else tuple(renamed_files)
+
+        return tuple(forwarded_files) + tuple(target_path for (_, target_path) in renamed_files)
+
+    def _complete(self, future):
+        try:
+            (path, target_path, input_size, output_size) = future.result()
+        except Exception as e:
+            raise PostExporterException('Compression failed') from e
+
+        self._submitted.discard(path)
+
+        self._files += 1
+        self._input_size += input_size
+        self._output_size += output_size
+
+        self._log.debug("Compressed {} to {}".format(path, target_path))
+
+        return path, target_path
+
+
+def _compress_file(path, level, keep):
+    # Runs in a worker process, compress to a temporary file first so the result appears atomically
+    target_path = path + '.' + CompressPostExporter.EXTENSION
+    temp_path = target_path + '.tmp'
+
+    with open(path, 'rb') as f_in, gzip.open(temp_path, 'wb', compresslevel=level) as f_out:
+        shutil.copyfileobj(f_in, f_out, 1024 * 1024)
+
+    os.replace(temp_path, target_path)
+
+    input_size = os.path.getsize(path)
+
+    if not keep:
+        os.remove(path)
+
+    return path, target_path, input_size, os.path.getsize(target_path)
+
+
+def forward_files(post_exporter, exported_files, processed_files):
+    # Files handed on to the next post-exporter in the chain
+    if post_exporter.REPLACES_FILES:
+        return tuple(processed_files) if processed_files else ()
+
+    return exported_files
+
+
+class PostExportPool(object):
+    """
+    Runs post-exporters on worker threads, coalescing repeated requests for the same file
+    """
+
+    DEFAULT_RETRIES = 3
+    DEFAULT_BACKOFF = 0.5
+
+    # Transient I/O errors are retried, anything else fails the post-exporter straight away
+    _RETRY_EXCEPTIONS = (OSError,)
+
+    def __init__(self, post_export_modules, workers=None, retries=None, backoff=None, histograms=None,
+                 forward=None):
+        self._post_export_modules = post_export_modules
+        self._forward = forward if forward else forward_files
+        self._retries = retries if retries is not None else self.DEFAULT_RETRIES
+        self._backoff = backoff if backoff is not None else self.DEFAULT_BACKOFF
+        self._histograms = histograms
+
+        # Each post-exporter only ever runs on one worker at a time, so workers beyond one per module are idle
+        self._workers = workers if workers else len(post_export_modules)
+
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=max(self._workers, 1),
+                                                               thread_name_prefix='post-export')
+
+        self._lock = threading.Lock()
+        self._changed = threading.Condition(self._lock)
+
+        # Batches run concurrently only when they share no paths, in order per post-exporter
+        self._queue = collections.deque()
+        self._active = set()
+        self._running = 0
+        self._sequence = 0
+        self._module_sequence = [0] * len(post_export_modules)
+        self._failure = pipeline.WorkerFailure(PostExporterException, 'Post-export failed')
+
+        # Statistics
+        self._requested = 0
+        self._processed = 0
+
+        self._log = logging.getLogger(type(self).__name__)
+        self._log.info("Post-export pool: {} worker{}, {} retr{} with {} s backoff".format(
+            self._workers, 's' if self._workers != 1 else '', self._retries, 'ies' if self._retries != 1 else 'y',
+            self._backoff))
+
+    def check(self):
+        self._failure.check()
+
+    def submit(self, exported_files):
+        self.check()
+
+        if not exported_files:
+            return
+
+        batch = collections.OrderedDict.fromkeys(exported_files)
+
+        with self._lock:
+            self._requested += len(batch)
+
+            # Paths still waiting in an earlier batch are only processed once, with this batch
+            for queued in self._queue:
+                for f in batch:
+                    queued.pop(f, None)
+
+            self._queue = collections.deque(queued for queued in self._queue if queued)
+            self._queue.append(batch)
+
+            self._dispatch()
+
+    def shutdown(self):
+        # Wait for every pending path to be processed before returning
+        with self._lock:
+            while self._queue or self._running:
+                self._changed.wait()
+
+        self._executor.shutdown()
+
+        self._log.info("Post-export pool: {} requested, {} processed".format(self._requested, self._processed))
+
+        self.check()
+
+    def _dispatch(self):
+        # Called with the lock held, batches start in order so one waiting on a busy path holds back later ones
+        while self._queue and self._running < self._workers:
+            if self._failure.is_set():
+                self._queue.clear()
+                self._changed.notify_all()
+                return
+
+            if not self._active.isdisjoint(self._queue[0]):
+                return
+
+            paths = tuple(self._queue.popleft())
+
+            self._active.update(paths)
+            self._running += 1
+
+            self._executor.submit(self._run, self._sequence, paths)
+            self._sequence += 1
+
+    def _run(self, sequence, paths):
+        files = paths
+
+        for (n, post_exporter) in enumerate(self._post_export_modules):
+            with self._lock:
+                while self._module_sequence[n] != sequence:
+                    self._changed.wait()
+
+                failed = self._failure.is_set()
+
+            try:
+                if not failed:
+                    start_time = time.perf_counter()
+
+                    files = self._forward(post_exporter, files, self._process(post_exporter, files))
+
+                    if self._histograms:
+                        self._histograms[n].add(time.perf_counter() - start_time)
+            except Exception as e:
+                self._log.exception("Exception in {}".format(type(post_exporter).__name__), exc_info=True)
+                self._failure.set(e)
+            finally:
+                with self._lock:
+                    self._module_sequence[n] += 1
+                    self._changed.notify_all()
+
+        with self._lock:
+            self._active.difference_update(paths)
+            self._running -= 1
+            self._processed += len(paths)
+
+            self._dispatch()
+            self._changed.notify_all()
+
+    def _process(self, post_exporter, paths):
+        for attempt in range(self._retries + 1):
+            try:
+                return post_exporter.process(paths)
+            except self._RETRY_EXCEPTIONS:
+                if attempt == self._retries:
+                    raise
+
+                wait = self._backoff * 2 ** attempt
+
+                self._log.warning("Retrying {} in {:.3g} s, {} attempt{} remaining".format(
+                    type(post_exporter).__name__, wait, self._retries - attempt,
+                    's' if self._retries - attempt != 1 else ''), exc_info=True)
+
+                time.sleep(wait)
+
+
+class ChunkStoreBackup(PostExporter):
+    """
+    Backs up exported files to a content-addressed store of deduplicated chunks with a manifest for each run
+    """
+
+    CHUNKING_FIXED = 'fixed'
+    CHUNKING_CONTENT = 'content'
+
+    CHUNK_DIRECTORY = 'chunks'
+    MANIFEST_DIRECTORY = 'manifests'
+
+    DEFAULT_CHUNK_SIZE = 1024 * 1024
+
+    # Content-defined boundaries are taken from a polynomial rolling hash over a window of bytes
+    _WINDOW = 48
+    _PRIME = 0x100000001b3
+
+    _READ_BUFFER = 4 * 1024 * 1024
+
+    # Rolling hash is computed over blocks of this many bytes to bound the size of intermediate arrays
+    _HASH_BLOCK = 256 * 1024
+
+    MANIFEST_SUFFIX = '.jsonl'
+
+    def __init__(self, result_directory, target_directory, chunking=None, chunk_size=None):
+        super().__init__(result_directory)
+
+        self._target_directory = target_directory
+        self._chunking = chunking if chunking else self.CHUNKING_CONTENT
+        self._chunk_size = chunk_size if chunk_size else self.DEFAULT_CHUNK_SIZE
+
+        if self._chunking not in (self.CHUNKING_FIXED, self.CHUNKING_CONTENT):
+            raise PostExporterException("Unknown chunking {}".format(self._chunking))
+
+        # Content-defined chunks average chunk_size (rounded to a power of two), between a quarter and four times it
+        self._boundary_bits = max(int(self._chunk_size).bit_length() - 1, 1)
+        self._min_size = max(self._chunk_size // 4, self._WINDOW)
+        self._max_size = self._chunk_size * 4
+
+        self._chunk_directory = os.path.join(target_directory, self.CHUNK_DIRECTORY)
+        self._run_name = os.path.basename(os.path.normpath(result_directory))
+        self._manifest_path = os.path.join(target_directory, self.MANIFEST_DIRECTORY,
+                                           self._run_name + self.MANIFEST_SUFFIX)
+
+        os.makedirs(self._chunk_directory, exist_ok=True)
+        os.makedirs(os.path.dirname(self._manifest_path), exist_ok=True)
+
+        # JSON line per file update holding only the chunks added since the previous one
+        self._manifest = None
+
+        self._files = collections.OrderedDict()
+        self._known_chunks = set()
+        self._powers = None
+
+        # Directories with renamed chunks not yet synced, synced before a manifest entry refers to the chunks
+        self._unsynced_directories = set()
+
+        # Statistics
+        self._bytes_read = 0
+        self._bytes_stored = 0
+
+    def process(self, exported_files):
+        changed = False
+
+        for f in exported_files:
+            changed |= self._backup(f)
+
+        if changed:
+            self._manifest.flush()
+            os.fsync(self._manifest.fileno())
+
+        return self._manifest_path,
+
+    def close(self):
+        if self._manifest is not None:
+            self._manifest.close()
+            self._manifest = None
+
+        if self._bytes_read:
+            self._log.info("Chunked {} bytes, stored {} new bytes ({:.1%})".format(
+                self._bytes_read, self._bytes_stored, self._bytes_stored / float(self._bytes_read)))
+
+    @classmethod
+    def restore(cls, target_directory, run_name, destination_directory):
+        # Rebuild the files of a run from the chunk store
+        files = collections.OrderedDict()
+
+        with open(os.path.join(target_directory, cls.MANIFEST_DIRECTORY, run_name + cls.MANIFEST_SUFFIX), 'r') as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    # Last line may be incomplete if the process died mid-write
+                    continue
+
+                if 'file' not in entry:
+                    continue
+
+                chunks = files.get(entry['file'], [])[:entry['keep']] + entry['chunks']
+
+                if sum(length for (_, length) in chunks) != entry['size']:
+                    raise PostExporterException("Manifest entry for {} doesn't match its size".format(entry['file']))
+
+                files[entry['file']] = chunks
+
+        paths = []
+
+        for (name, chunks) in files.items():
+            path = os.path.join(destination_directory, name)
+
+            with open(path, 'wb') as f_out:
+                for (digest, length) in chunks:
+                    with open(cls._chunk_path(target_directory, digest), 'rb') as f_in:
+                        f_out.write(f_in.read())
+
+            paths.append(path)
+
+        return paths
+
+    @classmethod
+    def _chunk_path(cls, target_directory, digest):
+        return os.path.join(target_directory, cls.CHUNK_DIRECTORY, digest[:2], digest)
+
+    def _backup(self, path):
+        stat = os.stat(path)
+        identity = [stat.st_dev, stat.st_ino]
+
+        name = os.path.basename(path)
+        entry = self._files.get(name)
+
+        if entry is not None and entry['identity'] == identity and entry['mtime'] == stat.st_mtime_ns and \
+                entry['size'] == stat.st_size:
+            # Unchanged
+            return False
+
+        chunks = []
+        offset = 0
+
+        with open(path, 'rb') as f:
+            if entry is not None and entry['identity'] == identity and stat.st_size > entry['size'] and \
+                    self._verify(f, entry['chunks']):
+                # Appended to, re-chunk from the start of the last chunk since it ended at the old end of file
+                chunks = entry['chunks'][:-1]
+                offset = sum(length for (_, length) in chunks)
+
+            keep = len(chunks)
+
+            for (digest, length) in self._chunk(f, offset, stat.st_size):
+                chunks.append([digest, length])
+
+        self._bytes_read += stat.st_size - offset
+
+        self._files[name] = {
+            'identity': identity,
+            'mtime': stat.st_mtime_ns,
+            'size': stat.st_size,
+            'chunks': chunks
+        }
+
+        self._write_manifest_entry(name, stat.st_size, keep, chunks[keep:])
+
+        return True
+
+    def _verify(self, f, chunks):
+        # Check the last complete chunk is unchanged, otherwise the file was rewritten rather than appended to
+        if len(chunks) < 2:
+            return True
+
+        (digest, length) = chunks[-2]
+        f.seek(sum(n for (_, n) in chunks[:-2]))
+
+        return hashlib.sha256(f.read(length)).hexdigest() == digest
+
+    def _chunk(self, f, offset, end):
+        f.seek(offset)
+
+        buffer = bytearray()
+        remaining = end - offset
+
+        # Read well past the largest chunk so each buffer yields several boundaries
+        read_size = max(self._max_size * 4, self._READ_BUFFER)
+
+        while remaining > 0 or buffer:
+            block = f.read(min(read_size, remaining))
+            remaining -= len(block)
+            buffer += block
+
+            final = remaining <= 0 or not block
+            start = 0
+
+            for cut in self._boundaries(buffer, final):
+                yield self._store(memoryview(buffer)[start:cut])
+                start = cut
+
+            del buffer[:start]
+
+            if final:
+                break
+
+    def _boundaries(self, buffer, final):
+        size = len(buffer)
+        cuts = []
+
+        if self._chunking == self.CHUNKING_FIXED:
+            cuts.extend(range(self._chunk_size, size + 1, self._chunk_size))
+        elif size > self._min_size:
+            candidates = self._candidates(buffer)
+            position = 0
+
+            while True:
+                n = np.searchsorted(candidates, position + self._min_size)
+
+                if n < len(candidates) and candidates[n] - position <= self._max_size:
+                    position = int(candidates[n])
+                elif size - position >= self._max_size:
+                    position += self._max_size
+                else:
+                    break
+
+                cuts.append(position)
+
+        if final and (not cuts or cuts[-1] < size) and size:
+            cuts.append(size)
+
+        return cuts
+
+    def _candidates(self, buffer):
+        # Positions where the window hash ends with a boundary, blocks overlap by the window
+        data = np.frombuffer(buffer, dtype=np.uint8)
+        shift = np.uint64(64 - self._boundary_bits)
+
+        candidates = []
+
+        for start in range(0, len(data), self._HASH_BLOCK):
+            begin = max(start - self._WINDOW + 1, 0)
+            hashes = self._window_hashes(data[begin:start + self._HASH_BLOCK])
+
+            candidates.append(np.flatnonzero(hashes >> shift == 0) + begin + 1)
+
+        return np.concatenate(candidates)
+
+    def _window_hashes(self, data):
+        # Rolling hash of the window ending at each byte, wrapping at 2 ** 64
+        n = len(data)
+
+        if self._powers is None:
+            block = self._HASH_BLOCK + self._WINDOW - 1
+            inverse = pow(self._PRIME, -1, 2 ** 64)
+
+            powers = np.cumprod(np.full(block, self._PRIME, dtype=np.uint64))
+            inverse_powers = np.cumprod(np.full(block, inverse, dtype=np.uint64))
+
+            # Start both series at the zeroth power
+            one = np.ones(1, dtype=np.uint64)
+
+            self._powers = (np.concatenate((one, powers[:-1])), np.concatenate((one, inverse_powers[:-1])))
+
+        (powers, inverse_powers) = (self._powers[0][:n], self._powers[1][:n])
+
+        prefix = np.cumsum(data.astype(np.uint64) * inverse_powers, dtype=np.uint64)
+
+        window = np.zeros(n, dtype=np.uint64)
+        window[self._WINDOW - 1] = prefix[self._WINDOW - 1]
+        window[self._WINDOW:] = prefix[self._WINDOW:] - prefix[:-self._WINDOW]
+
+        hashes = powers * window
+
+        # Windows that run past the start of the buffer aren't used
+        hashes[:self._WINDOW - 1] = np.uint64(2 ** 64 - 1)
+
+        return hashes
+
+    def _store(self, data):
+        digest = hashlib.sha256(data).hexdigest()
+
+        if digest not in self._known_chunks:
+            path = self._chunk_path(self._target_directory, digest)
+
+            if not os.path.exists(path):
+                directory = os.path.dirname(path)
+
+                if not os.path.isdir(directory):
+                    os.makedirs(directory, exist_ok=True)
+                    self._unsynced_directories.add(self._chunk_directory)
+
+                # Write under a temporary name so a partial chunk is never taken as stored
+                with open(path + '.tmp', 'wb') as f:
+                    f.write(data)
+                    f.flush()
+                    os.fsync(f.fileno())
+
+                os.replace(path + '.tmp', path)
+                self._unsynced_directories.add(directory)
+
+                self._bytes_stored += len(data)
+
+            self._known_chunks.add(digest)
+
+        return digest, len(data)
+
+    def _write_manifest_entry(self, name, size, keep, chunks):
+        # Chunk renames must be on disk before the manifest can be
+        for directory in self._unsynced_directories:
+            descriptor = os.open(directory, os.O_RDONLY)
+
+            try:
+                os.fsync(descriptor)
+            finally:
+                os.close(descriptor)
+
+        self._unsynced_directories.clear()
+
+        if self._manifest is None:
+            new = not os.path.isfile(self._manifest_path) or not os.path.getsize(self._manifest_path)
+
+            self._manifest = open(self._manifest_path, 'a')
+
+            if new:
+                self._manifest.write(json.dumps(collections.OrderedDict([
+                    ('run', self._run_name),
+                    ('chunking', self._chunking),
+                    ('chunk_size', self._chunk_size)
+                ])) + '\n')
+
+        # Restored as the first keep chunks of the previous entry for the file followed by these chunks
+        self._manifest.write(json.dumps(collections.OrderedDict([
+            ('file', name),
+            ('size', size),
+            ('keep', keep),
+            ('chunks', chunks)
+        ])) + '\n')
@@ -0,0 +1,246 @@
+import array
+import collections
+import collections.abc
+import logging
+
+__author__ = 'chris'
+
+
+class RecordException(Exception):
+    pass
+
+
+# Placeholder for fields a record doesn't have, None is a valid captured value
+_MISSING = object()
+
+
+class Schema(object):
+    """
+    Ordered field names shared by every record built with the same set of keys
+    """
+
+    def __init__(self, fields):
+        self.fields = tuple(fields)
+        self.index = {f: i for (i, f) in enumerate(self.fields)}
+
+        if len(self.index) != len(self.fields):
+            raise RecordException('Schema fields must be unique')
+
+    def __len__(self):
+        return len(self.fields)
+
+    def extend(self, fields):
+        return Schema(self.fields + tuple(f for f in fields if f not in self.index))
+
+
+class RecordBatch(object):
+    """
+    Fixed capacity block of records stored by column, numeric scalar columns are array backed
+    """
+
+    DEFAULT_SIZE = 256
+
+    def __init__(self, schema, size=None):
+        self.schema = schema
+        self.size = size if size else self.DEFAULT_SIZE
+        self.columns = [None] * len(schema)
+        self.rows = 0
+
+    def __len__(self):
+        return self.rows
+
+    def is_full(self):
+        return self.rows >= self.size
+
+    def append(self, mappings):
+        # Later mappings override earlier ones, returns None if a key isn't in the schema
+        if self.is_full():
+            raise RecordException('Record batch is full')
+
+        index = self.schema.index
+        row = self.rows
+        written = 0
+
+        for mapping in mappings:
+            for (key, value) in mapping.items():
+                i = index.get(key)
+
+                if i is None:
+                    self._truncate(row)
+                    return None
+
+                if self._length(i) > row:
+                    self._replace(i, row, value)
+                else:
+                    self._append_value(i, value)
+                    written += 1
+
+        if written < len(self.columns):
+            # Fields missing from this record are marked absent
+            for i in range(len(self.columns)):
+                if self._length(i) == row:
+                    self._append_value(i, _MISSING)
+
+        self.rows += 1
+
+        return row
+
+    def column(self, name):
+        return self.columns[self.schema.index[name]]
+
+    def _length(self, i):
+        column = self.columns[i]
+
+        return len(column) if column is not None else 0
+
+    def _append_value(self, i, value):
+        column = self.columns[i]
+
+        if column is None:
+            # Column type is chosen from the first value
+            self.columns[i] = self._create_column(value)
+        elif type(column) is list:
+            column.append(value)
+        else:
+            try:
+                if type(value) is not (float if column.typecode == 'd' else int):
+                    raise TypeError()
+
+                column.append(value)
+            except (TypeError, OverflowError):
+                # Value doesn't fit the typed column, fall back to a list
+                self.columns[i] = list(column) + [value]
+
+    def _replace(self, i, row, value):
+        column = self.columns[i]
+
+        if type(column) is not list and type(value) is not (float if column.typecode == 'd' else int):
+            column = self.columns[i] = list(column)
+
+        column[row] = value
+
+    def _truncate(self, row):
+        for (i, column) in enumerate(self.columns):
+            if row == 0:
+                self.columns[i] = None
+            elif column is not None and len(column) > row:
+                del column[row:]
+
+    @staticmethod
+    def _create_column(value):
+        # bool is a subclass of int but should keep its type, so compare types exactly
+        if type(value) is float:
+            return array.array('d', [value])
+        elif type(value) is int and -2 ** 63 <= value < 2 ** 63:
+            return array.array('q', [value])
+        else:
+            return [value]
+
+
+class Record(collections.abc.Mapping):
+    """
+    Read-only mapping view of a single row in a record batch
+    """
+
+    __slots__ = ('batch', 'row')
+
+    def __init__(self, batch, row):
+        self.batch = batch
+        self.row = row
+
+    @property
+    def schema(self):
+        return self.batch.schema
+
+    def __getitem__(self, key):
+        value = self.batch.columns[self.batch.schema.index[key]][self.row]
+
+        if value is _MISSING:
+            raise KeyError(key)
+
+        return value
+
+    def __contains__(self, key):
+        i = self.batch.schema.index.get(key)
+
+        return i is not None and self.batch.columns[i][self.row] is not _MISSING
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __len__(self):
+        return len(self.keys())
+
+    def get(self, key, default=None):
+        i = self.batch.schema.index.get(key)
+
+        if i is None:
+            return default
+
+        value = self.batch.columns[i][self.row]
+
+        return default if value is _MISSING else value
+
+    def keys(self):
+        row = self.row
+
+        return tuple(f for (f, c) in zip(self.batch.schema.fields, self.batch.columns) if c[row] is not _MISSING)
+
+    def values(self):
+        row = self.row
+
+        return [c[row] for c in self.batch.columns if c[row] is not _MISSING]
+
+    def items(self):
+        row = self.row
+
+        return [(f, c[row]) for (f, c) in zip(self.batch.schema.fields, self.batch.columns) if c[row] is not _MISSING]
+
+    def to_dict(self):
+        return dict(self.items())
+
+
+class RecordBuilder(object):
+    """
+    Packs per-capture data into record batches, reusing the schema for as long as the fields don't change
+    """
+
+    def __init__(self, batch_size=None):
+        self._batch_size = batch_size
+        self._schema = None
+        self._batch = None
+
+        self._log = logging.getLogger(type(self).__name__)
+
+    def get_schema(self):
+        return self._schema
+
+    def build(self, parts):
+        # Parts are the mappings making up one capture, combined with the same precedence as dict.update
+        if self._schema is not None:
+            if self._batch.is_full():
+                self._batch = RecordBatch(self._schema, self._batch_size)
+
+            row = self._batch.append(parts)
+
+            if row is not None:
+                return Record(self._batch, row)
+
+        fields = collections.OrderedDict()
+
+        for part in parts:
+            fields.update((k, None) for k in part)
+
+        if self._schema is None:
+            self._schema = Schema(fields)
+
+            self._log.debug("Record schema: {} field{}".format(len(self._schema),
+                                                               's' if len(self._schema) != 1 else ''))
+        else:
+            self._schema = self._schema.extend(fields)
+
+            self._log.warning("Record schema changed, now {} fields".format(len(self._schema)))
+
+        self._batch = RecordBatch(self._schema, self._batch_size)
+
+        return Record(self._batch, self._batch.append(parts))
@@ -0,0 +1,7 @@
+import os
+import sys
+
+__author__ = 'chris'
+
+# Modules live at the repository root rather than in an installed package
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,280 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+import scipy.io as sio
+
+import acquisition
+import capture
+import catalog
+import checkpoint
+import experiment
+import exporter
+import post_export
+
+__author__ = 'chris'
+
+
+class _Node(object):
+    def __init__(self, experiment, children=None):
+        self.experiment = experiment
+        self.children = children
+
+
+class _StopExperiment(experiment.RepeatExperiment):
+    def __init__(self, label, maximum, fail=False):
+        super().__init__(label, maximum)
+
+        self._fail = fail
+        self.stopped = False
+
+    def _get_state(self):
+        return {'count': self._count}
+
+    def _primary_key_field(self):
+        return 'count'
+
+    def stop(self):
+        self.stopped = True
+
+        if self._fail:
+            raise experiment.ExperimentException('Stop failed')
+
+
+class _RecordingPostExporter(post_export.PostExporter):
+    def __init__(self, result_directory):
+        super().__init__(result_directory)
+
+        self.files = []
+        self.closed = False
+
+    def process(self, exported_files):
+        if self.closed:
+            raise AssertionError('Post-exporter used after close')
+
+        self.files.extend((f, os.path.getsize(f)) for f in exported_files)
+
+    def close(self):
+        self.closed = True
+
+
+class _FailingCloseExporter(exporter.Exporter):
+    def __init__(self, message):
+        super().__init__('', '', '')
+
+        self._message = message
+
+    def export(self, capture_id, export_data):
+        return None
+
+    def close(self):
+        raise IOError(self._message)
+
+
+class AcquisitionStopTest(unittest.TestCase):
+    def setUp(self):
+        self._directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self._directory)
+
+    def test_stop_runs_every_step_and_raises_first_error(self):
+        experiments = [_StopExperiment('a', 1, fail=True), _StopExperiment('b', 1)]
+        journal = checkpoint.CheckpointJournal(self._directory)
+
+        acquisition_loop = acquisition.Acquisition([_Node(experiments[0], [_Node(experiments[1])])], [],
+                                                   export_modules=[_FailingCloseExporter('first'),
+                                                                   _FailingCloseExporter('second')],
+                                                   checkpoint_journal=journal)
+        acquisition_loop.run()
+
+        with self.assertRaises(experiment.ExperimentException):
+            acquisition_loop.stop()
+
+        self.assertTrue(all(e.stopped for e in experiments))
+        self.assertEqual(len(checkpoint.CheckpointJournal.load(self._directory)['state']), 2)
+
+
+class AcquisitionSchemaTest(unittest.TestCase):
+    def setUp(self):
+        self._directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self._directory)
+
+    def test_sequential_experiments_with_different_fields(self):
+        export_module = exporter.MatfileExporter(self._directory)
+
+        # Each top-level experiment adds its own state fields, so captures from the two have different schemas
+        acquisition_loop = acquisition.Acquisition([_Node(_StopExperiment('first', 2)),
+                                                    _Node(_StopExperiment('second', 2))],
+                                                   [capture.RandomCapture('random')],
+                                                   export_modules=[export_module])
+
+        try:
+            acquisition_loop.run()
+        finally:
+            acquisition_loop.stop()
+
+        data = [sio.loadmat(os.path.join(self._directory, f)) for f in sorted(os.listdir(self._directory))
+                if f.endswith('.mat')]
+
+        self.assertEqual(len(data), 4)
+        self.assertEqual(sum('first_count' in d for d in data), 2)
+        self.assertEqual(sum('second_count' in d for d in data), 2)
+        self.assertFalse(any('first_count' in d and 'second_count' in d for d in data))
+
+
+class AcquisitionCloseFilesTest(unittest.TestCase):
+    def setUp(self):
+        self._directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self._directory)
+
+    def _run(self, export_module):
+        post_export_module = _RecordingPostExporter(self._directory)
+
+        acquisition_loop = acquisition.Acquisition([_Node(_StopExperiment('repeat', 3))],
+                                                   [capture.RandomCapture('random')],
+                                                   export_modules=[export_module],
+                                                   post_export_modules=[post_export_module])
+
+        try:
+            acquisition_loop.run()
+        finally:
+            acquisition_loop.stop()
+
+        # Last time each file was post-exported must match its final size
+        sizes = dict(post_export_module.files)
+
+        for (f, size) in sizes.items():
+            self.assertEqual(size, os.path.getsize(f))
+
+        return sizes
+
+    def test_aggregate_matfile_post_exported(self):
+        sizes = self._run(exporter.MatfileExporter(self._directory, aggregate=10))
+
+        self.assertEqual(len(sizes), 1)
+        self.assertEqual(sio.loadmat(list(sizes)[0])['random_number'].shape[0], 3)
+
+    def test_background_aggregate_matfile_post_exported(self):
+        sizes = self._run(exporter.BackgroundExporterWrapper('MatfileExporter', result_directory=self._directory,
+                                                             aggregate=10))
+
+        self.assertEqual(len(sizes), 1)
+
+    def test_buffered_rows_post_exported(self):
+        sizes = self._run(exporter.CSVExporter(self._directory, flush_rows=None))
+
+        self.assertEqual(len(sizes), 1)
+
+        with open(list(sizes)[0]) as f:
+            self.assertEqual(len(f.readlines()), 4)
+
+
+class AcquisitionBackgroundExportTest(unittest.TestCase):
+    def setUp(self):
+        self._directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self._directory)
+
+    def _create(self, export_directory, pipeline_config=None):
+        export_module = exporter.BackgroundExporterWrapper('MatfileExporter', result_directory=export_directory)
+
+        return acquisition.Acquisition([_Node(_StopExperiment('repeat', 4))], [capture.RandomCapture('random')],
+                                       export_modules=[export_module],
+                                       post_export_modules=[_RecordingPostExporter(self._directory)],
+                                       checkpoint_journal=checkpoint.CheckpointJournal(self._directory),
+                                       catalog_index=catalog.CatalogIndex(self._directory),
+                                       pipeline_config=pipeline_config)
+
+    def _check_credited(self, pipeline_config):
+        acquisition_loop = self._create(self._directory, pipeline_config)
+
+        try:
+            acquisition_loop.run()
+        finally:
+            acquisition_loop.stop()
+
+        captures = catalog.CatalogIndex.open(self._directory).find()
+
+        self.assertEqual(len(captures), 4)
+
+        for c in captures:
+            files = c['files']['MatfileExporter']
+
+            self.assertEqual(len(files), 1)
+            self.assertIn(c['cap_id'][-8:], os.path.basename(files[0]))
+
+        self.assertEqual(checkpoint.CheckpointJournal.load(self._directory)['capture'], 4)
+
+    def test_files_credited_to_their_capture(self):
+        self._check_credited(None)
+
+    def test_files_credited_to_their_capture_in_pipeline(self):
+        self._check_credited({})
+
+    def test_unwritten_captures_not_checkpointed(self):
+        acquisition_loop = self._create(os.path.join(self._directory, 'missing'))
+
+        with self.assertRaises(Exception):
+            try:
+                acquisition_loop.run()
+            finally:
+                acquisition_loop.stop()
+
+        with self.assertRaises(checkpoint.CheckpointException):
+            checkpoint.CheckpointJournal.load(self._directory)
+
+
+class AcquisitionCompressTest(unittest.TestCase):
+    def setUp(self):
+        self._directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self._directory)
+
+    def _run(self, post_export_pool_config):
+        post_export_module = _RecordingPostExporter(self._directory)
+        catalog_index = catalog.CatalogIndex(self._directory)
+
+        acquisition_loop = acquisition.Acquisition([_Node(_StopExperiment('repeat', 5))],
+                                                   [capture.RandomCapture('random')],
+                                                   export_modules=[exporter.MatfileExporter(self._directory)],
+                                                   post_export_modules=[
+                                                       post_export.CompressPostExporter(self._directory, workers=1),
+                                                       post_export_module],
+                                                   catalog_index=catalog_index,
+                                                   post_export_pool_config=post_export_pool_config)
+
+        try:
+            acquisition_loop.run()
+        finally:
+            acquisition_loop.stop()
+
+        # Later post-exporters only see the compressed files
+        recorded = sorted(set(f for (f, _) in post_export_module.files))
+
+        self.assertEqual(len(recorded), 5)
+        self.assertTrue(all(f.endswith('.mat.gz') for f in recorded))
+
+        # Catalog follows the rename
+        captures = catalog.CatalogIndex.open(self._directory).find()
+        files = sorted(f for c in captures for f in c['files']['MatfileExporter'])
+
+        self.assertEqual([os.path.realpath(f) for f in files], [os.path.realpath(f) for f in recorded])
+        self.assertTrue(all(os.path.isfile(f) for f in files))
+
+    def test_compressed_files_passed_on(self):
+        self._run(None)
+
+    def test_compressed_files_passed_on_in_pool(self):
+        self._run({})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,116 @@
+import threading
+import time
+import unittest
+
+import capture
+import hardware
+
+__author__ = 'chris'
+
+
+class _TimedCapture(capture.Capture):
+    # Records how many captures are running at once, overall and per connector
+    _counter_lock = threading.Lock()
+
+    def __init__(self, label, connector, counters, value=None, delay=0.05):
+        super().__init__(label)
+
+        self._connector = connector
+        self._counters = counters
+        self._value = value if value is not None else label
+        self._delay = delay
+
+    def get_connectors(self):
+        return self._connector,
+
+    def _get_data(self, experiment_stack):
+        keys = ('all', self._connector.get_root())
+
+        with self._counter_lock:
+            for k in keys:
+                self._counters['active'][k] = self._counters['active'].get(k, 0) + 1
+                self._counters['peak'][k] = max(self._counters['peak'].get(k, 0), self._counters['active'][k])
+
+        time.sleep(self._delay)
+
+        with self._counter_lock:
+            for k in keys:
+                self._counters['active'][k] -= 1
+
+        return {
+            'value': self._value
+        }
+
+
+class _FailingCapture(capture.Capture):
+    def get_connectors(self):
+        return ()
+
+    def _get_data(self, experiment_stack):
+        raise capture.CaptureException('Instrument not responding')
+
+
+class ParallelCaptureRunnerTest(unittest.TestCase):
+    def setUp(self):
+        self._counters = {'active': {}, 'peak': {}}
+        self._runners = []
+
+    def tearDown(self):
+        for runner in self._runners:
+            runner.shutdown()
+
+    def _runner(self, modules, **kwargs):
+        runner = capture.ParallelCaptureRunner(modules, **kwargs)
+        self._runners.append(runner)
+
+        return runner
+
+    def test_separate_connectors_run_concurrently(self):
+        modules = [_TimedCapture("c{}".format(n), hardware.SimulatedConnector("c{}".format(n)), self._counters)
+                   for n in range(4)]
+
+        data = self._runner(modules).get_data([])
+
+        self.assertEqual(data, {"c{}_value".format(n): "c{}".format(n) for n in range(4)})
+        self.assertEqual(self._counters['peak']['all'], 4)
+
+    def test_shared_connector_serialised(self):
+        shared = hardware.SimulatedConnector('bus')
+        other = hardware.SimulatedConnector('other')
+
+        modules = [_TimedCapture('a', shared, self._counters), _TimedCapture('b', other, self._counters),
+                   _TimedCapture('c', shared, self._counters)]
+
+        self._runner(modules).get_data([])
+
+        self.assertEqual(self._counters['peak'][shared], 1)
+        self.assertEqual(self._counters['peak']['all'], 2)
+
+    def test_overlapping_keys_merge_in_module_order(self):
+        # Slowest module finishes last but is first in the configuration
+        modules = [_TimedCapture('x', hardware.SimulatedConnector('a'), self._counters, value=1, delay=0.1),
+                   _TimedCapture('x', hardware.SimulatedConnector('b'), self._counters, value=2, delay=0.0)]
+
+        self.assertEqual(self._runner(modules).get_data([]), {'x_value': 2})
+
+    def test_worker_limit(self):
+        modules = [_TimedCapture("c{}".format(n), hardware.SimulatedConnector("c{}".format(n)), self._counters)
+                   for n in range(4)]
+
+        self._runner(modules, workers=2).get_data([])
+
+        self.assertEqual(self._counters['peak']['all'], 2)
+
+    def test_undeclared_connectors_rejected(self):
+        with self.assertRaises(capture.CaptureException):
+            capture.ParallelCaptureRunner([capture.Capture('undeclared')])
+
+    def test_capture_exception_raised(self):
+        modules = [_TimedCapture('a', hardware.SimulatedConnector('a'), self._counters), _FailingCapture('b')]
+
+        with self.assertRaises(capture.CaptureException):
+            self._runner(modules).get_data([])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,67 @@
+import os
+import shutil
+import sqlite3
+import tempfile
+import unittest
+
+import catalog
+
+__author__ = 'chris'
+
+
+class CatalogIndexTest(unittest.TestCase):
+    def setUp(self):
+        self._directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self._directory)
+
+    def test_find_by_key(self):
+        index = catalog.CatalogIndex(self._directory)
+
+        for n in range(1, 4):
+            index.add("{:064x}".format(n), n, float(n), {'flow_step': n % 2},
+                      [('CSVExporter', [os.path.join(self._directory, 'a.csv')])])
+
+        index.close()
+
+        reader = catalog.CatalogIndex.open(self._directory)
+
+        self.assertEqual([r['cap_index'] for r in reader.find({'flow_step': 1})], [1, 3])
+        self.assertEqual(reader.find({'flow_step': 0})[0]['files'],
+                         {'CSVExporter': [os.path.join(self._directory, 'a.csv')]})
+
+        reader.close()
+
+    def test_open_is_read_only(self):
+        catalog.CatalogIndex(self._directory).close()
+
+        reader = catalog.CatalogIndex.open(self._directory)
+
+        with self.assertRaises(sqlite3.OperationalError):
+            reader.add('0' * 64, 1, 0.0, {}, [])
+
+        reader.close()
+
+    def test_read_while_writing(self):
+        index = catalog.CatalogIndex(self._directory, commit_records=2)
+
+        for n in range(1, 4):
+            index.add("{:064x}".format(n), n, float(n), {'flow_step': n}, [])
+
+        reader = catalog.CatalogIndex.open(self._directory)
+
+        # Third capture is still in the writer's open transaction
+        self.assertEqual(reader._connection.execute('PRAGMA journal_mode').fetchone()[0], 'wal')
+        self.assertEqual([r['cap_index'] for r in reader.find({})], [1, 2])
+
+        reader.close()
+        index.close()
+
+    def test_open_missing(self):
+        with self.assertRaises(catalog.CatalogException):
+            catalog.CatalogIndex.open(self._directory)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,106 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+import acquisition
+import capture
+import checkpoint
+import experiment
+import exporter
+
+__author__ = 'chris'
+
+
+class _Node(object):
+    def __init__(self, experiment, children=None):
+        self.experiment = experiment
+        self.children = children
+
+
+class _FailingCapture(capture.Capture):
+    def __init__(self, label, fail_after):
+        super().__init__(label)
+
+        self._remaining = fail_after
+
+    def get_connectors(self):
+        return ()
+
+    def _get_data(self, experiment_stack):
+        if self._remaining == 0:
+            raise capture.CaptureException('Simulated failure')
+
+        self._remaining -= 1
+
+        return {}
+
+
+class _RecordingExporter(exporter.Exporter):
+    def __init__(self):
+        super().__init__('', '', '')
+
+        self.steps = []
+
+    def export(self, capture_id, export_data):
+        self.steps.append((export_data['cap_index'], export_data['outer_count'], export_data['inner_count']))
+
+
+class _CountExperiment(experiment.RepeatExperiment):
+    def _get_state(self):
+        return {'count': self._count}
+
+    def _primary_key_field(self):
+        return 'count'
+
+
+class CheckpointResumeTest(unittest.TestCase):
+    def setUp(self):
+        self._directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self._directory)
+
+    def _run(self, fail_after=None, resume_record=None):
+        nodes = [_Node(_CountExperiment('outer', 2), [_Node(_CountExperiment('inner', 3))])]
+        capture_modules = [_FailingCapture('fail', fail_after if fail_after is not None else -1)]
+        export_module = _RecordingExporter()
+
+        journal = checkpoint.CheckpointJournal(self._directory, sync_records=1)
+
+        acquisition_loop = acquisition.Acquisition(nodes, capture_modules, export_modules=[export_module],
+                                                   checkpoint_journal=journal, resume_record=resume_record)
+
+        try:
+            acquisition_loop.run()
+        except capture.CaptureException:
+            pass
+        finally:
+            acquisition_loop.stop()
+
+        return export_module.steps
+
+    def test_resume_completes_remaining_captures(self):
+        first = self._run(fail_after=4)
+        record = checkpoint.CheckpointJournal.load(self._directory)
+
+        self.assertEqual(record['capture'], 4)
+
+        second = self._run(resume_record=record)
+
+        # Capture indices carry on from the interrupted run
+        self.assertEqual(first + second, [(n + 1, n // 3 + 1, n % 3 + 1) for n in range(6)])
+
+    def test_load_missing_journal(self):
+        with self.assertRaises(checkpoint.CheckpointException):
+            checkpoint.CheckpointJournal.load(self._directory)
+
+    def test_load_empty_journal(self):
+        open(os.path.join(self._directory, checkpoint.CheckpointJournal.FILENAME), 'w').close()
+
+        with self.assertRaises(checkpoint.CheckpointException):
+            checkpoint.CheckpointJournal.load(self._directory)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,81 @@
+import unittest
+
+import experiment
+
+__author__ = 'chris'
+
+
+class _ValueExperiment(experiment._SteppedExperiment):
+    def _get_state(self):
+        return {
+            'value': self._get_step_value()
+        }
+
+    def _primary_key_field(self):
+        return 'value'
+
+
+def _sweep(exp):
+    values = []
+
+    while exp.has_next():
+        exp.step()
+        values.append(exp.get_state()['test_value'])
+
+    exp.reset()
+
+    return values
+
+
+class StepOrderTest(unittest.TestCase):
+    def test_configured_order_by_default(self):
+        exp = _ValueExperiment('test', [3, 1, 2])
+
+        self.assertEqual(_sweep(exp), [3, 1, 2])
+        self.assertEqual(_sweep(exp), [3, 1, 2])
+
+    def test_ramp_sorts_values(self):
+        exp = _ValueExperiment('test', [3, 1, 2], order=experiment._SteppedExperiment.ORDER_RAMP)
+
+        self.assertEqual(_sweep(exp), [1, 2, 3])
+        self.assertEqual(_sweep(exp), [1, 2, 3])
+
+    def test_serpentine_alternates_direction(self):
+        exp = _ValueExperiment('test', [10, 20, 30], order=experiment._SteppedExperiment.ORDER_SERPENTINE)
+
+        self.assertEqual(_sweep(exp), [10, 20, 30])
+        self.assertEqual(_sweep(exp), [30, 20, 10])
+        self.assertEqual(_sweep(exp), [10, 20, 30])
+
+    def test_nearest_follows_closest_value(self):
+        exp = _ValueExperiment('test', [0, 50, 10, 40, 20], order=experiment._SteppedExperiment.ORDER_NEAREST)
+
+        self.assertEqual(_sweep(exp), [0, 10, 20, 40, 50])
+        self.assertEqual(_sweep(exp), [50, 40, 20, 10, 0])
+
+    def test_nearest_multi_channel(self):
+        exp = _ValueExperiment('test', [[0, 0], [10, 10], [1, 1]], order=experiment._SteppedExperiment.ORDER_NEAREST)
+
+        self.assertEqual(_sweep(exp), [[0, 0], [1, 1], [10, 10]])
+
+    def test_resume_keeps_direction(self):
+        exp = _ValueExperiment('test', [10, 20, 30], order=experiment._SteppedExperiment.ORDER_SERPENTINE)
+        _sweep(exp)
+        exp.step()
+
+        resumed = _ValueExperiment('test', [10, 20, 30], order=experiment._SteppedExperiment.ORDER_SERPENTINE)
+        resumed.set_resume_state(exp.get_resume_state())
+
+        self.assertEqual(_sweep(resumed), [20, 10])
+
+    def test_step_logs_setpoint(self):
+        exp = _ValueExperiment('test', [0.5, 0.25], order=experiment._SteppedExperiment.ORDER_RAMP)
+
+        with self.assertLogs('_ValueExperiment', level='INFO') as logs:
+            exp.step()
+
+        self.assertIn('Step 1 of 2 (value 0.25)', logs.output[-1])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,263 @@
+import ast
+import csv
+import json
+import os
+import shutil
+import sqlite3
+import tempfile
+import unittest
+
+import numpy as np
+
+import exporter
+import post_export
+import record
+
+__author__ = 'chris'
+
+
+class DelimitedExportTest(unittest.TestCase):
+    def setUp(self):
+        self._directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self._directory)
+
+    def _read(self, files, delimiter=','):
+        with open(files[0], newline='') as f:
+            return list(csv.reader(f, delimiter=delimiter, skipinitialspace=True))
+
+    def test_quoted_round_trip(self):
+        e = exporter.CSVExporter(self._directory)
+
+        rows = [
+            {'cap_time': 'Fri, 16 Oct 2026 12:00:00 +0000', 'note': 'say "hi"', 'text': 'a\nb', 'space': ' x',
+             'value': 1.5},
+            {'cap_time': 'Sat, 17 Oct 2026 12:00:00 +0000', 'note': '', 'text': 'plain', 'space': 'y', 'value': 2}
+        ]
+
+        for row in rows:
+            files = e.export(None, row)
+
+        e.close()
+
+        lines = self._read(files)
+
+        self.assertEqual(lines[0], list(rows[0]))
+        self.assertEqual(lines[1], [str(v) for v in rows[0].values()])
+        self.assertEqual(lines[2], [str(v) for v in rows[1].values()])
+
+    def test_sequence_width_changes(self):
+        e = exporter.CSVExporter(self._directory)
+
+        e.export(None, {'empty': [], 'pair': [1, 2], 'last': 'x'})
+        e.export(None, {'empty': [3, 4], 'pair': [5, 6, 7], 'last': 'y'})
+        files = e.export(None, {'empty': [], 'pair': [8, 9], 'last': 'z'})
+
+        e.close()
+
+        lines = self._read(files)
+
+        self.assertEqual(lines[0], ['empty', 'pair[0]', 'pair[1]', 'last'])
+        self.assertEqual(lines[1], ['[]', '1', '2', 'x'])
+        self.assertEqual(ast.literal_eval(lines[2][0]), [3, 4])
+        self.assertEqual(ast.literal_eval(lines[2][1]), [5, 6, 7])
+        self.assertEqual(lines[2][2:], ['', 'y'])
+        self.assertEqual(lines[3], ['[]', '8', '9', 'z'])
+
+    def test_tab_delimited_round_trip(self):
+        e = exporter.MKSPressureExporter(self._directory)
+
+        files = e.export(None, {'a': 'one\ttwo', 'b': 'three, four'})
+        e.close()
+
+        self.assertEqual(self._read(files, '\t'), [['one\ttwo', 'three, four']])
+        self.assertTrue(os.path.isfile(files[0]))
+
+    def test_record_missing_field(self):
+        e = exporter.CSVExporter(self._directory, missing='NA')
+        builder = record.RecordBuilder()
+
+        e.export(None, builder.build([{'a': 1, 'b': [2, 3], 'c': None}]))
+        files = e.export(None, builder.build([{'a': 4}, {'d': 5}]))
+        e.close()
+
+        self.assertEqual(self._read(files), [['a', 'b[0]', 'b[1]', 'c'], ['1', '2', '3', 'None'],
+                                             ['4', 'NA', 'NA', 'NA']])
+
+    def test_sidecar_keeps_shape(self):
+        e = exporter.CSVExporter(self._directory, sidecar_threshold=64)
+
+        arrays = [np.arange(64.0).reshape(4, 16), np.ones((5, 16)), np.zeros((8, 8))]
+
+        for a in arrays:
+            files = e.export(None, {'trace': a})
+
+        e.close()
+
+        reader = exporter.SidecarReader(files[0])
+        lines = self._read(files)
+
+        self.assertEqual(reader.fields(), ['trace'])
+        self.assertTrue(np.array_equal(reader.read(lines[1][0]), arrays[0]))
+        self.assertTrue(np.array_equal(reader.read(lines[2][0]), arrays[1]))
+
+        # Different trailing shape can't share the sidecar so it's written inline
+        self.assertFalse(reader.is_reference(lines[3][0]))
+        self.assertEqual(ast.literal_eval(lines[3][0]), arrays[2].tolist())
+
+    def test_state_keyed_by_capture_index(self):
+        e = exporter.CSVExporter(self._directory, state_fields='*_step', rotate_rows=2)
+
+        # Resumed run, capture indices don't start at 1
+        for n in range(5, 10):
+            files = e.export(None, {'cap_index': n, 'flow_step': n // 3, 'value': float(n)})
+
+        e.close()
+
+        segments = sorted(f for f in os.listdir(self._directory) if f.endswith('.csv'))
+
+        self.assertEqual(len(segments), 3)
+
+        state = exporter.StateReader(os.path.join(self._directory, segments[1]))
+        lines = self._read([os.path.join(self._directory, segments[1])])
+
+        self.assertEqual(lines[0], ['cap_index', 'value'])
+        self.assertEqual([state.get(int(line[0]))['flow_step'] for line in lines[1:]], [2, 2])
+
+        with open([f for f in files if f.endswith(exporter.CSVExporter.SEGMENT_MANIFEST_SUFFIX)][0]) as f:
+            manifest = json.load(f)
+
+        self.assertEqual([(s['first_cap_index'], s['last_cap_index']) for s in manifest['segments']],
+                         [(5, 6), (7, 8), (9, 9)])
+
+
+class ColumnarExportTest(unittest.TestCase):
+    def setUp(self):
+        self._directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self._directory)
+
+    def test_columns_read_back_and_files_reported(self):
+        e = exporter.ColumnarExporter(self._directory, chunk_rows=4, sync_rows=3)
+
+        reported = []
+
+        for n in range(7):
+            trace = np.arange(3.0) + n if n != 5 else [1.0, 2.0]
+            reported.append(e.export(None, {'index': n, 'trace': trace, 'label': 'x'}))
+
+        closed = e.close()
+
+        # Files are reported when the manifest is synced and on close
+        self.assertEqual([r is not None for r in reported], [False, False, True, False, False, True, False])
+        self.assertEqual(reported[2], closed)
+        self.assertTrue(all(os.path.isfile(f) for f in closed))
+
+        reader = exporter.ColumnarReader(os.path.dirname(closed[0]))
+
+        self.assertEqual(reader.rows, 7)
+        self.assertEqual(reader.columns(), ['index', 'trace'])
+        self.assertEqual(reader['index'].tolist(), list(range(7)))
+        self.assertEqual(reader['trace'][6].tolist(), [6.0, 7.0, 8.0])
+
+        # Value with a different shape is filled
+        self.assertTrue(np.isnan(reader['trace'][5]).all())
+
+
+class SQLiteExportTest(unittest.TestCase):
+    def setUp(self):
+        self._directory = tempfile.mkdtemp()
+        self._backup_directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self._directory)
+        shutil.rmtree(self._backup_directory)
+
+    def _count_backup(self, name):
+        connection = sqlite3.connect(os.path.join(self._backup_directory, name))
+
+        try:
+            return connection.execute('SELECT COUNT(*) FROM capture').fetchone()[0]
+        finally:
+            connection.close()
+
+    def test_backup_copy_is_usable(self):
+        e = exporter.SQLiteExporter(self._directory, commit_rows=3, commit_interval=3600)
+        backup = post_export.BackupCopy(self._directory, self._backup_directory)
+
+        counts = []
+
+        for n in range(1, 8):
+            files = e.export(None, {'cap_index': n, 'value': float(n), 'trace': np.arange(4.0) * n})
+
+            if files:
+                backup.process(files)
+                counts.append(self._count_backup(os.path.basename(files[0])))
+
+        files = e.close()
+        backup.process(files)
+
+        self.assertEqual(counts, [3, 6])
+        self.assertEqual(self._count_backup(os.path.basename(files[0])), 7)
+
+        reader = exporter.SQLiteReader(os.path.join(self._backup_directory, os.path.basename(files[0])))
+        rows = list(reader.rows())
+        reader.close()
+
+        self.assertEqual([r['cap_index'] for r in rows], list(range(1, 8)))
+        self.assertTrue(np.array_equal(rows[-1]['trace'], np.arange(4.0) * 7))
+
+    def _read_rows(self, files):
+        reader = exporter.SQLiteReader(files[0])
+
+        try:
+            return list(reader.rows())
+        finally:
+            reader.close()
+
+    def test_table_created_from_first_capture(self):
+        e = exporter.SQLiteExporter(self._directory, commit_rows=1)
+        files = e.export(None, {'cap_index': 1, 'value': 1.5, 'count': 2, 'name': 'a', 'trace': [1.0, 2.0]})
+        e.close()
+
+        connection = sqlite3.connect(files[0])
+
+        try:
+            (sql,) = connection.execute("SELECT sql FROM sqlite_master WHERE name = 'capture'").fetchone()
+            columns = [(r[1], r[2]) for r in connection.execute('PRAGMA table_info(capture)')]
+        finally:
+            connection.close()
+
+        self.assertTrue(sql.startswith('CREATE TABLE'))
+        self.assertEqual(columns, [('cap_index', 'INTEGER'), ('value', 'REAL'), ('count', 'INTEGER'),
+                                   ('name', 'TEXT'), ('trace', 'BLOB')])
+
+    def test_field_added_after_first_capture(self):
+        e = exporter.SQLiteExporter(self._directory)
+        e.export(None, {'cap_index': 1, 'value': 1.5})
+
+        with self.assertLogs('SQLiteExporter', level='WARNING'):
+            e.export(None, {'cap_index': 2, 'value': 2.5, 'extra': 'x'})
+
+        rows = self._read_rows(e.close())
+
+        self.assertEqual(rows[0]['extra'], None)
+        self.assertEqual(rows[1]['extra'], 'x')
+
+    def test_index_only_captures(self):
+        e = exporter.SQLiteExporter(self._directory)
+        e.export(None, {'cap_index': 1})
+        e.export(None, {'cap_index': 2})
+
+        self.assertEqual([r['cap_index'] for r in self._read_rows(e.close())], [1, 2])
+
+    def test_no_captures(self):
+        e = exporter.SQLiteExporter(self._directory)
+
+        self.assertEqual(self._read_rows(e.close()), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,143 @@
+import asyncio
+import threading
+import time
+import unittest
+
+import hardware
+
+__author__ = 'chris'
+
+
+class _BlockingConnector(hardware.Connector):
+    def __init__(self, name, delay):
+        super().__init__(name)
+
+        self._delay = delay
+        self._counter_lock = threading.Lock()
+
+        self.active = 0
+        self.peak = 0
+        self.resets = 0
+
+    def query(self, data, read_size=None):
+        with self._counter_lock:
+            self.active += 1
+            self.peak = max(self.peak, self.active)
+
+        time.sleep(self._delay)
+
+        with self._counter_lock:
+            self.active -= 1
+
+        return data
+
+    def reset(self):
+        self.resets += 1
+
+
+class AsyncConnectorTest(unittest.TestCase):
+    def test_queries_serialised(self):
+        connector = _BlockingConnector('blocking', 0.01)
+
+        async def run():
+            return await asyncio.gather(*[connector.async_query(n) for n in range(5)])
+
+        self.assertEqual(asyncio.run(run()), list(range(5)))
+        self.assertEqual(connector.peak, 1)
+
+    def test_used_from_several_event_loops(self):
+        connector = hardware.SimulatedConnector('sim', latency=0.01, response=b'ok\n')
+
+        async def run():
+            return await asyncio.gather(connector.async_query(b'read?\n'), connector.async_query(b'read?\n'))
+
+        for _ in range(2):
+            self.assertEqual(asyncio.run(run()), [b'ok\n', b'ok\n'])
+
+    def test_timeout_waits_for_blocking_call(self):
+        connector = _BlockingConnector('blocking', 0.2)
+
+        with self.assertRaises(hardware.ConnectorException):
+            asyncio.run(connector.async_query(b'slow', timeout=0.05))
+
+        # Lock is only released once the executor thread has finished with the instrument
+        self.assertEqual(connector.active, 0)
+        self.assertEqual(connector.resets, 1)
+
+    def test_excludes_blocking_callers(self):
+        connector = hardware.SimulatedConnector('sim')
+        locked = threading.Event()
+        release = threading.Event()
+
+        def hold_lock():
+            with connector.get_lock():
+                locked.set()
+                release.wait()
+
+        thread = threading.Thread(target=hold_lock)
+        thread.start()
+        locked.wait()
+
+        async def run():
+            task = asyncio.ensure_future(connector.async_write(b'x'))
+            await asyncio.sleep(0.02)
+
+            self.assertFalse(task.done())
+            release.set()
+
+            return await task
+
+        try:
+            self.assertEqual(asyncio.run(run()), 1)
+        finally:
+            release.set()
+            thread.join()
+
+
+class ConnectorEventLoopTest(unittest.TestCase):
+    def setUp(self):
+        self._loop = hardware.ConnectorEventLoop('test')
+        self._loop.start()
+
+    def tearDown(self):
+        self._loop.stop(1.0)
+
+    def test_run_from_sync_code(self):
+        connectors = [hardware.SimulatedConnector("sim{}".format(n), latency=0.05) for n in range(10)]
+
+        async def run():
+            return await asyncio.gather(*[c.async_query(b'read?\n') for c in connectors])
+
+        start_time = time.perf_counter()
+        responses = self._loop.run(run(), timeout=1.0)
+
+        # Instruments are serviced concurrently from the one loop thread
+        self.assertEqual(responses, [b'0.0\n'] * 10)
+        self.assertLess(time.perf_counter() - start_time, 0.4)
+
+    def test_run_timeout(self):
+        with self.assertRaises(hardware.ConnectorException):
+            self._loop.run(asyncio.sleep(1.0), timeout=0.05)
+
+    def test_periodic_task_survives_errors_until_cancelled(self):
+        calls = []
+
+        async def poll():
+            calls.append(time.perf_counter())
+
+            if len(calls) == 2:
+                raise hardware.ConnectorException('Instrument not ready')
+
+        future = self._loop.schedule_periodic(poll, 0.01)
+        time.sleep(0.1)
+        future.cancel()
+
+        count = len(calls)
+        time.sleep(0.05)
+
+        self.assertGreater(count, 3)
+        self.assertEqual(len(calls), count)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,112 @@
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+import metrics
+
+__author__ = 'chris'
+
+
+class HistogramTest(unittest.TestCase):
+    def test_empty(self):
+        h = metrics.Histogram()
+
+        self.assertIsNone(h.get_mean())
+        self.assertIsNone(h.get_percentile(0.5))
+
+    def test_summary(self):
+        h = metrics.Histogram()
+
+        for n in range(1, 101):
+            h.add(n * 1e-3)
+
+        s = h.summary()
+
+        self.assertEqual(s['count'], 100)
+        self.assertAlmostEqual(s['mean'], 50.5e-3)
+        self.assertEqual(s['min'], 1e-3)
+        self.assertEqual(s['max'], 100e-3)
+
+        # Percentiles are bucket edges, within the ~9% bucket resolution
+        self.assertAlmostEqual(s['p50'], 50e-3, delta=50e-3 * 0.1)
+        self.assertAlmostEqual(s['p90'], 90e-3, delta=90e-3 * 0.1)
+        self.assertLessEqual(s['p99'], s['max'])
+
+    def test_values_outside_bucket_range(self):
+        h = metrics.Histogram()
+        h.add(0.0)
+        h.add(1e6)
+
+        # Smallest and largest buckets catch everything beyond their edge
+        self.assertEqual(h.get_percentile(0.5), 1e-6)
+        self.assertEqual(h.get_percentile(1.0), 1e6)
+
+
+class MetricsRegistryTest(unittest.TestCase):
+    def setUp(self):
+        self._directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self._directory)
+
+    def _load(self):
+        with open(os.path.join(self._directory, metrics.MetricsRegistry.FILENAME), 'r') as f:
+            return json.load(f)
+
+    def test_histogram_shared_by_name(self):
+        registry = metrics.MetricsRegistry()
+
+        self.assertIs(registry.get_histogram('capture'), registry.get_histogram('capture'))
+
+        registry.record('capture', 0.5)
+
+        self.assertEqual(registry.summary()['capture']['count'], 1)
+
+    def test_write(self):
+        registry = metrics.MetricsRegistry(self._directory)
+        registry.record('export', 0.25)
+        registry.write()
+
+        output = self._load()
+
+        self.assertEqual(list(output['stages']), ['export'])
+        self.assertEqual(output['stages']['export']['total'], 0.25)
+        self.assertEqual(os.listdir(self._directory), [metrics.MetricsRegistry.FILENAME])
+
+    def test_poll_waits_for_interval(self):
+        registry = metrics.MetricsRegistry(self._directory, write_interval=3600)
+        registry.record('export', 0.25)
+        registry.poll()
+
+        self.assertEqual(os.listdir(self._directory), [])
+
+        registry = metrics.MetricsRegistry(self._directory, write_interval=0)
+        registry.poll()
+
+        self.assertEqual(self._load()['stages'], {})
+
+    def test_no_directory(self):
+        registry = metrics.MetricsRegistry()
+        registry.record('capture', 0.1)
+        registry.write()
+        registry.poll()
+
+        self.assertEqual(os.listdir(self._directory), [])
+
+    def test_log_summary(self):
+        registry = metrics.MetricsRegistry()
+        registry.record('fast', 0.001)
+        registry.record('slow', 1.0)
+        registry.get_histogram('unused')
+
+        with self.assertLogs('MetricsRegistry') as logs:
+            registry.log_summary()
+
+        # Most expensive stage first, stages without samples left out
+        self.assertEqual([line.split(':')[2] for line in logs.output[1:]], ['slow', 'fast'])
+
+
+if __name__ == '__main__':
+    unittest.main()
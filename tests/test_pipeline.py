@@ -0,0 +1,144 @@
+import threading
+import time
+import unittest
+
+import pipeline
+
+__author__ = 'chris'
+
+
+class PipelineTest(unittest.TestCase):
+    def test_items_pass_through_stages_in_order(self):
+        results = []
+
+        p = pipeline.Pipeline.from_config([('double', lambda x: x * 2), ('add', lambda x: x + 1),
+                                           ('collect', results.append)], depth=2)
+        p.start()
+
+        for n in range(20):
+            p.put(n)
+
+        p.stop()
+
+        self.assertEqual(results, [n * 2 + 1 for n in range(20)])
+
+    def test_none_result_not_forwarded(self):
+        results = []
+
+        p = pipeline.Pipeline.from_config([('filter', lambda x: x if x % 2 else None), ('collect', results.append)])
+        p.start()
+
+        for n in range(6):
+            p.put(n)
+
+        p.stop()
+
+        self.assertEqual(results, [1, 3, 5])
+
+    def test_worker_exception_raised_on_producer(self):
+        results = []
+
+        def fail_on_three(x):
+            if x == 3:
+                raise ValueError('bad item')
+
+            return x
+
+        p = pipeline.Pipeline.from_config([('check', fail_on_three), ('collect', results.append)])
+        p.start()
+
+        for n in range(3):
+            p.put(n)
+
+        p.put(3)
+
+        with self.assertRaises(pipeline.PipelineException) as context:
+            p.stop()
+
+        self.assertIsInstance(context.exception.__cause__, ValueError)
+        self.assertEqual(results, [0, 1, 2])
+
+    def test_later_stage_failure_halts_put(self):
+        def fail(x):
+            raise ValueError('bad item')
+
+        p = pipeline.Pipeline.from_config([('pass', lambda x: x), ('fail', fail)])
+        p.start()
+        p.put(1)
+
+        # Wait for the failure to be recorded on the worker thread
+        for _ in range(100):
+            if p.get_stage('fail')._failure.is_set():
+                break
+
+            time.sleep(0.01)
+
+        with self.assertRaises(pipeline.PipelineException):
+            p.put(2)
+
+        with self.assertRaises(pipeline.PipelineException):
+            p.stop()
+
+    def test_stage_options(self):
+        p = pipeline.Pipeline.from_config([('a', lambda x: x), ('b', lambda x: x)], depth=4,
+                                          stage={'b': {'depth': 1, 'policy': 'drop'}})
+
+        self.assertEqual(p.get_stage('a')._depth, 4)
+        self.assertEqual(p.get_stage('b')._policy, pipeline.PipelineStage.POLICY_DROP)
+        self.assertIsNone(p.get_stage('c'))
+
+    def test_invalid_configuration(self):
+        with self.assertRaises(pipeline.PipelineException):
+            pipeline.PipelineStage('a', lambda x: x, policy='unknown')
+
+        with self.assertRaises(pipeline.PipelineException):
+            pipeline.PipelineStage('a', lambda x: x, depth=0)
+
+
+class PipelineStageDropTest(unittest.TestCase):
+    def setUp(self):
+        self._release = threading.Event()
+        self._started = threading.Event()
+        self.processed = []
+        self.dropped = []
+
+    def _blocked(self, item):
+        self._started.set()
+        self._release.wait()
+        self.processed.append(item)
+
+    def _fill(self, policy):
+        stage = pipeline.PipelineStage('slow', self._blocked, depth=2, policy=policy,
+                                       drop_function=self.dropped.append)
+        stage.start()
+
+        # First item is held by the worker, the queue then fills
+        stage.put(0)
+        self._started.wait(1.0)
+
+        for n in range(1, 5):
+            stage.put(n)
+
+        self._release.set()
+        stage.stop()
+
+        return stage
+
+    def test_drop_incoming(self):
+        stage = self._fill(pipeline.PipelineStage.POLICY_DROP)
+
+        self.assertEqual(self.processed, [0, 1, 2])
+        self.assertEqual(self.dropped, [3, 4])
+        self.assertEqual(stage.get_dropped(), 2)
+        self.assertEqual(stage.get_high_water(), 2)
+
+    def test_drop_oldest(self):
+        stage = self._fill(pipeline.PipelineStage.POLICY_DROP_OLDEST)
+
+        self.assertEqual(self.processed, [0, 3, 4])
+        self.assertEqual(self.dropped, [1, 2])
+        self.assertEqual(stage.get_dropped(), 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
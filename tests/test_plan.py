@@ -0,0 +1,107 @@
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+import checkpoint
+import experiment
+import plan
+
+__author__ = 'chris'
+
+
+class _Node(object):
+    def __init__(self, experiment, children=None):
+        self.experiment = experiment
+        self.children = children
+
+
+class ExperimentPlanTest(unittest.TestCase):
+    def _tree(self):
+        # Outer delays of 10 and 20 seconds, each running three repeats
+        return [_Node(experiment.TimeExperiment('outer', [10.0, 20.0]), [_Node(experiment.RepeatExperiment('rep', 3))])]
+
+    def test_counts(self):
+        p = plan.ExperimentPlan(self._tree())
+
+        self.assertEqual(p.captures, 6)
+        self.assertEqual(p.steps, 8)
+        self.assertEqual(p.delay, 30.0)
+
+    def test_schedule(self):
+        schedule = list(plan.ExperimentPlan(self._tree()).schedule())
+
+        self.assertEqual([s.path for s in schedule], [(('outer', 0), ('rep', n)) for n in range(3)] +
+                         [(('outer', 1), ('rep', n)) for n in range(3)])
+
+        # Outer step delay falls before the first capture of each sweep
+        self.assertEqual([s.delay for s in schedule], [10.0, 0.0, 0.0, 20.0, 0.0, 0.0])
+
+    def test_sibling_trees(self):
+        nodes = self._tree() + [_Node(experiment.RepeatExperiment('after', 2))]
+        p = plan.ExperimentPlan(nodes)
+
+        self.assertEqual(p.captures, 8)
+        self.assertEqual(len(list(p.schedule())), 8)
+
+    def test_estimate(self):
+        estimate = plan.ExperimentPlan(self._tree()).estimate(capture_time=0.5, step_time=0.1,
+                                                              export_size={'csv': 100})
+
+        self.assertEqual(estimate['capture_time'], 3.0)
+        self.assertAlmostEqual(estimate['step_time'], 0.8)
+        self.assertAlmostEqual(estimate['wall_time'], 33.8)
+        self.assertEqual(estimate['export_size'], {'csv': 600})
+
+    def test_unplannable_experiment(self):
+        with self.assertRaises(plan.PlanException):
+            plan.ExperimentPlan([_Node(experiment.Experiment('base'))])
+
+    def test_describe(self):
+        lines = plan.ExperimentPlan(self._tree()).describe()
+
+        self.assertEqual(lines, ['outer (TimeExperiment): 2 steps, 0:00:30 delay',
+                                 '\trep (RepeatExperiment): 3 steps, 0:00:00 delay'])
+
+
+class MeasureReferenceTest(unittest.TestCase):
+    def setUp(self):
+        self._directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self._directory)
+
+    def test_capture_time_excludes_scheduled_delay(self):
+        reference_plan = plan.ExperimentPlan([_Node(experiment.TimeExperiment('outer', [10.0, 20.0]),
+                                                    [_Node(experiment.RepeatExperiment('rep', 3))])])
+
+        with open(os.path.join(self._directory, checkpoint.CheckpointJournal.FILENAME), 'w') as f:
+            for (capture, timestamp) in ((1, 100.0), (2, 102.0), (4, 126.0)):
+                f.write(json.dumps({'capture': capture, 'timestamp': timestamp}) + '\n')
+
+        with open(os.path.join(self._directory, 'data.csv'), 'wb') as f:
+            f.write(b'x' * 400)
+
+        (capture_time, export_size) = plan.measure_reference(self._directory, reference_plan, {'csv': 'CSVExporter'})
+
+        # Three captures measured over 26 seconds including the 20 second outer step
+        self.assertAlmostEqual(capture_time, 2.0)
+        self.assertEqual(export_size, {'CSVExporter': 100.0})
+
+    def test_missing_journal(self):
+        with self.assertRaises(plan.PlanException):
+            plan.measure_reference(self._directory, plan.ExperimentPlan([]), {})
+
+
+class FormatTest(unittest.TestCase):
+    def test_format_duration(self):
+        self.assertEqual(plan.format_duration(3725.4), '1:02:05')
+
+    def test_format_size(self):
+        self.assertEqual(plan.format_size(512), '512.0 B')
+        self.assertEqual(plan.format_size(2.5e9), '2.5 GB')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,498 @@
+import errno
+import gzip
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+import unittest.mock
+import zipfile
+
+import post_export
+
+__author__ = 'chris'
+
+
+class LatestCopyTest(unittest.TestCase):
+    def setUp(self):
+        self._directory = tempfile.mkdtemp()
+        self._target_directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self._directory)
+        shutil.rmtree(self._target_directory)
+
+    def _write(self, name, content):
+        path = os.path.join(self._directory, name)
+
+        with open(path, 'wb') as f:
+            f.write(content)
+
+        return path
+
+    def _read(self, path):
+        with open(path, 'rb') as f:
+            return f.read()
+
+    def test_publish_falls_through_when_copy_stops_early(self):
+        content = os.urandom(256 * 1024)
+        path = self._write('data.bin', content)
+
+        latest = post_export.LatestCopy(self._directory, self._target_directory, atomic=True)
+
+        # Copy methods that stop after returning 0 must not publish a truncated file
+        with unittest.mock.patch('os.link', side_effect=OSError()), \
+                unittest.mock.patch('fcntl.ioctl', side_effect=OSError()), \
+                unittest.mock.patch('os.copy_file_range', return_value=0), \
+                unittest.mock.patch('os.sendfile', return_value=0):
+            (published,) = latest.process([path])
+
+        self.assertEqual(self._read(published), content)
+        self.assertEqual(os.listdir(self._target_directory), ['data.bin'])
+
+    def test_short_copy_does_not_disable_method(self):
+        latest = post_export.LatestCopy(self._directory, self._target_directory, atomic=True)
+        copy_file_range = os.copy_file_range
+        calls = []
+
+        def stop_once(fd_in, fd_out, count):
+            calls.append(count)
+
+            return 0 if len(calls) == 1 else copy_file_range(fd_in, fd_out, count)
+
+        with unittest.mock.patch('os.link', side_effect=OSError(errno.EXDEV, 'Cross-device link')) as link, \
+                unittest.mock.patch('fcntl.ioctl', side_effect=OSError(errno.EOPNOTSUPP, 'Not supported')), \
+                unittest.mock.patch('os.copy_file_range', side_effect=stop_once):
+            latest.process([self._write('a.bin', b'first')])
+            (published,) = latest.process([self._write('b.bin', b'second')])
+
+        # Unsupported methods are skipped from then on, the one that stopped short is tried again
+        self.assertEqual(link.call_count, 1)
+        self.assertEqual(len(calls), 2)
+        self.assertEqual(self._read(published), b'second')
+
+    def test_publish_replaces_previous_copy(self):
+        latest = post_export.LatestCopy(self._directory, self._target_directory, atomic=True)
+
+        (first,) = latest.process([self._write('a.csv', b'first')])
+        (second,) = latest.process([self._write('b.csv', b'second')])
+
+        self.assertFalse(os.path.exists(first))
+        self.assertEqual(self._read(second), b'second')
+
+
+class _RecordingPostExporter(post_export.PostExporter):
+    def __init__(self, name, calls, delay):
+        super().__init__('')
+
+        self._name = name
+        self._calls = calls
+        self._delay = delay
+        self._busy = False
+
+    def process(self, exported_files):
+        if self._busy:
+            raise AssertionError("{} called concurrently".format(self._name))
+
+        self._busy = True
+        time.sleep(self._delay)
+        self._calls.append((self._name, tuple(exported_files)))
+        self._busy = False
+
+
+class PostExportPoolTest(unittest.TestCase):
+    def setUp(self):
+        self._directory = tempfile.mkdtemp()
+        self._target_directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self._directory)
+        shutil.rmtree(self._target_directory)
+
+    def test_post_exporters_run_in_order_per_path(self):
+        calls = []
+        modules = [_RecordingPostExporter(name, calls, delay) for (name, delay) in
+                   (('slow', 0.02), ('fast', 0.0), ('last', 0.01))]
+
+        pool = post_export.PostExportPool(modules, workers=4)
+
+        for n in range(8):
+            pool.submit(["{}.mat".format(n)])
+
+        pool.shutdown()
+
+        for n in range(8):
+            path = ("{}.mat".format(n),)
+
+            self.assertEqual([name for (name, paths) in calls if paths == path], ['slow', 'fast', 'last'])
+
+        # Each post-exporter sees paths in the order they were submitted
+        for name in ('slow', 'fast', 'last'):
+            self.assertEqual([paths for (module, paths) in calls if module == name],
+                             [("{}.mat".format(n),) for n in range(8)])
+
+    def test_backup_before_compress_deletes(self):
+        backup = post_export.BackupCopy(self._directory, self._target_directory)
+        compress = post_export.CompressPostExporter(self._directory, workers=2)
+
+        pool = post_export.PostExportPool([backup, compress], workers=4)
+
+        contents = {}
+
+        for n in range(20):
+            path = os.path.join(self._directory, "{:02d}.mat".format(n))
+            contents[os.path.basename(path)] = os.urandom(64 * 1024)
+
+            with open(path, 'wb') as f:
+                f.write(contents[os.path.basename(path)])
+
+            pool.submit([path])
+
+        pool.shutdown()
+        compress.close()
+
+        for (name, content) in contents.items():
+            with open(os.path.join(self._target_directory, name), 'rb') as f:
+                self.assertEqual(f.read(), content)
+
+            with gzip.open(os.path.join(self._directory, name + '.gz'), 'rb') as f:
+                self.assertEqual(f.read(), content)
+
+            self.assertFalse(os.path.exists(os.path.join(self._directory, name)))
+
+    def test_repeated_path_waits_for_running_chain(self):
+        calls = []
+        release = threading.Event()
+
+        class _Blocking(_RecordingPostExporter):
+            def process(self, exported_files):
+                release.wait()
+                super().process(exported_files)
+
+        pool = post_export.PostExportPool([_Blocking('block', calls, 0.0), _RecordingPostExporter('next', calls, 0.0)],
+                                          workers=4)
+
+        pool.submit(['a.csv'])
+        pool.submit(['a.csv', 'b.mat'])
+        pool.submit(['a.csv', 'c.mat'])
+
+        release.set()
+        pool.shutdown()
+
+        # Queued requests for a.csv coalesce into the latest one, which waits for the running chain
+        for name in ('block', 'next'):
+            self.assertEqual([paths for (module, paths) in calls if module == name],
+                             [('a.csv',), ('b.mat',), ('a.csv', 'c.mat')])
+
+        self.assertLess(calls.index(('next', ('a.csv',))), calls.index(('block', ('a.csv', 'c.mat'))))
+
+
+class ChunkStoreBackupTest(unittest.TestCase):
+    def setUp(self):
+        self._directory = tempfile.mkdtemp()
+        self._target_directory = tempfile.mkdtemp()
+        self._restore_directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self._directory)
+        shutil.rmtree(self._target_directory)
+        shutil.rmtree(self._restore_directory)
+
+    def _restore(self):
+        run_name = os.path.basename(self._directory)
+        paths = post_export.ChunkStoreBackup.restore(self._target_directory, run_name, self._restore_directory)
+
+        contents = {}
+
+        for path in paths:
+            with open(path, 'rb') as f:
+                contents[os.path.basename(path)] = f.read()
+
+        return contents
+
+    def test_restore_appended_and_rewritten_files(self):
+        backup = post_export.ChunkStoreBackup(self._directory, self._target_directory, chunk_size=4096)
+
+        log_path = os.path.join(self._directory, 'log.csv')
+        data_path = os.path.join(self._directory, 'data.bin')
+
+        expected = {'log.csv': b''}
+
+        for n in range(10):
+            # Growing file is chunked incrementally, the other is rewritten each time
+            with open(log_path, 'ab') as f:
+                row = os.urandom(3000)
+                f.write(row)
+                expected['log.csv'] += row
+
+            expected['data.bin'] = os.urandom(20000 + n)
+
+            with open(data_path, 'wb') as f:
+                f.write(expected['data.bin'])
+
+            backup.process([log_path, data_path])
+
+        backup.close()
+
+        self.assertEqual(self._restore(), expected)
+
+    def test_inserted_bytes_only_store_changed_chunks(self):
+        backup = post_export.ChunkStoreBackup(self._directory, self._target_directory, chunk_size=4096)
+
+        content = os.urandom(1024 * 1024)
+
+        for (name, data) in (('a.bin', content), ('b.bin', b'inserted' + content)):
+            with open(os.path.join(self._directory, name), 'wb') as f:
+                f.write(data)
+
+            backup.process([os.path.join(self._directory, name)])
+
+        backup.close()
+
+        # Content-defined boundaries realign after the insertion so almost every chunk is shared
+        stored = sum(os.path.getsize(os.path.join(root, f)) for (root, _, files) in
+                     os.walk(os.path.join(self._target_directory, post_export.ChunkStoreBackup.CHUNK_DIRECTORY))
+                     for f in files)
+
+        self.assertLess(stored, len(content) + 4 * 16384)
+        self.assertEqual(self._restore(), {'a.bin': content, 'b.bin': b'inserted' + content})
+
+    def test_restore_ignores_incomplete_manifest_line(self):
+        backup = post_export.ChunkStoreBackup(self._directory, self._target_directory, chunk_size=4096)
+
+        path = os.path.join(self._directory, 'a.bin')
+        content = os.urandom(50000)
+
+        with open(path, 'wb') as f:
+            f.write(content)
+
+        (manifest,) = backup.process([path])
+        backup.close()
+
+        with open(manifest, 'a') as f:
+            f.write('{"file": "a.bin", "si')
+
+        self.assertEqual(self._restore(), {'a.bin': content})
+
+    @unittest.skipUnless(os.path.isdir('/proc/self/fd'), 'needs /proc to map descriptors to paths')
+    def test_chunks_synced_before_manifest_entry(self):
+        backup = post_export.ChunkStoreBackup(self._directory, self._target_directory, chunk_size=4096)
+
+        path = os.path.join(self._directory, 'a.bin')
+
+        with open(path, 'wb') as f:
+            f.write(os.urandom(50000))
+
+        synced = set()
+        fsync = os.fsync
+        write_manifest_entry = backup._write_manifest_entry
+
+        def record_fsync(descriptor):
+            synced.add(os.readlink("/proc/self/fd/{}".format(descriptor)))
+            fsync(descriptor)
+
+        def check_write_manifest_entry(name, size, keep, chunks):
+            write_manifest_entry(name, size, keep, chunks)
+
+            for (digest, _) in chunks:
+                chunk_path = post_export.ChunkStoreBackup._chunk_path(self._target_directory, digest)
+
+                self.assertIn(chunk_path + '.tmp', synced)
+                self.assertIn(os.path.dirname(chunk_path), synced)
+
+        with unittest.mock.patch('os.fsync', record_fsync), \
+                unittest.mock.patch.object(backup, '_write_manifest_entry', check_write_manifest_entry):
+            backup.process([path])
+
+        backup.close()
+
+        self.assertIn(os.path.join(self._target_directory, post_export.ChunkStoreBackup.CHUNK_DIRECTORY), synced)
+
+
+class ZipPostExporterTest(unittest.TestCase):
+    def setUp(self):
+        self._directory = tempfile.mkdtemp()
+        self._restore_directory = tempfile.mkdtemp()
+
+        self._result_directory = os.path.join(self._directory, 'run')
+        os.mkdir(self._result_directory)
+
+        self._path = os.path.join(self._result_directory, 'data.csv')
+
+    def tearDown(self):
+        shutil.rmtree(self._directory)
+        shutil.rmtree(self._restore_directory)
+
+    def _append(self, content, mode='ab'):
+        with open(self._path, mode) as f:
+            f.write(content)
+
+    def _members(self, zip_path):
+        with zipfile.ZipFile(zip_path, 'r') as archive:
+            return [(info.filename, info.comment) for info in archive.infolist()]
+
+    def _restore(self, zip_path):
+        (restored,) = post_export.ZipPostExporter.reassemble(zip_path, self._restore_directory)
+
+        with open(restored, 'rb') as f:
+            return f.read()
+
+    def test_unchanged_file_archived_once(self):
+        archiver = post_export.ZipPostExporter(self._result_directory)
+        self._append(b'a,b\n')
+
+        archiver.process([self._path])
+        (zip_path,) = archiver.process([self._path])
+        archiver.close()
+
+        self.assertEqual(len(self._members(zip_path)), 1)
+        self.assertEqual(self._restore(zip_path), b'a,b\n')
+
+    def test_growth_held_back_until_segment_size(self):
+        archiver = post_export.ZipPostExporter(self._result_directory, segment_size=8)
+        self._append(b'a,b\n')
+        archiver.process([self._path])
+
+        self._append(b'1,2\n')
+        (zip_path,) = archiver.process([self._path])
+
+        self._append(b'3,4\n')
+        archiver.process([self._path])
+
+        self._append(b'5,6\n')
+        archiver.process([self._path])
+        archiver.close()
+
+        # Only the appended bytes go into each segment, the tail is flushed on close
+        members = self._members(zip_path)
+
+        self.assertEqual([comment for (_, comment) in members], [b'', b'offset=4', b'offset=12'])
+        self.assertEqual(self._restore(zip_path), b'a,b\n1,2\n3,4\n5,6\n')
+
+    def test_rewritten_file_archived_again(self):
+        archiver = post_export.ZipPostExporter(self._result_directory, segment_size=1)
+        self._append(b'first version\n')
+        archiver.process([self._path])
+
+        self._append(b'second\n', 'wb')
+        (zip_path,) = archiver.process([self._path])
+        archiver.close()
+
+        self.assertEqual([comment for (_, comment) in self._members(zip_path)], [b'', b'offset=0'])
+        self.assertEqual(self._restore(zip_path), b'second\n')
+
+    def test_checkpoint_leaves_readable_archive(self):
+        archiver = post_export.ZipPostExporter(self._result_directory, checkpoint_interval=0, segment_size=1024)
+        self._append(b'a,b\n')
+        archiver.process([self._path])
+
+        self._append(b'1,2\n')
+        (zip_path,) = archiver.process([self._path])
+
+        # Archive is complete on disk while still open, including growth below the segment size
+        self.assertEqual(self._restore(zip_path), b'a,b\n1,2\n')
+
+        archiver.close()
+
+    def test_resume_keeps_existing_members(self):
+        archiver = post_export.ZipPostExporter(self._result_directory)
+        self._append(b'a,b\n')
+        archiver.process([self._path])
+        archiver.close()
+
+        self._append(b'1,2\n')
+
+        archiver = post_export.ZipPostExporter(self._result_directory)
+        (zip_path,) = archiver.process([self._path])
+        archiver.close()
+
+        self.assertEqual(len(self._members(zip_path)), 2)
+        self.assertEqual(self._restore(zip_path), b'a,b\n1,2\n')
+
+    def test_unknown_compression(self):
+        with self.assertRaises(post_export.PostExporterException):
+            post_export.ZipPostExporter(self._result_directory, compression='zstd')
+
+
+class IncrementalBackupTest(unittest.TestCase):
+    def setUp(self):
+        self._directory = tempfile.mkdtemp()
+        self._target_directory = tempfile.mkdtemp()
+
+        self._path = os.path.join(self._directory, 'data.csv')
+        self._target_path = os.path.join(self._target_directory, 'data.csv')
+
+        self._backup = post_export.BackupCopy(self._directory, self._target_directory, incremental=True)
+
+    def tearDown(self):
+        shutil.rmtree(self._directory)
+        shutil.rmtree(self._target_directory)
+
+    def _write(self, path, content, mode='ab'):
+        with open(path, mode) as f:
+            f.write(content)
+
+    def _sync(self):
+        # Bytes copied for each call to process
+        with unittest.mock.patch.object(self._backup, '_copy', wraps=self._backup._copy) as copy:
+            self.assertEqual(self._backup.process([self._path]), (self._target_path,))
+
+        with open(self._path, 'rb') as f_in, open(self._target_path, 'rb') as f_out:
+            self.assertEqual(f_in.read(), f_out.read())
+
+        return [c[0][2] for c in copy.call_args_list]
+
+    def test_appended_bytes_only(self):
+        self._write(self._path, b'a,b\n')
+
+        self.assertEqual(self._sync(), [4])
+
+        self._write(self._path, b'1,2\n3,4\n')
+
+        self.assertEqual(self._sync(), [8])
+        self.assertEqual(self._sync(), [])
+
+    def test_rewritten_file_copied_in_full(self):
+        self._write(self._path, b'a,b\n1,2\n')
+        self._sync()
+
+        # Same inode and longer, but the bytes already backed up changed
+        self._write(self._path, b'a,c\n1,2\n3,4\n', 'r+b')
+
+        self.assertEqual(self._sync(), [12])
+
+    def test_truncated_file_copied_in_full(self):
+        self._write(self._path, b'a,b\n1,2\n')
+        self._sync()
+
+        self._write(self._path, b'a,b\n', 'wb')
+
+        self.assertEqual(self._sync(), [4])
+
+    def test_replaced_file_copied_in_full(self):
+        self._write(self._path, b'a,b\n')
+        self._sync()
+
+        replacement = os.path.join(self._directory, 'new.csv')
+        self._write(replacement, b'a,b\n1,2\n')
+        os.replace(replacement, self._path)
+
+        self.assertEqual(self._sync(), [8])
+
+    def test_changed_backup_copied_in_full(self):
+        self._write(self._path, b'a,b\n')
+        self._sync()
+
+        self._write(self._target_path, b'x')
+        self._write(self._path, b'1,2\n')
+
+        self.assertEqual(self._sync(), [8])
+
+        os.remove(self._target_path)
+
+        self.assertEqual(self._sync(), [8])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,75 @@
+import unittest
+
+import record
+
+__author__ = 'chris'
+
+
+class RecordBuilderTest(unittest.TestCase):
+    def test_parts_combine_like_update(self):
+        builder = record.RecordBuilder()
+
+        r = builder.build([{'a': 1, 'b': 2.0}, {'c': 'x', 'a': 3}])
+
+        self.assertEqual(r.keys(), ('a', 'b', 'c'))
+        self.assertEqual(r.to_dict(), {'a': 3, 'b': 2.0, 'c': 'x'})
+
+    def test_schema_shared_and_columns_typed(self):
+        builder = record.RecordBuilder()
+
+        first = builder.build([{'a': 1}, {'b': 1.5}])
+        second = builder.build([{'b': 2.5}, {'a': 2}])
+
+        self.assertIs(first.batch, second.batch)
+        self.assertEqual(second.to_dict(), {'a': 2, 'b': 2.5})
+        self.assertEqual(first.batch.column('a').typecode, 'q')
+        self.assertEqual(first.batch.column('b').typecode, 'd')
+
+    def test_missing_and_mismatched_values(self):
+        builder = record.RecordBuilder()
+
+        builder.build([{'a': 1, 'b': 1.0}])
+        r = builder.build([{'a': 'text'}])
+
+        self.assertEqual(r.to_dict(), {'a': 'text'})
+        self.assertEqual(list(r.batch.column('a')), [1, 'text'])
+
+    def test_missing_fields_absent(self):
+        builder = record.RecordBuilder()
+
+        first = builder.build([{'a': 1, 'b': None}])
+        second = builder.build([{'a': 2}])
+
+        self.assertIn('b', first)
+        self.assertIsNone(first['b'])
+        self.assertNotIn('b', second)
+        self.assertEqual(second.get('b', 'default'), 'default')
+        self.assertEqual(second.keys(), ('a',))
+        self.assertEqual(list(second.items()), [('a', 2)])
+        self.assertEqual(len(second), 1)
+
+        with self.assertRaises(KeyError):
+            second['b']
+
+    def test_new_field_extends_schema(self):
+        builder = record.RecordBuilder()
+
+        first = builder.build([{'a': 1, 'b': 2}])
+        second = builder.build([{'a': 3}, {'c': 4}])
+
+        self.assertIsNot(first.batch, second.batch)
+        self.assertEqual(len(first.batch), 1)
+        self.assertEqual(second.schema.fields, ('a', 'b', 'c'))
+        self.assertEqual(second.to_dict(), {'a': 3, 'c': 4})
+
+    def test_full_batch(self):
+        builder = record.RecordBuilder(batch_size=2)
+
+        records = [builder.build([{'a': n}]) for n in range(5)]
+
+        self.assertEqual([r['a'] for r in records], list(range(5)))
+        self.assertEqual(len(set(id(r.batch) for r in records)), 3)
+
+
+if __name__ == '__main__':
+    unittest.main()
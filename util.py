@@ -1,5 +1,6 @@
 import functools
 import inspect
+import json
 import logging
 import os
 import random
@@ -40,6 +41,18 @@ def class_instance_from_dict(class_name, parent, *args, **kwargs):
     return class_type(*args, **kwargs)
 
 
+def prefix_keys(prefix, data, key_cache):
+    # Prefixed keys are cached since modules return the same keys on every call
+    try:
+        return {key_cache[k]: v for (k, v) in data.items()}
+    except KeyError:
+        for k in data:
+            if k not in key_cache:
+                key_cache[k] = prefix + '_' + k
+
+        return {key_cache[k]: v for (k, v) in data.items()}
+
+
 class ExceptionRetry(object):
     default_retry = 3
 
@@ -163,6 +176,21 @@ def get_module_subclasses(module, parent):
     return subclass_list
 
 
+def sql_identifier(name):
+    # Quote a field name for use as an SQLite identifier
+    return '"' + str(name).replace('"', '""') + '"'
+
+
+def write_json(path, obj, **kwargs):
+    # Write to a temporary file and rename it over the target so readers never see a partial file
+    temp_path = path + '.tmp'
+
+    with open(temp_path, 'w') as f:
+        json.dump(obj, f, **kwargs)
+
+    os.replace(temp_path, path)
+
+
 def unique_list(l):
     seen = set()
     seen_add = seen.add